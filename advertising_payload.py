@@ -0,0 +1,136 @@
+from collections import namedtuple
+
+
+# Legacy advertising and scan response PDUs carry at most 31 bytes each
+LEGACY_ADV_LENGTH = 31
+
+# Every AD structure starts with a length byte and a type byte
+AD_HEADER_SIZE = 2
+# Flags AD structure that BlueZ adds to peripheral advertisements
+FLAGS_SIZE = AD_HEADER_SIZE + 1
+TX_POWER_SIZE = AD_HEADER_SIZE + 1
+COMPANY_ID_SIZE = 2
+
+BASE_UUID_SUFFIX = '-0000-1000-8000-00805f9b34fb'
+
+PayloadPlan = namedtuple('PayloadPlan', [
+    'adv',                  # field names placed in the advertising PDU
+    'scan_response',        # field names placed in the scan response
+    'local_name',           # name to advertise, possibly shortened
+    'name_shortened',
+    'adv_size',
+    'scan_response_size',
+    'extended',
+])
+
+
+def uuid_length(uuid):
+    """
+    Encoded length of a UUID. UUIDs on the Bluetooth base UUID shrink to
+    16 or 32 bits like BlueZ sends them.
+    """
+    uuid = str(uuid).lower()
+    if len(uuid) == 4:
+        return 2
+    if len(uuid) == 8:
+        return 4
+    if uuid.endswith(BASE_UUID_SUFFIX):
+        return 2 if uuid.startswith('0000') else 4
+    return 16
+
+
+def uuid_list_size(uuids):
+    """
+    Size of the UUID list AD structures, one per UUID width.
+    """
+    widths = {}
+    for uuid in uuids or ():
+        length = uuid_length(uuid)
+        widths[length] = widths.get(length, 0) + length
+    return sum(AD_HEADER_SIZE + total for total in widths.values())
+
+
+def manufacturer_data_size(manufacturer_data):
+    return sum(AD_HEADER_SIZE + COMPANY_ID_SIZE + len(data) for data in (manufacturer_data or {}).values())
+
+
+def service_data_size(service_data):
+    return sum(AD_HEADER_SIZE + uuid_length(uuid) + len(data) for uuid, data in (service_data or {}).items())
+
+
+def shorten_name(name, max_bytes):
+    """
+    Cut a name to at most max_bytes of UTF-8 without splitting a character.
+    """
+    return name.encode('utf-8')[:max(0, max_bytes)].decode('utf-8', 'ignore')
+
+
+def plan_payload(service_uuids=None, solicit_uuids=None, manufacturer_data=None, service_data=None,
+                 local_name=None, include_tx_power=False, include_flags=True,
+                 max_adv_length=LEGACY_ADV_LENGTH, max_scan_response_length=LEGACY_ADV_LENGTH):
+    """
+    Place the advertising fields so every PDU fits, using the sizes BlueZ
+    encodes them with. Flags, UUIDs and TX power must go in the advertising
+    PDU. Manufacturer and service data follow them there if they fit,
+    otherwise they go to the scan response.
+
+    For legacy advertising BlueZ sends the local name in the scan response,
+    which an actively scanning phone receives in the same scan. With
+    extended advertising (max_adv_length above 31) everything goes in one
+    PDU and there is no scan response. The name is shortened to the space
+    that is left.
+
+    Raises ValueError when the fields cannot be placed.
+    """
+    extended = max_adv_length > LEGACY_ADV_LENGTH
+    adv, scan_response = [], []
+    adv_size = scan_response_size = 0
+
+    required = (
+        ('flags', FLAGS_SIZE if include_flags else 0),
+        ('service_uuids', uuid_list_size(service_uuids)),
+        ('solicit_uuids', uuid_list_size(solicit_uuids)),
+        ('tx_power', TX_POWER_SIZE if include_tx_power else 0),
+    )
+    for field, size in required:
+        if size:
+            adv.append(field)
+            adv_size += size
+    if adv_size > max_adv_length:
+        raise ValueError(f"Advertising needs {adv_size} bytes for {', '.join(adv)}, only {max_adv_length} available")
+
+    optional = (
+        ('manufacturer_data', manufacturer_data_size(manufacturer_data)),
+        ('service_data', service_data_size(service_data)),
+    )
+    for field, size in optional:
+        if not size:
+            continue
+        if adv_size + size <= max_adv_length:
+            adv.append(field)
+            adv_size += size
+        elif not extended and scan_response_size + size <= max_scan_response_length:
+            scan_response.append(field)
+            scan_response_size += size
+        else:
+            raise ValueError(f"No room for {size} bytes of {field}")
+
+    name_shortened = False
+    if local_name:
+        if extended:
+            target, room = adv, max_adv_length - adv_size - AD_HEADER_SIZE
+        else:
+            target, room = scan_response, max_scan_response_length - scan_response_size - AD_HEADER_SIZE
+        name = shorten_name(local_name, room)
+        if not name:
+            raise ValueError("No room left for the local name")
+        name_shortened = name != local_name
+        local_name = name
+        target.append('local_name')
+        if target is adv:
+            adv_size += AD_HEADER_SIZE + len(name.encode('utf-8'))
+        else:
+            scan_response_size += AD_HEADER_SIZE + len(name.encode('utf-8'))
+
+    return PayloadPlan(tuple(adv), tuple(scan_response), local_name, name_shortened,
+                       adv_size, scan_response_size, extended)
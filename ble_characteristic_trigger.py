@@ -1,213 +1,261 @@
-import json
-import sys
-import array
-import subprocess
-import dbus
+import os
+import signal
 import socket
-import time
+import dbus
+import dbus.exceptions
+import dbus.mainloop.glib
+import dbus.service
 from gi.repository import GLib
-from gatt_module import (
-    GATT_CHARACTERISTIC_IFACE, CUDDiscriptor, Characteristic, InvalidValueLengthException, 
-    logger, InvalidArgsException, NotSupportedException, Advertisement, Service, Application, Agent, 
-    AGENT_PATH, BLUEZ_SERVICE_NAME
-)
-
-mainloop = GLib.MainLoop()
-
-
-class WiFiManager:
-    def __init__(self, interface="wlan0"):
-        self.interface = interface
-        self.ssid = None
-        self.psk = None
-
-    def set_credentials(self, ssid, psk):
-        if len(ssid) > 32:
-            raise ValueError("SSID must be 32 characters or less")
-        if not (8 <= len(psk) <= 63):
-            raise ValueError("PSK must be between 8 and 63 characters")
-        self.ssid = ssid
-        self.psk = psk
-        logger.info(f"WiFi credentials set: SSID={self.ssid}")
-
-    def connect(self, retries=3, delay=5):
-        if not self.ssid or not self.psk:
-            raise ValueError("SSID and PSK must be set before connecting")
-
-        last_error = "Unknown error"
-        for attempt in range(1, retries + 1):
-            cmd = [
-                "nmcli", "device", "wifi", "connect", self.ssid,
-                "password", self.psk,
-                "ifname", self.interface
-            ]
-
-            logger.info(f"Attempt {attempt}: Running command: {' '.join(cmd)}")
-            process = subprocess.run(cmd, capture_output=True, text=True)
-
-            if process.returncode == 0:
-                logger.info(f"Connected to Wi-Fi network {self.ssid}: {process.stdout}")
-                return {"success": True, "message": "Connected successfully"}
-
-            error_msg = process.stderr.strip()
-            logger.warning(f"Failed to connect (attempt {attempt}): {error_msg}")
-            last_error = error_msg
-
-            if attempt < retries:
-                time.sleep(delay)
-
-        logger.error(f"All {retries} connection attempts failed.")
-        return {"success": False, "message": last_error}
-
-    def scan_wifi_networks(self):
+from gatt_server import Agent, Application, logger, scheduler
+from wpa_characteristics import WPAService, create_advertising_controller, mainloop, register_agent
+
+BUTTON_GPIO = 2
+ADVERTISING_WINDOW = 300
+
+CONTROL_SOCKET = '/run/ble-wifi-config/control.sock'
+
+DAEMON_BUS_NAME = 'nl.dewarmte.BleWifiConfig'
+DAEMON_IFACE = 'nl.dewarmte.BleWifiConfig1'
+DAEMON_PATH = '/nl/dewarmte/BleWifiConfig'
+
+
+class AdvertisingDaemon:
+    """
+    Long-running provisioning daemon. The agent and GATT application are
+    registered once at startup, triggers only start and stop the advertising
+    controller, so re-advertising costs a single BlueZ call.
+    """
+    def __init__(self, bus, advertising_window=ADVERTISING_WINDOW):
+        self.bus = bus
+        self.advertising_window = advertising_window
+        self.agent = Agent(bus)
+        self.agent.set_exit_on_release(False)
+        self.application = Application(bus, mainloop)
+        self.wpa_service = WPAService(bus, 0)
+        self.application.add_service(self.wpa_service)
+        self.advertising = create_advertising_controller(bus)
+        self.application.set_advertising(self.advertising)
+        self.window_timer = None
+        self.control = None
+
+    def start(self):
+        """
+        Register the agent and GATT application, advertising stays off until triggered.
+        """
+        register_agent(self.bus)
+        self.application.register_application()
+        logger.info("Daemon ready, waiting for an advertising trigger")
+
+    def is_advertising(self):
+        return self.advertising.running
+
+    def start_advertising(self):
+        """
+        Start advertising, or extend the window if already advertising. The
+        adapter is only discoverable and pairable while advertising.
+        """
+        self.restart_window()
+        if self.advertising.running:
+            return
+        advertisement = self.advertising.phases[0].advertisement
+        for callback in (advertisement.configure_adapter, self.wpa_service.wpa_characteristic.start_deferred):
+            if callback not in advertisement.registered_callbacks:
+                self.advertising.add_registered_callback(callback)
+        self.advertising.start()
+
+    def stop_advertising(self):
+        """
+        Stop advertising and background scanning until the next trigger.
+        """
+        if self.window_timer is not None:
+            self.window_timer.cancel()
+            self.window_timer = None
+        advertisement = self.advertising.phases[0].advertisement
+        if advertisement.configure_adapter in advertisement.registered_callbacks:
+            # Stopped before the first registration, the adapter was never opened up
+            advertisement.registered_callbacks.remove(advertisement.configure_adapter)
+        else:
+            advertisement.configure_adapter(False)
+        self.advertising.stop()
+        self.wpa_service.wpa_characteristic.scan_cache.stop()
+
+    def toggle_advertising(self):
+        if self.advertising.running:
+            self.stop_advertising()
+        else:
+            self.start_advertising()
+
+    def restart_window(self):
+        if self.window_timer is not None:
+            self.window_timer.cancel()
+        self.window_timer = scheduler.schedule(self.advertising_window, self.on_window_expired)
+
+    def on_window_expired(self):
+        self.window_timer = None
+        if self.wpa_service.wpa_characteristic.sessions:
+            # A client is still provisioning, keep advertising for reconnects
+            self.restart_window()
+            return
+        logger.info("Advertising window expired")
+        self.stop_advertising()
+
+    def handle_command(self, command):
+        """
+        Run a text command from the control socket and return the reply.
+        """
+        if command == 'start':
+            self.start_advertising()
+        elif command == 'stop':
+            self.stop_advertising()
+        elif command == 'toggle':
+            self.toggle_advertising()
+        elif command != 'status':
+            return f"error: unknown command {command!r}"
+        return "advertising" if self.is_advertising() else "stopped"
+
+    def watch_button(self, pin=BUTTON_GPIO):
+        """
+        Start advertising on a button press. gpiozero is optional, the
+        other triggers keep working without it.
+        """
         try:
-            output = subprocess.check_output(
-                ['nmcli', '-t', '-f', 'SSID', 'device', 'wifi'],
-                text=True
-            )
-            ssids = list({line.strip() for line in output.splitlines() if line.strip()})
-            logger.info(f"Available Wi-Fi networks: {ssids}")
-            return ssids
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error scanning Wi-Fi networks: {e}")
-            return []
-
-
-class WPACharacteristic(Characteristic):
-    WPA_CHAR_UUID = '00001801-0000-1000-6000-00805f9b34fb'
-    WPA_CHAR_FLAGS = ['read', 'write', 'notify', 'secure-read', 'secure-write']
-
-    def __init__(self, bus, index, service):
-        super().__init__(bus, index, self.WPA_CHAR_UUID, self.WPA_CHAR_FLAGS, service)
-        self.wifi_manager = WiFiManager()
-        self.notifying = False
-        self.add_descriptor(CUDDiscriptor(bus, 1, self))
-        self.ip = self.get_local_ip()
-        msg = json.dumps({"status": "idle", "ip": self.ip})
-        self.value = [dbus.Byte(x) for x in msg.encode('utf-8')]
-        self.last_activity = time.time()
-        GLib.timeout_add_seconds(60, self.idle_timeout_check)
-
-    def get_local_ip(self):
+            from gpiozero import Button, GPIOZeroError
+        except ImportError:
+            logger.warning("gpiozero not installed, button trigger disabled")
+            return
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            return s.getsockname()[0]
-        except Exception:
-            return "0.0.0.0"
-        finally:
-            s.close()
+            self.button = Button(pin, bounce_time=0.05)
+        except GPIOZeroError as e:
+            logger.warning(f"Button on GPIO{pin} unavailable: {e}")
+            return
+        # gpiozero calls back from its own thread, hand the press to the main loop
+        self.button.when_pressed = lambda: GLib.idle_add(self.on_button_pressed)
+        logger.info(f"Watching button on GPIO{pin}")
+
+    def on_button_pressed(self):
+        logger.info("Button pressed")
+        self.start_advertising()
+        return False
 
-    def ReadValue(self, options):
-        self.last_activity = time.time()
-        wifi_list = self.wifi_manager.scan_wifi_networks()
-        return array.array('B', '\n'.join(wifi_list).encode('utf-8'))
 
-    def WriteValue(self, value, options):
-        self.last_activity = time.time()
+class ControlSocket:
+    """
+    Unix socket accepting one text command per connection: start, stop,
+    toggle or status. The reply is the resulting advertising state.
+    """
+    MAX_COMMAND_LENGTH = 64
+
+    def __init__(self, daemon, path=CONTROL_SOCKET):
+        self.daemon = daemon
+        self.path = path
+        self.sock = None
+        self.watch_id = None
+
+    def open(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o660)
+        self.sock.listen(4)
+        self.sock.setblocking(False)
+        self.watch_id = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self.on_accept)
+        logger.info(f"Control socket listening on {self.path}")
+
+    def close(self):
+        if self.watch_id is not None:
+            GLib.source_remove(self.watch_id)
+            self.watch_id = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def on_accept(self, fd, condition):
         try:
-            config = json.loads(bytearray(value).decode('utf-8'))
-            self.wifi_manager.set_credentials(config['ssid'], config['psk'])
-            result = self.wifi_manager.connect()
-            self.ip = self.get_local_ip()
-            status = "connected" if result["success"] else "failed"
-
-            self.value = [dbus.Byte(x) for x in json.dumps({
-                "status": status,
-                "reason": result["message"],
-                "ip": self.ip
-            }).encode('utf-8')]
-
-            if self.notifying:
-                self.PropertiesChanged(GATT_CHARACTERISTIC_IFACE, {'Value': dbus.Array(self.value, signature='y')}, [])
-
-            if result["success"]:
-                GLib.timeout_add_seconds(10, self.disconnect_client)
-            else:
-                GLib.timeout_add_seconds(10, self.service.application.restart_advertising)
-
-        except Exception as e:
-            logger.error(f"Error in WriteValue: {e}")
-
-    def StartNotify(self):
-        self.notifying = True
-        self.notify()
-
-    def StopNotify(self):
-        self.notifying = False
-
-    def notify(self):
-        if self.notifying:
-            self.PropertiesChanged(GATT_CHARACTERISTIC_IFACE, {'Value': dbus.Array(self.value, signature='y')}, [])
-            GLib.timeout_add_seconds(2, self.notify)
-
-    def idle_timeout_check(self):
-        if time.time() - self.last_activity > 300:
-            logger.info("Idle timeout reached. Disconnecting BLE client.")
-            return self.disconnect_client()
+            conn, _ = self.sock.accept()
+        except OSError as e:
+            logger.error(f"Control socket accept failed: {e}")
+            return True
+        conn.setblocking(False)
+        GLib.io_add_watch(conn.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                          self.on_command, conn)
         return True
 
-    def disconnect_client(self):
+    def on_command(self, fd, condition, conn):
         try:
-            adapter = dbus.Interface(self.bus.get_object("org.bluez", "/org/bluez/hci0"), "org.bluez.Adapter1")
-            for device_path in self.get_connected_devices():
-                adapter.RemoveDevice(device_path)
-                logger.info(f"Disconnected BLE client: {device_path}")
-        except Exception as e:
-            logger.error(f"Failed to disconnect client: {e}")
+            data = conn.recv(self.MAX_COMMAND_LENGTH)
+            command = data.decode('utf-8', 'replace').strip().lower()
+            if command:
+                logger.info(f"Control command: {command}")
+                conn.sendall((self.daemon.handle_command(command) + "\n").encode('utf-8'))
+        except OSError as e:
+            logger.error(f"Control socket error: {e}")
+        finally:
+            conn.close()
         return False
 
-    def get_connected_devices(self):
-        obj_manager = dbus.Interface(self.bus.get_object("org.bluez", "/"), "org.freedesktop.DBus.ObjectManager")
-        managed = obj_manager.GetManagedObjects()
-        return [path for path, interfaces in managed.items() if 'org.bluez.Device1' in interfaces and interfaces['org.bluez.Device1'].get('Connected')]
 
+class DaemonControl(dbus.service.Object):
+    """
+    D-Bus control interface for the daemon, needs the policy in
+    ble_wifi_config.conf to own its name on the system bus.
+    """
+    def __init__(self, bus, daemon):
+        self.daemon = daemon
+        self.bus_name = dbus.service.BusName(DAEMON_BUS_NAME, bus, do_not_queue=True)
+        dbus.service.Object.__init__(self, bus, DAEMON_PATH)
 
-class WPAService(Service):
-    WPA_SERVICE_UUID = '00001801-0000-1000-9000-00805f9b34fb'
-    def __init__(self, bus, index):
-        super().__init__(bus, index, self.WPA_SERVICE_UUID, True)
-        self.wpa_characteristic = WPACharacteristic(bus, 1, self)
-        self.add_characteristic(self.wpa_characteristic)
+    @dbus.service.method(DAEMON_IFACE)
+    def StartAdvertising(self):
+        self.daemon.start_advertising()
 
+    @dbus.service.method(DAEMON_IFACE)
+    def StopAdvertising(self):
+        self.daemon.stop_advertising()
 
-class WPAAdvertisement(Advertisement):
-    def __init__(self, bus, index, mainloop):
-        super().__init__(bus, index, 'peripheral', mainloop)
-        self.add_service_uuid(WPAService.WPA_SERVICE_UUID)
-        self.add_local_name(socket.gethostname())
-        self.include_tx_power = True
-        self.set_adapter_property('Discoverable', dbus.Boolean(1))
-        self.set_adapter_property('DiscoverableTimeout', dbus.UInt32(0))
-        self.set_adapter_property('Pairable', dbus.Boolean(1))
-        self.set_adapter_property('PairableTimeout', dbus.UInt32(0))
+    @dbus.service.method(DAEMON_IFACE, out_signature='b')
+    def IsAdvertising(self):
+        return self.daemon.is_advertising()
 
 
 def main():
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     bus = dbus.SystemBus()
-    agent = Agent(bus)
-    agent.set_exit_on_release(False)
-    agent_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/org/bluez"), "org.bluez.AgentManager1")
-    agent_manager.RegisterAgent(AGENT_PATH, "KeyboardDisplay")
-    agent_manager.RequestDefaultAgent(AGENT_PATH)
-    logger.info("Agent registered for secure pairing")
 
-    advertisement = WPAAdvertisement(bus, 0, mainloop)
-    application = Application(bus, mainloop)
-    wpa_service = WPAService(bus, 0)
-    wpa_service.wpa_characteristic.service = wpa_service  # Inject for callbacks
-    wpa_service.application = application                 # For restart access
-    application.add_service(wpa_service)
+    daemon = AdvertisingDaemon(bus)
+    daemon.start()
+    daemon.watch_button()
 
-    application.register_application()
-    advertisement.start_advertisement()
+    control_socket = ControlSocket(daemon)
+    try:
+        control_socket.open()
+    except OSError as e:
+        logger.warning(f"Control socket unavailable: {e}")
+
+    try:
+        # Kept on the daemon so the exported object and its bus name stay alive
+        daemon.control = DaemonControl(bus, daemon)
+        logger.info(f"D-Bus control available as {DAEMON_BUS_NAME}")
+    except dbus.exceptions.DBusException as e:
+        logger.warning(f"D-Bus control unavailable: {e}")
+
+    def on_signal():
+        logger.info("Stopping daemon")
+        mainloop.quit()
+        return False
+
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, on_signal)
+    try:
+        mainloop.run()
+    finally:
+        # BlueZ drops our advertisement and application when we leave the bus
+        control_socket.close()
 
-    mainloop.run()
 
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        logger.info("Exiting application")
-        mainloop.quit()
+        logger.info("Exiting daemon")
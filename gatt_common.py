@@ -0,0 +1,74 @@
+import re
+
+
+# Interface UUIDs
+BLUEZ_SERVICE_NAME = 'org.bluez'
+BLUEZ_SERVICE_PATH = '/org/bluez'
+
+GATT_SERVICE_IFACE = 'org.bluez.GattService1'
+GATT_CHARACTERISTIC_IFACE = 'org.bluez.GattCharacteristic1'
+GATT_DESCRIPTOR_IFACE = 'org.bluez.GattDescriptor1'
+GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
+
+GATT_ADAPTER_IFACE = 'org.bluez.Adapter1'
+GATT_DEVICE_IFACE = 'org.bluez.Device1'
+
+GATT_AGENT_IFACE = 'org.bluez.Agent1'
+AGENT_PATH = '/org/bluez/ble/agent'
+
+DBUS_PROPERTIES_IFACE = 'org.freedesktop.DBus.Properties'
+DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+
+GATT_LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+GATT_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
+
+UUID_PATTERN = re.compile(r'^([0-9a-fA-F]{4}|[0-9a-fA-F]{8}|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})$')
+
+CHARACTERISTIC_FLAGS = {
+    'broadcast', 'read', 'write-without-response', 'write', 'notify', 'indicate',
+    'authenticated-signed-writes', 'extended-properties', 'reliable-write', 'writable-auxiliaries',
+    'encrypt-read', 'encrypt-write', 'encrypt-notify', 'encrypt-indicate',
+    'encrypt-authenticated-read', 'encrypt-authenticated-write', 'encrypt-authenticated-notify',
+    'encrypt-authenticated-indicate', 'secure-read', 'secure-write', 'secure-notify', 'secure-indicate',
+    'authorize',
+}
+
+DESCRIPTOR_FLAGS = {
+    'read', 'write', 'encrypt-read', 'encrypt-write', 'encrypt-authenticated-read',
+    'encrypt-authenticated-write', 'secure-read', 'secure-write', 'authorize',
+}
+
+
+def index_gatt_tree(services):
+    """
+    Validate a GATT tree and index it by object path and service UUID.
+    Shared by the GLib and asyncio front ends, raises ValueError describing
+    the first problem found.
+    """
+    objects_by_path = {}
+    services_by_uuid = {}
+
+    def add(obj, flags=None, allowed_flags=None):
+        if obj.path in objects_by_path:
+            raise ValueError(f"Duplicate object path {obj.path}")
+        if not UUID_PATTERN.match(str(obj.uuid)):
+            raise ValueError(f"Invalid UUID {obj.uuid} at {obj.path}")
+        if flags is not None and not set(flags) <= allowed_flags:
+            raise ValueError(f"Invalid flags {sorted(set(flags) - allowed_flags)} at {obj.path}")
+        objects_by_path[obj.path] = obj
+
+    for service in services:
+        if service.uuid in services_by_uuid:
+            raise ValueError(f"Duplicate service UUID {service.uuid}")
+        if not service.characteristics:
+            raise ValueError(f"Service {service.path} has no characteristics")
+        add(service)
+        services_by_uuid[service.uuid] = service
+        for characteristic in service.characteristics:
+            if not characteristic.descriptors:
+                raise ValueError(f"Characteristic {characteristic.path} has no descriptors")
+            add(characteristic, characteristic.flags, CHARACTERISTIC_FLAGS)
+            for descriptor in characteristic.descriptors:
+                add(descriptor, descriptor.flags, DESCRIPTOR_FLAGS)
+
+    return objects_by_path, services_by_uuid
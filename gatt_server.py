@@ -1,16 +1,26 @@
 import array
+import heapq
+import itertools
 import json
-import subprocess
 import dbus
 import dbus.mainloop.glib
 import dbus.service
 import dbus.exceptions
 import logging  
 import os
-import sys
 import time
+from collections import namedtuple
 from gi.repository import GLib
-from gi.repository import GObject  
+from advertising_payload import LEGACY_ADV_LENGTH, plan_payload
+from gatt_common import (
+    BLUEZ_SERVICE_NAME, BLUEZ_SERVICE_PATH,
+    GATT_SERVICE_IFACE, GATT_CHARACTERISTIC_IFACE, GATT_DESCRIPTOR_IFACE, GATT_MANAGER_IFACE,
+    GATT_ADAPTER_IFACE, GATT_DEVICE_IFACE,
+    GATT_AGENT_IFACE, AGENT_PATH,
+    DBUS_PROPERTIES_IFACE, DBUS_OM_IFACE,
+    GATT_LE_ADVERTISING_MANAGER_IFACE, GATT_ADVERTISEMENT_IFACE,
+    index_gatt_tree,
+)
 
 
 
@@ -22,7 +32,8 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 loghandler = logging.StreamHandler()
 loghandler.setFormatter(formatter)
 
-loghandlerfile = logging.FileHandler('gatt_module.log')
+# delay=True leaves opening the log file to the first record instead of import time
+loghandlerfile = logging.FileHandler('gatt_module.log', delay=True)
 loghandlerfile.setFormatter(formatter)
 
 logger.addHandler(loghandler)
@@ -33,27 +44,20 @@ mainloop = None
 bus = None
 
 
-# Interface UUIDs
-BLUEZ_SERVICE_NAME = 'org.bluez'
-BLUEZ_SERVICE_PATH = '/org/bluez'
-
-GATT_SERVICE_IFACE = 'org.bluez.GattService1'
-GATT_CHARACTERISTIC_IFACE = 'org.bluez.GattCharacteristic1'
-GATT_DESCRIPTOR_IFACE = 'org.bluez.GattDescriptor1'
-GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
-
-GATT_ADAPTER_IFACE = 'org.bluez.Adapter1'
-GATT_DEVICE_IFACE = 'org.bluez.Device1'
-
-GATT_AGENT_IFACE = 'org.bluez.Agent1'
-AGENT_PATH = '/org/bluez/ble/agent'
-
-DBUS_PROPERTIES_IFACE = 'org.freedesktop.DBus.Properties'
-DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
-
-GATT_LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
-GATT_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
-
+def process_uptime():
+    """
+    Seconds since this process was started by the kernel, so startup
+    metrics include interpreter start and imports. None if /proc is missing.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # starttime is field 22, counted after the parenthesised command name
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
 
 
 class InvalidArgsException(dbus.exceptions.DBusException):
@@ -104,6 +108,134 @@ class InvalidValueLengthException(dbus.exceptions.DBusException):
     """
     _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidValueLength'
 
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    """
+    Exception raised for a read offset past the end of the value.
+    """
+    _dbus_error_name = 'org.bluez.Error.InvalidOffset'
+
+
+class CancelledException(dbus.exceptions.DBusException):
+    """
+    Exception set on a DBusFuture that was cancelled.
+    """
+    _dbus_error_name = 'org.freedesktop.DBus.Error.Failed'
+
+
+DEFAULT_CALL_TIMEOUT = 5
+
+# BlueZ advertising interval bounds in milliseconds (0x20 to 0xFFFFFF units of 0.625 ms)
+MIN_ADVERTISING_INTERVAL = 20
+MAX_ADVERTISING_INTERVAL = 10485759
+
+
+class DBusFuture:
+    """
+    Result of an asynchronous D-Bus call. Callbacks added with
+    add_done_callback run on the main loop once the reply, an error or a
+    cancellation arrives.
+    """
+    def __init__(self, description=""):
+        self.description = description
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def cancelled(self):
+        return isinstance(self.error, CancelledException)
+
+    def result(self):
+        """
+        Get the reply value, raising the call's error if it failed.
+        """
+        if not self.finished:
+            raise FailedException(f"{self.description} has not completed")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self):
+        return self.error
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(future) when the future completes, immediately if it
+        already has.
+        """
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def set_result(self, *args):
+        if len(args) == 0:
+            self._finish(None, None)
+        elif len(args) == 1:
+            self._finish(args[0], None)
+        else:
+            self._finish(args, None)
+
+    def set_exception(self, error):
+        self._finish(None, error)
+
+    def cancel(self):
+        """
+        Cancel the call. dbus-python cannot abort a pending call, so a late
+        reply is simply ignored.
+        """
+        self._finish(None, CancelledException(f"{self.description} cancelled"))
+
+    def _finish(self, value, error):
+        if self.finished:
+            return
+        self.finished = True
+        self.value = value
+        self.error = error
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"Callback for {self.description} failed: {e}")
+
+
+def call_async(method, *args, timeout=DEFAULT_CALL_TIMEOUT):
+    """
+    Call a dbus-python proxy method without blocking and return a DBusFuture.
+    `timeout` is in seconds; an expired call completes with a NoReply error.
+    """
+    future = DBusFuture(getattr(method, '_method_name', str(method)))
+    method(*args, reply_handler=future.set_result, error_handler=future.set_exception, timeout=timeout)
+    return future
+
+
+def gather(*futures):
+    """
+    Combine futures into one that completes with the list of their results,
+    or with the first error once all of them are done.
+    """
+    combined = DBusFuture("gather")
+    remaining = [len(futures)]
+
+    def on_done(_):
+        remaining[0] -= 1
+        if remaining[0] > 0:
+            return
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            combined.set_exception(errors[0])
+        else:
+            combined.set_result([f.value for f in futures])
+
+    if not futures:
+        combined.set_result([])
+    for future in futures:
+        future.add_done_callback(on_done)
+    return combined
 
 
 class Application (dbus.service.Object):
@@ -114,6 +246,10 @@ class Application (dbus.service.Object):
         self.path ="/"
         self.mainloop = mainloop
         self.services = []
+        self.managed_objects = None
+        self.objects_by_path = None
+        self.services_by_uuid = None
+        self.advertising = None
         self.bus = bus
         self.adapter = self.find_adapter()
         self.adapter_obj = self.bus.get_object(BLUEZ_SERVICE_NAME, self.adapter)
@@ -123,14 +259,7 @@ class Application (dbus.service.Object):
         """
         Find the adapter for the application.
         """
-        remote_om = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, "/"), DBUS_OM_IFACE)
-        objects = remote_om.GetManagedObjects()
-        adapter = None
-        for path, ifaces in objects.items():
-            if GATT_ADAPTER_IFACE in ifaces:
-                adapter = path
-                break
-        return adapter
+        return get_object_cache(self.bus).find_adapter()
 
     def get_path(self):
         """
@@ -144,13 +273,79 @@ class Application (dbus.service.Object):
         Add a GATT service to the application.
         """
         self.services.append(service)
+        service.application = self
+        self.invalidate_managed_objects()
+
+    def set_advertising(self, controller):
+        """
+        Set the AdvertisingController used by restart_advertising.
+        """
+        self.advertising = controller
+
+    def restart_advertising(self):
+        """
+        Restart advertising from its first phase, e.g. after a failed
+        provisioning attempt. Returns False so it can be used as a one-shot timer.
+        """
+        if self.advertising is None:
+            logger.warning("No advertising controller to restart")
+            return False
+        self.advertising.restart()
+        return False
+
+    def invalidate_managed_objects(self):
+        """
+        Drop the cached object tree and indexes so the next lookup rebuilds them.
+        """
+        self.managed_objects = None
+        self.objects_by_path = None
+        self.services_by_uuid = None
+
+    def build_index(self):
+        """
+        Validate the whole GATT tree and index it by path and service UUID.
+        Raises InvalidArgsException describing the first problem found.
+        """
+        try:
+            objects_by_path, services_by_uuid = index_gatt_tree(self.services)
+        except ValueError as e:
+            raise InvalidArgsException(str(e))
+
+        self.objects_by_path = objects_by_path
+        self.services_by_uuid = services_by_uuid
+        logger.info(f"GATT tree validated: {len(services_by_uuid)} services, {len(objects_by_path)} objects")
+
+    def get_object(self, path):
+        """
+        Get a service, characteristic or descriptor by object path.
+        """
+        if self.objects_by_path is None:
+            self.build_index()
+        try:
+            return self.objects_by_path[str(path)]
+        except KeyError:
+            raise NotFoundException(f"No GATT object at {path}")
+
+    def get_service(self, uuid):
+        """
+        Get a GATT service by UUID.
+        """
+        if self.services_by_uuid is None:
+            self.build_index()
+        try:
+            return self.services_by_uuid[uuid]
+        except KeyError:
+            raise NotFoundException("Service not found")
 
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature = 'a{oa{sa{sv}}}')
     def GetManagedObjects(self):
         """
-        Get all managed objects.
+        Get all managed objects. The tree is built once and reused until a
+        service, characteristic or descriptor is added.
         """
+        if self.managed_objects is not None:
+            return self.managed_objects
         objects = {}
         for service in self.services:
             objects[service.get_path()] = service.get_properties()
@@ -158,7 +353,9 @@ class Application (dbus.service.Object):
                 objects[characteristic.get_path()] = characteristic.get_properties()
                 for descriptor in characteristic.descriptors:
                     objects[descriptor.get_path()] = descriptor.get_properties()
-        logger.debug(f"Managed objects tree: {json.dumps(str(objects), indent=2)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Managed objects tree: {json.dumps(str(objects), indent=2)}")
+        self.managed_objects = objects
         return objects
     
     def register_application(self):
@@ -166,6 +363,7 @@ class Application (dbus.service.Object):
         Register the application with the GATT manager.
         """
         logger.info("Registering application")
+        self.build_index()
         gatt_manager = dbus.Interface(self.adapter_obj, GATT_MANAGER_IFACE)
         gatt_manager.RegisterApplication(self.path, {}, reply_handler=self.register_success, error_handler=self.register_error)
         logger.info("Application registered")
@@ -211,16 +409,25 @@ class Application (dbus.service.Object):
 class Service (dbus.service.Object):
     """
     GATT Service class that represents a GATT service.
+
+    Subclasses declare their characteristics in CHARACTERISTICS, a list of
+    Characteristic classes built in order as cls(bus, index, service) with
+    indexes starting at 1. A list can also be passed to the constructor.
     """
 
     PATH_BASE = '/org/bluez/ble/service/'
+    CHARACTERISTICS = []
 
-    def __init__(self, bus, index, uuid, primary=True):
+    def __init__(self, bus, index, uuid, primary=True, characteristics=None):
         self.path = self.PATH_BASE + str(index)
         self.bus = bus
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.characteristics_by_uuid = {}
+        self.application = None
+        for char_index, characteristic_class in enumerate(characteristics or self.CHARACTERISTICS, start=1):
+            self.add_characteristic(characteristic_class(bus, char_index, self))
         dbus.service.Object.__init__(self, bus, self.path)
 
 
@@ -234,7 +441,18 @@ class Service (dbus.service.Object):
         """
         Add a GATT characteristic to the service.
         """
+        if characteristic.uuid in self.characteristics_by_uuid:
+            raise InvalidArgsException(f"Duplicate characteristic UUID {characteristic.uuid}")
         self.characteristics.append(characteristic)
+        self.characteristics_by_uuid[characteristic.uuid] = characteristic
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Invalidate the application's cached object tree after a change.
+        """
+        if self.application is not None:
+            self.application.invalidate_managed_objects()
 
     def get_characteristics(self):
         """
@@ -246,10 +464,10 @@ class Service (dbus.service.Object):
         """
         Get a GATT characteristic by UUID.
         """
-        for characteristic in self.characteristics:
-            if characteristic.uuid == uuid:
-                return characteristic
-        raise NotFoundException("Characteristic not found")
+        try:
+            return self.characteristics_by_uuid[uuid]
+        except KeyError:
+            raise NotFoundException("Characteristic not found")
 
     def get_characteristics_path(self):
         """
@@ -287,7 +505,12 @@ class Service (dbus.service.Object):
 class Characteristic (dbus.service.Object):
     """
     GATT Characteristic class that represents a GATT characteristic.
+
+    Subclasses declare their descriptors in DESCRIPTORS, a list of
+    Descriptor classes built in order as cls(bus, index, characteristic).
     """
+    DESCRIPTORS = []
+
     def __init__(self, bus, index, uuid, flags, service):
         self.path = service.path +"/char" +str(index)
         self.bus = bus
@@ -295,6 +518,9 @@ class Characteristic (dbus.service.Object):
         self.flags = flags
         self.service = service
         self.descriptors = []
+        self.descriptors_by_uuid = {}
+        for descriptor_index, descriptor_class in enumerate(self.DESCRIPTORS, start=1):
+            self.add_descriptor(descriptor_class(bus, descriptor_index, self))
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_path(self):
@@ -308,16 +534,20 @@ class Characteristic (dbus.service.Object):
         """
         Add a GATT descriptor to the characteristic.
         """
+        if descriptor.uuid in self.descriptors_by_uuid:
+            raise InvalidArgsException(f"Duplicate descriptor UUID {descriptor.uuid}")
         self.descriptors.append(descriptor)
+        self.descriptors_by_uuid[descriptor.uuid] = descriptor
+        self.service.invalidate()
 
     def get_descriptor(self,uuid):
         """
         Get a GATT descriptor by UUID.
         """
-        for descriptor in self.descriptors:
-            if descriptor.uuid == uuid:
-                return descriptor
-        raise NotFoundException("Descriptor not found")
+        try:
+            return self.descriptors_by_uuid[uuid]
+        except KeyError:
+            raise NotFoundException("Descriptor not found")
 
     def get_descriptors(self):
         """
@@ -412,6 +642,284 @@ class Characteristic (dbus.service.Object):
         self.value = value
         self.PropertiesChanged(GATT_CHARACTERISTIC_IFACE, {'Value': dbus.Array(value, signature='y')}, [])
 
+
+class ScheduledCall:
+    """
+    Handle for a call queued on a DeadlineScheduler.
+    """
+    def __init__(self, scheduler, deadline, callback, args):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Cancel the call if it has not run yet.
+        """
+        if self.cancelled:
+            return
+        self.cancelled = True
+        self.scheduler._on_cancelled()
+
+
+class DeadlineScheduler:
+    """
+    One-shot deadlines for the whole process kept in a heap and driven by a
+    single GLib timer armed for the earliest one, instead of one GLib source
+    per idle, notify or re-advertise timeout.
+
+    Cancelled calls stay in the heap until they reach the top. Timers that
+    are restarted on every write, like the idle timeout, would pile them up,
+    so the heap is rebuilt from the live calls once more than half of it is
+    cancelled.
+    """
+    def __init__(self):
+        self.heap = []
+        self.cancelled = 0
+        self.counter = itertools.count()
+        self.timer_id = None
+        self.timer_deadline = None
+
+    def schedule(self, delay, callback, *args):
+        """
+        Run callback(*args) once, `delay` seconds from now. Returns a
+        ScheduledCall that can be cancelled.
+        """
+        call = ScheduledCall(self, time.monotonic() + delay, callback, args)
+        heapq.heappush(self.heap, (call.deadline, next(self.counter), call))
+        self._arm()
+        return call
+
+    def _on_cancelled(self):
+        self.cancelled += 1
+        if self.cancelled * 2 > len(self.heap):
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def _arm(self):
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+        if not self.heap:
+            return
+        deadline = self.heap[0][0]
+        if self.timer_id is not None and self.timer_deadline <= deadline:
+            return
+        if self.timer_id is not None:
+            GLib.source_remove(self.timer_id)
+        self.timer_deadline = deadline
+        delay_ms = max(0, int((deadline - time.monotonic()) * 1000))
+        self.timer_id = GLib.timeout_add(delay_ms, self._on_timer)
+
+    def _on_timer(self):
+        self.timer_id = None
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, call = heapq.heappop(self.heap)
+            if call.cancelled:
+                self.cancelled -= 1
+                continue
+            # Marked directly, cancel() after the call ran must not count it
+            call.cancelled = True
+            try:
+                call.callback(*call.args)
+            except Exception as e:
+                logger.error(f"Scheduled call {call.callback} failed: {e}")
+        self._arm()
+        return False
+
+
+scheduler = DeadlineScheduler()
+
+
+class BluezObjectCache:
+    """
+    Local copy of the org.bluez object tree. It is loaded with a single
+    GetManagedObjects and then kept current from InterfacesAdded,
+    InterfacesRemoved and PropertiesChanged, so adapters, devices and their
+    properties can be looked up without a D-Bus round-trip. Use
+    get_object_cache(bus) to share one instance per bus.
+    """
+    def __init__(self, bus):
+        self.bus = bus
+        self.objects = {}
+        self.connected = set()
+        self.listeners = []
+        bus.add_signal_receiver(self.on_interfaces_added, dbus_interface=DBUS_OM_IFACE,
+                                signal_name='InterfacesAdded', bus_name=BLUEZ_SERVICE_NAME)
+        bus.add_signal_receiver(self.on_interfaces_removed, dbus_interface=DBUS_OM_IFACE,
+                                signal_name='InterfacesRemoved', bus_name=BLUEZ_SERVICE_NAME)
+        bus.add_signal_receiver(self.on_properties_changed, dbus_interface=DBUS_PROPERTIES_IFACE,
+                                signal_name='PropertiesChanged', bus_name=BLUEZ_SERVICE_NAME,
+                                path_keyword='path')
+        remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/"), DBUS_OM_IFACE)
+        for path, ifaces in remote_om.GetManagedObjects().items():
+            self.on_interfaces_added(path, ifaces)
+        logger.info(f"BlueZ object cache loaded: {len(self.objects)} objects")
+
+    def add_listener(self, callback):
+        """
+        Call callback(path, connected) whenever a device connects or disconnects.
+        """
+        self.listeners.append(callback)
+
+    def get_properties(self, path, interface):
+        """
+        Get the cached properties of an interface, or None if not present.
+        """
+        return self.objects.get(str(path), {}).get(interface)
+
+    def get_paths(self, interface):
+        """
+        Get the sorted paths of all objects implementing an interface.
+        """
+        return sorted(path for path, ifaces in self.objects.items() if interface in ifaces)
+
+    def find_adapter(self):
+        """
+        Get the first adapter path, or None if there is none.
+        """
+        adapters = self.get_paths(GATT_ADAPTER_IFACE)
+        return adapters[0] if adapters else None
+
+    def get_connected_devices(self):
+        return list(self.connected)
+
+    def on_interfaces_added(self, path, ifaces):
+        path = str(path)
+        entry = self.objects.setdefault(path, {})
+        for interface, props in ifaces.items():
+            entry[str(interface)] = dict(props)
+        if GATT_DEVICE_IFACE in ifaces:
+            self._set_connected(path, bool(ifaces[GATT_DEVICE_IFACE].get('Connected', False)))
+
+    def on_interfaces_removed(self, path, interfaces):
+        path = str(path)
+        entry = self.objects.get(path, {})
+        for interface in interfaces:
+            entry.pop(str(interface), None)
+        if not entry:
+            self.objects.pop(path, None)
+        if GATT_DEVICE_IFACE in interfaces:
+            self._set_connected(path, False)
+
+    def on_properties_changed(self, interface, changed, invalidated, path=None):
+        path = str(path)
+        props = self.objects.get(path, {}).get(str(interface))
+        if props is None:
+            return
+        props.update(changed)
+        for name in invalidated:
+            props.pop(str(name), None)
+        if interface == GATT_DEVICE_IFACE and 'Connected' in changed:
+            self._set_connected(path, bool(changed['Connected']))
+
+    def _set_connected(self, path, connected):
+        if connected == (path in self.connected):
+            return
+        if connected:
+            self.connected.add(path)
+        else:
+            self.connected.discard(path)
+        for callback in self.listeners:
+            callback(path, connected)
+
+
+object_caches = {}
+
+
+def get_object_cache(bus):
+    """
+    Get the BluezObjectCache shared by everything on this bus.
+    """
+    cache = object_caches.get(id(bus))
+    if cache is None:
+        cache = BluezObjectCache(bus)
+        object_caches[id(bus)] = cache
+    return cache
+
+
+class NotifyScheduler:
+    """
+    Notification scheduler for a characteristic. The value is sent only when
+    it changes, bursts of changes within `coalesce_ms` are sent once, and an
+    optional keepalive re-sends the value every `keepalive_seconds`. At most
+    one deadline per characteristic is queued on the shared scheduler.
+
+    `characteristic` can be any object with a `value`; `send` replaces the
+    default PropertiesChanged emission, e.g. to write to an acquired fd.
+    """
+    def __init__(self, characteristic, coalesce_ms=50, keepalive_seconds=0, send=None):
+        self.characteristic = characteristic
+        self.send = send or self._emit_properties_changed
+        self.coalesce_ms = coalesce_ms
+        self.keepalive_seconds = keepalive_seconds
+        self.notifying = False
+        self.last_sent = None
+        self.timer = None
+        self.timer_is_keepalive = False
+
+    def start(self):
+        """
+        Start notifying. The current value is sent once so a new subscriber
+        sees the state it missed.
+        """
+        self.notifying = True
+        self.last_sent = None
+        self.value_changed()
+
+    def stop(self):
+        """
+        Stop notifying and drop any pending timer.
+        """
+        self.notifying = False
+        self._cancel_timer()
+
+    def value_changed(self):
+        """
+        Schedule a notification for the characteristic's current value.
+        """
+        if not self.notifying:
+            return
+        if self.timer is not None and not self.timer_is_keepalive:
+            # Already coalescing, the pending send will pick up the new value
+            return
+        self._cancel_timer()
+        self.timer_is_keepalive = False
+        self.timer = scheduler.schedule(self.coalesce_ms / 1000.0, self._on_timer)
+
+    def flush(self):
+        """
+        Send the current value right away instead of coalescing it, for
+        changes such as state transitions that must each reach the client.
+        """
+        if not self.notifying:
+            return
+        self._cancel_timer()
+        self.timer_is_keepalive = False
+        self._on_timer()
+
+    def _on_timer(self):
+        self.timer = None
+        value = list(self.characteristic.value)
+        if value != self.last_sent or self.timer_is_keepalive:
+            self.last_sent = value
+            self.send(value)
+        if self.notifying and self.keepalive_seconds:
+            self.timer_is_keepalive = True
+            self.timer = scheduler.schedule(self.keepalive_seconds, self._on_timer)
+
+    def _cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _emit_properties_changed(self, value):
+        self.characteristic.PropertiesChanged(GATT_CHARACTERISTIC_IFACE, {'Value': dbus.Array(value, signature='y')}, [])
+
     
 class Descriptor (dbus.service.Object):
     """
@@ -508,9 +1016,11 @@ class Agent(dbus.service.Object):
         """
         Set the trusted path.
         """
-        props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, path), GATT_DEVICE_IFACE)
-        props.set(GATT_DEVICE_IFACE, 'Trusted', dbus.Boolean(1))
-        logger.info(f"Device {path} set as trusted")
+        props = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, path), DBUS_PROPERTIES_IFACE)
+        future = call_async(props.Set, GATT_DEVICE_IFACE, 'Trusted', dbus.Boolean(1))
+        future.add_done_callback(lambda f: logger.info(f"Device {path} set as trusted") if f.exception() is None
+                                 else logger.error(f"Failed to trust device {path}: {f.exception()}"))
+        return future
     
     def question(self, prompt):
         return input(prompt)
@@ -678,6 +1188,15 @@ class Advertisement(dbus.service.Object):
         self.include_tx_power = False
         self.solicit_uuids = None
         self.data = None
+        self.min_interval = None
+        self.max_interval = None
+        self.timeout = None
+        self.payload_plan = None
+        self.active = False
+        self.listeners = []
+        self.start_requested = None
+        self.time_to_advertise = None
+        self.registered_callbacks = []
         self.adapter = self.find_adapter()
         if self.adapter is None:
             raise NotFoundException("Adapter not found")
@@ -747,12 +1266,11 @@ class Advertisement(dbus.service.Object):
 
     def add_local_name(self, name):
         """
-        Add a local name to the advertisement.
+        Add a local name to the advertisement. Names that do not fit are
+        shortened by plan_payload.
         """
         if not isinstance(name, str):
             raise InvalidArgsException("Name must be a string")
-        if len(name) > 29:
-            raise InvalidValueLengthException("Name length must be less than or equal to 29 characters")
         self.local_name = dbus.String(name)
         logger.info(f"Local name added: {name}")
 
@@ -772,35 +1290,100 @@ class Advertisement(dbus.service.Object):
         logger.info(f"Data added: {data}")
 
     
+    def set_interval(self, min_interval, max_interval):
+        """
+        Set the advertising interval range in milliseconds. BlueZ only
+        applies MinInterval/MaxInterval when bluetoothd runs with -E.
+        """
+        if not MIN_ADVERTISING_INTERVAL <= min_interval <= max_interval <= MAX_ADVERTISING_INTERVAL:
+            raise InvalidArgsException(f"Interval must satisfy {MIN_ADVERTISING_INTERVAL} <= min <= max <= {MAX_ADVERTISING_INTERVAL} ms")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def set_timeout(self, timeout):
+        """
+        Set how many seconds BlueZ keeps the advertisement before releasing it.
+        """
+        if not 1 <= timeout <= 0xFFFF:
+            raise InvalidArgsException("Timeout must be between 1 and 65535 seconds")
+        self.timeout = timeout
+
+    def plan_payload(self):
+        """
+        Lay out the fields over the advertising PDU and scan response,
+        using extended advertising when the adapter supports it. Raises
+        InvalidValueLengthException if the fields cannot fit.
+        """
+        manager = get_object_cache(self.bus).get_properties(self.adapter, GATT_LE_ADVERTISING_MANAGER_IFACE) or {}
+        capabilities = manager.get('SupportedCapabilities', {})
+        max_adv_length = LEGACY_ADV_LENGTH
+        if '1M' in manager.get('SupportedSecondaryChannels', []):
+            max_adv_length = int(capabilities.get('MaxAdvLen', LEGACY_ADV_LENGTH))
+        try:
+            plan = plan_payload(
+                service_uuids=self.service_uuids, solicit_uuids=self.solicit_uuids,
+                manufacturer_data=self.manufacturer_data, service_data=self.service_data,
+                local_name=self.local_name, include_tx_power=self.include_tx_power,
+                include_flags=self.advertisement_type == 'peripheral',
+                max_adv_length=max_adv_length,
+                max_scan_response_length=int(capabilities.get('MaxScnRspLen', LEGACY_ADV_LENGTH)))
+        except ValueError as e:
+            raise InvalidValueLengthException(str(e))
+        if plan.name_shortened:
+            logger.warning(f"Local name shortened to {plan.local_name!r} to fit the advertisement")
+        logger.info(f"Advertising payload: {'extended ' if plan.extended else ''}ADV {plan.adv_size} bytes {list(plan.adv)}, "
+                    f"scan response {plan.scan_response_size} bytes {list(plan.scan_response)}")
+        self.payload_plan = plan
+        return plan
+
     def get_properties(self):
         """
-        Get the properties of the advertisement.
+        Get the properties of the advertisement. Unset optional properties
+        are left out, D-Bus cannot carry None.
         """
-        return {
-            GATT_ADVERTISEMENT_IFACE: {
-                'Type': self.advertisement_type,
-                'ServiceUUIDs': dbus.Array(self.service_uuids, signature='s'),
-                'ManufacturerData': self.manufacturer_data,
-                'ServiceData': self.service_data,
-                'LocalName': self.local_name,
-                'IncludeTxPower': dbus.Boolean(self.include_tx_power),
-                'SolicitUUIDs': dbus.Array(self.solicit_uuids, signature='s'),
-                'Data': self.data
-            }
+        plan = self.payload_plan
+        scan_response = plan.scan_response if plan is not None else ()
+        properties = {
+            'Type': self.advertisement_type,
+            'IncludeTxPower': dbus.Boolean(self.include_tx_power),
         }
+        if self.service_uuids:
+            properties['ServiceUUIDs'] = dbus.Array(self.service_uuids, signature='s')
+        if self.solicit_uuids:
+            properties['SolicitUUIDs'] = dbus.Array(self.solicit_uuids, signature='s')
+        if self.manufacturer_data:
+            key = 'ScanResponseManufacturerData' if 'manufacturer_data' in scan_response else 'ManufacturerData'
+            properties[key] = self.manufacturer_data
+        if self.service_data:
+            key = 'ScanResponseServiceData' if 'service_data' in scan_response else 'ServiceData'
+            properties[key] = self.service_data
+        if self.local_name is not None:
+            properties['LocalName'] = dbus.String(plan.local_name) if plan is not None else self.local_name
+        if plan is not None and plan.extended:
+            properties['SecondaryChannel'] = dbus.String('1M')
+        if self.data is not None:
+            properties['Data'] = self.data
+        if self.min_interval is not None:
+            properties['MinInterval'] = dbus.UInt32(self.min_interval)
+            properties['MaxInterval'] = dbus.UInt32(self.max_interval)
+        if self.timeout is not None:
+            properties['Timeout'] = dbus.UInt16(self.timeout)
+        return {GATT_ADVERTISEMENT_IFACE: properties}
     
     def set_adapter_property(self, name, value):
         """
-        Set a property of the adapter.
+        Set a property of the adapter without blocking. Returns a DBusFuture.
         """
-        self.adapter_props.Set(GATT_ADAPTER_IFACE, name, value)
-        logger.info(f"Adapter property set: {name} - {value}")
+        future = call_async(self.adapter_props.Set, GATT_ADAPTER_IFACE, name, value)
+        future.add_done_callback(lambda f: logger.info(f"Adapter property set: {name} - {value}") if f.exception() is None
+                                 else logger.error(f"Failed to set adapter property {name}: {f.exception()}"))
+        return future
 
     def get_adapter_properties(self):
         """
-        Get the properties of the adapter.
+        Get the properties of the adapter without blocking. Returns a DBusFuture.
         """
-        return self.adapter_props.GetAll(GATT_ADAPTER_IFACE)
+        return call_async(self.adapter_props.GetAll, GATT_ADAPTER_IFACE)
 
     def get_advertisement_type(self):
         """
@@ -830,19 +1413,16 @@ class Advertisement(dbus.service.Object):
         Release the advertisement.
         """
         logger.info("Advertisement released")
-        pass
+        was_active = self.active
+        self.active = False
+        if was_active:
+            self.notify_listeners('released')
 
     def find_adapter(self):
         """
         Find the adapter for the advertisement.
         """
-        rempte_om = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, "/"), DBUS_OM_IFACE)
-        objects = rempte_om.GetManagedObjects()
-        adapter = None
-        for path, ifaces in objects.items():
-            if GATT_ADAPTER_IFACE in ifaces:
-                adapter = path
-                break
+        adapter = get_object_cache(self.bus).find_adapter()
         logger.info(f"Adapter found: {adapter}")
         return adapter
 
@@ -853,6 +1433,15 @@ class Advertisement(dbus.service.Object):
         Register the advertisement.
         """
         logger.info("Registering advertisement")
+        try:
+            self.plan_payload()
+        except InvalidValueLengthException as e:
+            # Retrying cannot help, the payload is the same every time
+            logger.error(f"Advertisement payload does not fit: {e}")
+            self.active = False
+            self.notify_listeners('invalid')
+            self.quit()
+            return
         adv_manager = dbus.Interface(self.adapter_obj, GATT_LE_ADVERTISING_MANAGER_IFACE)
         adv_manager.RegisterAdvertisement(self.path, {}, reply_handler=self.register_success, error_handler=self.register_error)
         logger.info("Advertisement registered")
@@ -862,14 +1451,19 @@ class Advertisement(dbus.service.Object):
         Unregister the advertisement.
         """
         logger.info("Unregistering advertisement")
-        adv_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, BLUEZ_SERVICE_PATH), GATT_LE_ADVERTISING_MANAGER_IFACE)
+        adv_manager = dbus.Interface(self.adapter_obj, GATT_LE_ADVERTISING_MANAGER_IFACE)
         adv_manager.UnregisterAdvertisement(self.path, reply_handler=self.unregister_success, error_handler=self.unregister_error)
         logger.info("Advertisement unregistered")
 
     def start_advertisement(self):
         """
-        Start the advertisement.
+        Start the advertisement, unless it is already registered or pending.
         """
+        if self.active:
+            logger.info("Advertisement already active")
+            return
+        self.active = True
+        self.start_requested = time.monotonic()
         self.register_advertisement()
         logger.info("Advertisement started")
         
@@ -878,6 +1472,9 @@ class Advertisement(dbus.service.Object):
         """
         Stop the advertisement.
         """
+        if not self.active:
+            return
+        self.active = False
         self.unregister_advertisement()
         logger.info("Advertisement stopped")
         
@@ -887,26 +1484,216 @@ class Advertisement(dbus.service.Object):
         Register an error callback.
         """
         logger.error(f"Advertisement registration error: {error}")
-        self.mainloop.quit()
+        self.active = False
+        self.notify_listeners('failed')
+        self.quit()
             
 
     def register_success(self):
         """
-        Register a success callback.
+        Register a success callback. Reports the time to the first
+        advertisement and runs the work deferred until advertising.
         """
         logger.info("Advertisement registration successful")
+        elapsed = time.monotonic() - self.start_requested
+        if self.time_to_advertise is None:
+            self.time_to_advertise = elapsed
+            uptime = process_uptime()
+            since_start = f"{uptime * 1000:.0f} ms since process start, " if uptime is not None else ""
+            logger.info(f"Time to first advertisement: {since_start}{elapsed * 1000:.0f} ms since start_advertisement")
+        else:
+            logger.info(f"Advertisement registered in {elapsed * 1000:.0f} ms")
+        callbacks, self.registered_callbacks = self.registered_callbacks, []
+        for callback in callbacks:
+            callback()
+        self.notify_listeners('registered')
+
+    def add_listener(self, callback):
+        """
+        Call callback(advertisement, event) on 'registered', 'failed',
+        'invalid' (the payload cannot fit, it was never sent to BlueZ) and
+        'released' (BlueZ dropped an active advertisement).
+        """
+        self.listeners.append(callback)
+
+    def notify_listeners(self, event):
+        for callback in self.listeners:
+            callback(self, event)
+
+    def add_registered_callback(self, callback):
+        """
+        Run callback once the next registration succeeds, used to keep
+        work off the path to the first advertisement.
+        """
+        self.registered_callbacks.append(callback)
 
     def unregister_error(self, error):
         """
         Unregister an error callback.
         """
         logger.error(f"Advertisement unregistration error: {error}")
-        self.mainloop.quit()
+        self.quit()
 
     def unregister_success(self):
         """
         Unregister a success callback.
         """
         logger.info("Advertisement unregistration successful")
-        self.mainloop.quit()
+        self.quit()
+
+    def quit(self):
+        """
+        Quit the main loop, unless the advertisement belongs to a long-running
+        process that was given no main loop to quit.
+        """
+        if self.mainloop is not None:
+            self.mainloop.quit()
+
+
 
+AdvertisingPhase = namedtuple('AdvertisingPhase', ['advertisement', 'duration'])
+
+
+class AdvertisingController:
+    """
+    Runs advertisements as a sequence of phases, e.g. a fast interval burst
+    after a trigger followed by a slow power-saving interval. Every phase is
+    its own Advertisement, the next one is registered before the previous one
+    is dropped. A duration of None keeps the phase until stop().
+
+    Failed or dropped registrations are retried with exponential backoff, a
+    phase whose payload cannot fit is skipped instead. restart() runs at
+    most once per MIN_RESTART_INTERVAL seconds. Once stop() has been called,
+    restart() does nothing until the next start().
+    """
+    MIN_RESTART_INTERVAL = 5
+    RETRY_DELAY = 1
+    MAX_RETRY_DELAY = 60
+
+    def __init__(self, phases):
+        if not phases:
+            raise InvalidArgsException("At least one advertising phase is required")
+        self.phases = [AdvertisingPhase(*phase) for phase in phases]
+        self.index = None
+        self.running = False
+        # Set by stop(), not when the last phase ends or restart() cycles
+        self.stopped = False
+        self.timer = None
+        self.restart_timer = None
+        self.last_restart = None
+        self.retry_delay = self.RETRY_DELAY
+        for phase in self.phases:
+            phase.advertisement.add_listener(self.on_advertisement_event)
+
+    def current(self):
+        """
+        Get the advertisement of the current phase, None when stopped.
+        """
+        return None if self.index is None else self.phases[self.index].advertisement
+
+    def add_registered_callback(self, callback):
+        """
+        Run callback once the first phase is registered.
+        """
+        self.phases[0].advertisement.add_registered_callback(callback)
+
+    def start(self):
+        """
+        Start advertising from the first phase, a no-op if already running.
+        """
+        if self.running:
+            return
+        self.running = True
+        self.stopped = False
+        self.retry_delay = self.RETRY_DELAY
+        self.enter_phase(0)
+
+    def stop(self):
+        """
+        Stop advertising and cancel pending rotations, retries and restarts.
+        """
+        self.stopped = True
+        self.halt()
+
+    def halt(self):
+        self.running = False
+        self.cancel_timer()
+        if self.restart_timer is not None:
+            self.restart_timer.cancel()
+            self.restart_timer = None
+        advertisement = self.current()
+        self.index = None
+        if advertisement is not None:
+            advertisement.stop_advertisement()
+
+    def restart(self):
+        """
+        Restart from the first phase, rate-limited to one restart per
+        MIN_RESTART_INTERVAL. Restarts requested meanwhile are coalesced.
+        Does nothing after stop(), e.g. for a delayed restart that fires
+        once advertising was switched off.
+        """
+        if self.stopped:
+            logger.info("Advertising was stopped, ignoring restart")
+            return
+        if self.restart_timer is not None:
+            return
+        now = time.monotonic()
+        if self.last_restart is not None and now - self.last_restart < self.MIN_RESTART_INTERVAL:
+            wait = self.MIN_RESTART_INTERVAL - (now - self.last_restart)
+            logger.info(f"Advertising restart rate-limited, restarting in {wait:.1f}s")
+            self.restart_timer = scheduler.schedule(wait, self.on_restart_timer)
+            return
+        self.last_restart = now
+        logger.info("Restarting advertising")
+        self.halt()
+        self.start()
+
+    def on_restart_timer(self):
+        self.restart_timer = None
+        self.restart()
+
+    def enter_phase(self, index):
+        self.cancel_timer()
+        previous = self.current()
+        self.index = index
+        advertisement = self.phases[index].advertisement
+        logger.info(f"Advertising phase {index + 1}/{len(self.phases)}: {advertisement.get_path()}")
+        advertisement.start_advertisement()
+        if previous is not None and previous is not advertisement:
+            previous.stop_advertisement()
+
+    def next_phase(self):
+        self.timer = None
+        if self.index + 1 < len(self.phases):
+            self.enter_phase(self.index + 1)
+        else:
+            logger.info("Last advertising phase finished")
+            self.halt()
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def on_advertisement_event(self, advertisement, event):
+        if not self.running or advertisement is not self.current():
+            return
+        if event == 'registered':
+            self.retry_delay = self.RETRY_DELAY
+            duration = self.phases[self.index].duration
+            if duration is not None:
+                self.timer = scheduler.schedule(duration, self.next_phase)
+        elif event == 'released' and advertisement.timeout is not None:
+            # BlueZ ended the phase at its Timeout
+            self.cancel_timer()
+            self.next_phase()
+        elif event == 'invalid':
+            logger.error(f"Skipping advertising phase {self.index + 1}, its payload cannot be advertised")
+            self.cancel_timer()
+            self.next_phase()
+        else:
+            logger.warning(f"Advertisement {event}, retrying in {self.retry_delay}s")
+            self.cancel_timer()
+            self.timer = scheduler.schedule(self.retry_delay, self.enter_phase, self.index)
+            self.retry_delay = min(self.retry_delay * 2, self.MAX_RETRY_DELAY)
@@ -0,0 +1,682 @@
+import asyncio
+import logging
+
+from dbus_fast import BusType, DBusError, Variant
+from dbus_fast.aio import MessageBus
+from dbus_fast.service import PropertyAccess, ServiceInterface, dbus_property, method
+
+from advertising_payload import plan_payload
+from gatt_common import (
+    BLUEZ_SERVICE_NAME,
+    GATT_SERVICE_IFACE, GATT_CHARACTERISTIC_IFACE, GATT_DESCRIPTOR_IFACE, GATT_MANAGER_IFACE,
+    GATT_ADAPTER_IFACE, DBUS_PROPERTIES_IFACE, DBUS_OM_IFACE,
+    GATT_LE_ADVERTISING_MANAGER_IFACE, GATT_ADVERTISEMENT_IFACE,
+    index_gatt_tree,
+)
+
+
+# asyncio front end of gatt_server for processes that already run an event
+# loop. Objects are exported with dbus-fast, which answers Properties and
+# ObjectManager calls itself, so handlers only implement the GATT methods.
+# The embedding process owns the logging configuration.
+logger = logging.getLogger(__name__)
+
+
+class BluezError(DBusError):
+    """
+    Base class for errors returned to BlueZ from async handlers.
+    """
+    error_name = 'org.freedesktop.DBus.Error.Failed'
+
+    def __init__(self, text):
+        super().__init__(self.error_name, text)
+
+
+class InvalidArgsException(BluezError):
+    """
+    Exception raised for invalid arguments.
+    """
+    error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
+
+
+class NotSupportedException(BluezError):
+    """
+    Exception raised for unsupported operations.
+    """
+    error_name = 'org.freedesktop.DBus.Error.NotSupported'
+
+
+class NotPermittedException(BluezError):
+    """
+    Exception raised for operations that are not permitted.
+    """
+    error_name = 'org.freedesktop.DBus.Error.NotPermitted'
+
+
+class FailedException(BluezError):
+    """
+    Exception raised for failed operations.
+    """
+    error_name = 'org.freedesktop.DBus.Error.Failed'
+
+
+class NotFoundException(BluezError):
+    """
+    Exception raised for objects that are not found.
+    """
+    error_name = 'org.freedesktop.DBus.Error.NotFound'
+
+
+class InvalidValueLengthException(BluezError):
+    """
+    Exception raised for invalid value lengths.
+    """
+    error_name = 'org.freedesktop.DBus.Error.InvalidValueLength'
+
+
+class InvalidOffsetException(BluezError):
+    """
+    Exception raised for a read offset beyond the end of the value.
+    """
+    error_name = 'org.bluez.Error.InvalidOffset'
+
+
+async def connect_system_bus():
+    """
+    Connect to the system bus used by BlueZ.
+    """
+    return await MessageBus(bus_type=BusType.SYSTEM).connect()
+
+
+async def get_interface(bus, path, interface):
+    """
+    Get a proxy for a BlueZ interface.
+    """
+    introspection = await bus.introspect(BLUEZ_SERVICE_NAME, path)
+    return bus.get_proxy_object(BLUEZ_SERVICE_NAME, path, introspection).get_interface(interface)
+
+
+async def find_adapter(bus):
+    """
+    Find the first adapter that supports GATT and LE advertising.
+    """
+    object_manager = await get_interface(bus, '/', DBUS_OM_IFACE)
+    objects = await object_manager.call_get_managed_objects()
+    for path, interfaces in objects.items():
+        if GATT_MANAGER_IFACE in interfaces and GATT_LE_ADVERTISING_MANAGER_IFACE in interfaces:
+            logger.info(f"Adapter found: {path}")
+            return path
+    raise NotFoundException("Adapter not found")
+
+
+def unwrap_options(options):
+    """
+    Turn the a{sv} options of a BlueZ call into plain values.
+    """
+    return {key: value.value for key, value in options.items()}
+
+
+class Application:
+    """
+    asyncio GATT Application that exports services and registers them with BlueZ.
+
+    dbus-fast answers GetManagedObjects for every exported path below "/",
+    so the application only has to export its tree before registering.
+    """
+    def __init__(self, bus):
+        self.path = '/'
+        self.bus = bus
+        self.services = []
+        self.objects_by_path = None
+        self.services_by_uuid = None
+        self.adapter = None
+        self.exported = False
+
+    def add_service(self, service):
+        """
+        Add a GATT service to the application.
+        """
+        if self.exported:
+            raise NotPermittedException("Services cannot be added after the application is exported")
+        self.services.append(service)
+        service.application = self
+        self.objects_by_path = None
+        self.services_by_uuid = None
+
+    def build_index(self):
+        """
+        Validate the whole GATT tree and index it by path and service UUID.
+        """
+        try:
+            self.objects_by_path, self.services_by_uuid = index_gatt_tree(self.services)
+        except ValueError as e:
+            raise InvalidArgsException(str(e))
+        logger.info(f"GATT tree validated: {len(self.services_by_uuid)} services, {len(self.objects_by_path)} objects")
+
+    def get_object(self, path):
+        """
+        Get a service, characteristic or descriptor by object path.
+        """
+        if self.objects_by_path is None:
+            self.build_index()
+        try:
+            return self.objects_by_path[path]
+        except KeyError:
+            raise NotFoundException(f"No GATT object at {path}")
+
+    def get_service(self, uuid):
+        """
+        Get a GATT service by UUID.
+        """
+        if self.services_by_uuid is None:
+            self.build_index()
+        try:
+            return self.services_by_uuid[uuid]
+        except KeyError:
+            raise NotFoundException("Service not found")
+
+    def export(self):
+        """
+        Export every service, characteristic and descriptor on the bus.
+        """
+        if self.exported:
+            return
+        self.build_index()
+        for path, obj in self.objects_by_path.items():
+            self.bus.export(path, obj)
+        self.exported = True
+
+    def unexport(self):
+        """
+        Remove the exported tree from the bus.
+        """
+        if not self.exported:
+            return
+        for path in self.objects_by_path:
+            self.bus.unexport(path)
+        self.exported = False
+
+    async def register_application(self, adapter=None):
+        """
+        Export the tree and register it with the GATT manager.
+        """
+        logger.info("Registering application")
+        self.export()
+        self.adapter = adapter or self.adapter or await find_adapter(self.bus)
+        gatt_manager = await get_interface(self.bus, self.adapter, GATT_MANAGER_IFACE)
+        await gatt_manager.call_register_application(self.path, {})
+        logger.info("Application registration successful")
+
+    async def unregister_application(self):
+        """
+        Unregister the application from the GATT manager.
+        """
+        logger.info("Unregistering application")
+        gatt_manager = await get_interface(self.bus, self.adapter, GATT_MANAGER_IFACE)
+        try:
+            await gatt_manager.call_unregister_application(self.path)
+        finally:
+            self.unexport()
+        logger.info("Application unregistration successful")
+
+
+class Service(ServiceInterface):
+    """
+    asyncio GATT Service, declared the same way as gatt_server.Service.
+    """
+
+    PATH_BASE = '/org/bluez/ble/service/'
+    CHARACTERISTICS = []
+
+    def __init__(self, bus, index, uuid, primary=True, characteristics=None):
+        super().__init__(GATT_SERVICE_IFACE)
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.primary = primary
+        self.characteristics = []
+        self.characteristics_by_uuid = {}
+        self.application = None
+        for char_index, characteristic_class in enumerate(characteristics or self.CHARACTERISTICS, start=1):
+            self.add_characteristic(characteristic_class(bus, char_index, self))
+
+    def get_path(self):
+        """
+        Get the path of the service.
+        """
+        return self.path
+
+    def add_characteristic(self, characteristic):
+        """
+        Add a GATT characteristic to the service.
+        """
+        if characteristic.uuid in self.characteristics_by_uuid:
+            raise InvalidArgsException(f"Duplicate characteristic UUID {characteristic.uuid}")
+        self.characteristics.append(characteristic)
+        self.characteristics_by_uuid[characteristic.uuid] = characteristic
+
+    def get_characteristic(self, uuid):
+        """
+        Get a GATT characteristic by UUID.
+        """
+        try:
+            return self.characteristics_by_uuid[uuid]
+        except KeyError:
+            raise NotFoundException("Characteristic not found")
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> 's':
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Primary(self) -> 'b':
+        return self.primary
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristics(self) -> 'ao':
+        return [characteristic.path for characteristic in self.characteristics]
+
+
+class Characteristic(ServiceInterface):
+    """
+    asyncio GATT Characteristic.
+
+    Subclasses implement the coroutines read_value, write_value, start_notify
+    and stop_notify; the D-Bus methods await them on the bus's event loop.
+    Options arrive as plain values, e.g. options.get('offset', 0).
+    """
+    DESCRIPTORS = []
+
+    def __init__(self, bus, index, uuid, flags, service):
+        super().__init__(GATT_CHARACTERISTIC_IFACE)
+        self.path = service.path + "/char" + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.flags = flags
+        self.service = service
+        self.value = b''
+        self.notifying = False
+        self.descriptors = []
+        self.descriptors_by_uuid = {}
+        for descriptor_index, descriptor_class in enumerate(self.DESCRIPTORS, start=1):
+            self.add_descriptor(descriptor_class(bus, descriptor_index, self))
+
+    def get_path(self):
+        """
+        Get the path of the characteristic.
+        """
+        return self.path
+
+    def add_descriptor(self, descriptor):
+        """
+        Add a GATT descriptor to the characteristic.
+        """
+        if descriptor.uuid in self.descriptors_by_uuid:
+            raise InvalidArgsException(f"Duplicate descriptor UUID {descriptor.uuid}")
+        self.descriptors.append(descriptor)
+        self.descriptors_by_uuid[descriptor.uuid] = descriptor
+
+    def get_descriptor(self, uuid):
+        """
+        Get a GATT descriptor by UUID.
+        """
+        try:
+            return self.descriptors_by_uuid[uuid]
+        except KeyError:
+            raise NotFoundException("Descriptor not found")
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> 's':
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Service(self) -> 'o':
+        return self.service.path
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> 'as':
+        return list(self.flags)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Descriptors(self) -> 'ao':
+        return [descriptor.path for descriptor in self.descriptors]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Value(self) -> 'ay':
+        return bytes(self.value)
+
+    @method()
+    async def ReadValue(self, options: 'a{sv}') -> 'ay':
+        return bytes(await self.read_value(unwrap_options(options)))
+
+    @method()
+    async def WriteValue(self, value: 'ay', options: 'a{sv}'):
+        await self.write_value(bytes(value), unwrap_options(options))
+
+    @method()
+    async def StartNotify(self):
+        await self.start_notify()
+
+    @method()
+    async def StopNotify(self):
+        await self.stop_notify()
+
+    async def read_value(self, options):
+        """
+        Read the value of the characteristic.
+        """
+        logger.info("Default read_value called")
+        raise NotSupportedException("Read not supported")
+
+    async def write_value(self, value, options):
+        """
+        Write a value to the characteristic.
+        """
+        logger.info("Default write_value called")
+        raise NotSupportedException("Write not supported")
+
+    async def start_notify(self):
+        """
+        Start notifications for the characteristic.
+        """
+        logger.info("Default start_notify called")
+        raise NotSupportedException("Notifications not supported")
+
+    async def stop_notify(self):
+        """
+        Stop notifications for the characteristic.
+        """
+        logger.info("Default stop_notify called")
+        raise NotSupportedException("Notifications not supported")
+
+    def get_value(self):
+        """
+        Get the value of the characteristic.
+        """
+        return self.value
+
+    def set_value(self, value):
+        """
+        Set the value of the characteristic and notify subscribed clients.
+        """
+        self.value = bytes(value)
+        self.emit_properties_changed({'Value': self.value})
+
+
+class Descriptor(ServiceInterface):
+    """
+    asyncio GATT Descriptor. Subclasses implement read_value and write_value.
+    """
+    def __init__(self, bus, index, uuid, flags, characteristic):
+        super().__init__(GATT_DESCRIPTOR_IFACE)
+        self.path = characteristic.path + "/descriptor" + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.flags = flags
+        self.characteristic = characteristic
+        self.value = b''
+
+    def get_path(self):
+        """
+        Get the path of the descriptor.
+        """
+        return self.path
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> 's':
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristic(self) -> 'o':
+        return self.characteristic.path
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> 'as':
+        return list(self.flags)
+
+    @method()
+    async def ReadValue(self, options: 'a{sv}') -> 'ay':
+        return bytes(await self.read_value(unwrap_options(options)))
+
+    @method()
+    async def WriteValue(self, value: 'ay', options: 'a{sv}'):
+        await self.write_value(bytes(value), unwrap_options(options))
+
+    async def read_value(self, options):
+        """
+        Read the value of the descriptor.
+        """
+        logger.info("Default read_value called")
+        raise NotSupportedException("Read not supported")
+
+    async def write_value(self, value, options):
+        """
+        Write a value to the descriptor.
+        """
+        logger.info("Default write_value called")
+        raise NotSupportedException("Write not supported")
+
+
+class CUDDescriptor(Descriptor):
+    """
+    Characteristic User Description descriptor.
+    """
+    CUD_UUID = '2901'
+    CUD_FLAGS = ['read']
+    DESCRIPTION = 'Registers CUD for application'
+
+    def __init__(self, bus, index, characteristic):
+        super().__init__(bus, index, self.CUD_UUID, self.CUD_FLAGS, characteristic)
+        self.value = self.DESCRIPTION.encode('utf-8')
+
+    async def read_value(self, options):
+        """
+        Read the user description, honouring the read offset.
+        """
+        offset = options.get('offset', 0)
+        if offset > len(self.value):
+            raise InvalidOffsetException(f"Offset {offset} beyond {len(self.value)} bytes")
+        return self.value[offset:]
+
+
+class Advertisement(ServiceInterface):
+    """
+    asyncio LE Advertisement.
+
+    dbus-fast publishes every declared property, so collections default to
+    empty and a local name is required rather than optional. For the same
+    reason SecondaryChannel cannot be left out, so the payload is always
+    planned for legacy advertising PDUs.
+    """
+
+    PATH_BASE = '/org/bluez/ble/advertisement/'
+
+    def __init__(self, bus, index, advertisement_type, local_name):
+        super().__init__(GATT_ADVERTISEMENT_IFACE)
+        if not isinstance(local_name, str) or not local_name:
+            raise InvalidArgsException("Name must be a non-empty string")
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.advertisement_type = advertisement_type
+        self.local_name = local_name
+        self.service_uuids = []
+        self.solicit_uuids = []
+        self.manufacturer_data = {}
+        self.service_data = {}
+        self.include_tx_power = False
+        self.payload_plan = None
+        self.adapter = None
+        self.registered = False
+
+    def get_path(self):
+        """
+        Get the path of the advertisement.
+        """
+        return self.path
+
+    def add_service_uuid(self, uuid):
+        """
+        Add a service UUID to the advertisement.
+        """
+        self.service_uuids.append(uuid)
+
+    def add_solicit_uuid(self, uuid):
+        """
+        Add a solicit UUID to the advertisement.
+        """
+        self.solicit_uuids.append(uuid)
+
+    def add_manufacturer_data(self, manufacturer_id, data):
+        """
+        Add manufacturer data to the advertisement.
+        """
+        if not isinstance(manufacturer_id, int):
+            raise InvalidArgsException("Manufacturer ID must be an integer")
+        self.manufacturer_data[manufacturer_id] = self.encode_data(data)
+
+    def add_service_data(self, uuid, data):
+        """
+        Add service data to the advertisement.
+        """
+        if not isinstance(uuid, str):
+            raise InvalidArgsException("UUID must be a string")
+        self.service_data[uuid] = self.encode_data(data)
+
+    def encode_data(self, data):
+        """
+        Check and encode advertising data given as a string or bytes. Whether
+        it fits is decided by plan_payload.
+        """
+        if not isinstance(data, (str, bytes)):
+            raise InvalidArgsException("Data must be a string or bytes")
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return data
+
+    def plan_payload(self):
+        """
+        Lay out the fields over the advertising PDU and scan response like
+        gatt_server.Advertisement does. Raises InvalidValueLengthException
+        if the fields cannot fit.
+        """
+        try:
+            plan = plan_payload(
+                service_uuids=self.service_uuids, solicit_uuids=self.solicit_uuids,
+                manufacturer_data=self.manufacturer_data, service_data=self.service_data,
+                local_name=self.local_name, include_tx_power=self.include_tx_power,
+                include_flags=self.advertisement_type == 'peripheral')
+        except ValueError as e:
+            raise InvalidValueLengthException(str(e))
+        if plan.name_shortened:
+            logger.warning(f"Local name shortened to {plan.local_name!r} to fit the advertisement")
+        logger.info(f"Advertising payload: ADV {plan.adv_size} bytes {list(plan.adv)}, "
+                    f"scan response {plan.scan_response_size} bytes {list(plan.scan_response)}")
+        self.payload_plan = plan
+        return plan
+
+    def in_scan_response(self, field):
+        return self.payload_plan is not None and field in self.payload_plan.scan_response
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Type(self) -> 's':
+        return self.advertisement_type
+
+    @dbus_property(access=PropertyAccess.READ)
+    def LocalName(self) -> 's':
+        return self.payload_plan.local_name if self.payload_plan is not None else self.local_name
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ServiceUUIDs(self) -> 'as':
+        return self.service_uuids
+
+    @dbus_property(access=PropertyAccess.READ)
+    def SolicitUUIDs(self) -> 'as':
+        return self.solicit_uuids
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ManufacturerData(self) -> 'a{qv}':
+        if self.in_scan_response('manufacturer_data'):
+            return {}
+        return {key: Variant('ay', value) for key, value in self.manufacturer_data.items()}
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ScanResponseManufacturerData(self) -> 'a{qv}':
+        if not self.in_scan_response('manufacturer_data'):
+            return {}
+        return {key: Variant('ay', value) for key, value in self.manufacturer_data.items()}
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ServiceData(self) -> 'a{sv}':
+        if self.in_scan_response('service_data'):
+            return {}
+        return {key: Variant('ay', value) for key, value in self.service_data.items()}
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ScanResponseServiceData(self) -> 'a{sv}':
+        if not self.in_scan_response('service_data'):
+            return {}
+        return {key: Variant('ay', value) for key, value in self.service_data.items()}
+
+    @dbus_property(access=PropertyAccess.READ)
+    def IncludeTxPower(self) -> 'b':
+        return self.include_tx_power
+
+    @method()
+    def Release(self):
+        logger.info("Advertisement released")
+        self.registered = False
+
+    async def set_adapter_property(self, name, signature, value):
+        """
+        Set a property of the adapter, e.g. ('Powered', 'b', True).
+        """
+        self.adapter = self.adapter or await find_adapter(self.bus)
+        adapter_props = await get_interface(self.bus, self.adapter, DBUS_PROPERTIES_IFACE)
+        await adapter_props.call_set(GATT_ADAPTER_IFACE, name, Variant(signature, value))
+        logger.info(f"Adapter property set: {name} - {value}")
+
+    async def start_advertisement(self, adapter=None):
+        """
+        Export and register the advertisement.
+        """
+        logger.info("Registering advertisement")
+        self.plan_payload()
+        self.adapter = adapter or self.adapter or await find_adapter(self.bus)
+        self.bus.export(self.path, self)
+        adv_manager = await get_interface(self.bus, self.adapter, GATT_LE_ADVERTISING_MANAGER_IFACE)
+        try:
+            await adv_manager.call_register_advertisement(self.path, {})
+        except DBusError:
+            self.bus.unexport(self.path, self)
+            raise
+        self.registered = True
+        logger.info("Advertisement started")
+
+    async def stop_advertisement(self):
+        """
+        Unregister and unexport the advertisement.
+        """
+        if not self.registered:
+            return
+        logger.info("Unregistering advertisement")
+        adv_manager = await get_interface(self.bus, self.adapter, GATT_LE_ADVERTISING_MANAGER_IFACE)
+        try:
+            await adv_manager.call_unregister_advertisement(self.path)
+        finally:
+            self.registered = False
+            self.bus.unexport(self.path, self)
+        logger.info("Advertisement stopped")
+
+
+async def serve(application, advertisement, stop_event=None):
+    """
+    Register an application and its advertisement, then wait until
+    stop_event is set or the task is cancelled and tear both down.
+    """
+    await application.register_application()
+    await advertisement.start_advertisement(application.adapter)
+    try:
+        await (stop_event or asyncio.Event()).wait()
+    finally:
+        await advertisement.stop_advertisement()
+        await application.unregister_application()
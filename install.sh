@@ -33,6 +33,8 @@ sudo apt install -y python3 python3-pip || error "Failed to install Python3 or p
 info "Installing required Python packages..."
 pip3 install --upgrade pip
 pip3 install PyGObject dbus-python || error "Failed to install Python libraries."
+# dbus-fast backs the optional asyncio front end (gatt_server_asyncio.py)
+pip3 install dbus-fast || error "Failed to install dbus-fast."
 
 info "Enabling and starting Bluetooth and NetworkManager services..."
 sudo systemctl enable bluetooth
@@ -40,6 +42,10 @@ sudo systemctl start bluetooth
 sudo systemctl enable NetworkManager
 sudo systemctl start NetworkManager
 
+info "Installing D-Bus policy for the daemon control interface..."
+sudo cp ble_wifi_config.conf /etc/dbus-1/system.d/ || error "Failed to install D-Bus policy."
+sudo systemctl reload dbus || error "Failed to reload D-Bus."
+
 info "Setup Hardware Button Trigger Service..."
 #cd BLE-Wifi-Config-Rpi || error "Failed to change directory."
 sudo mv ble_characteristic_trigger.service /etc/systemd/system || error "Failed to copy service file."
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import string
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from gi.repository import GLib
+from gatt_server import DBusFuture, logger
+
+
+NETWORK_STORE_PATH = '/var/lib/ble-wifi-config/networks.json'
+
+# WPA2 PSK derivation: PBKDF2-HMAC-SHA1 over the SSID, 4096 rounds, 256 bits
+PMK_ITERATIONS = 4096
+PMK_LENGTH = 32
+
+PMK_CACHE_SIZE = 16
+
+KnownNetwork = namedtuple('KnownNetwork', ['ssid', 'psk_hash', 'bssid', 'channel', 'profile', 'last_connected', 'hidden'],
+                          defaults=(False,))
+
+
+def is_psk_hash(psk):
+    """
+    True for a precomputed 64 hex digit PSK, which NetworkManager and
+    wpa_supplicant accept in place of the passphrase.
+    """
+    return len(psk) == 2 * PMK_LENGTH and all(c in string.hexdigits for c in psk)
+
+
+def derive_pmk(ssid, psk):
+    return hashlib.pbkdf2_hmac('sha1', psk.encode('utf-8'), ssid.encode('utf-8'), PMK_ITERATIONS, PMK_LENGTH).hex()
+
+
+class PmkCache:
+    """
+    Derived PSKs of recent passphrases. PBKDF2 takes hundreds of
+    milliseconds on a Pi Zero, so derive() runs it on a worker thread and
+    repeated attempts with the same credentials are answered from the
+    cache. Keys hold a digest of the passphrase, not the passphrase itself.
+    """
+    def __init__(self, size=PMK_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.pending = {}
+
+    def key(self, ssid, psk):
+        return ssid, hashlib.sha256(psk.encode('utf-8')).digest()
+
+    def lookup(self, key):
+        pmk = self.entries.get(key)
+        if pmk is not None:
+            self.entries.move_to_end(key)
+        return pmk
+
+    def store(self, key, pmk):
+        self.entries[key] = pmk
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, ssid, psk):
+        """
+        Derive the hex PSK on the calling thread, using the cache.
+        """
+        if is_psk_hash(psk):
+            return psk.lower()
+        key = self.key(ssid, psk)
+        pmk = self.lookup(key)
+        if pmk is None:
+            pmk = derive_pmk(ssid, psk)
+            self.store(key, pmk)
+        return pmk
+
+    def derive(self, ssid, psk):
+        """
+        Derive the hex PSK without blocking the main loop. Returns a
+        DBusFuture completed on the main loop; concurrent requests for the
+        same credentials share one derivation.
+        """
+        if is_psk_hash(psk):
+            future = DBusFuture(f"PSK for {ssid}")
+            future.set_result(psk.lower())
+            return future
+        key = self.key(ssid, psk)
+        pending = self.pending.get(key)
+        if pending is not None:
+            return pending
+        future = DBusFuture(f"PSK for {ssid}")
+        pmk = self.lookup(key)
+        if pmk is not None:
+            future.set_result(pmk)
+            return future
+        self.pending[key] = future
+
+        def on_derived(pmk, error):
+            del self.pending[key]
+            if error is not None:
+                future.set_exception(error)
+            else:
+                self.store(key, pmk)
+                future.set_result(pmk)
+            return False
+
+        def worker():
+            started = time.monotonic()
+            try:
+                pmk, error = derive_pmk(ssid, psk), None
+            except Exception as e:
+                pmk, error = None, e
+            logger.info(f"Derived PSK for {ssid} in {(time.monotonic() - started) * 1000:.0f} ms")
+            GLib.idle_add(on_derived, pmk, error)
+
+        threading.Thread(target=worker, name="pmk-derive", daemon=True).start()
+        return future
+
+
+pmk_cache = PmkCache()
+
+
+def psk_hash(ssid, psk):
+    """
+    Derive the hex PSK for a passphrase, or normalise one given already hashed.
+    """
+    return pmk_cache.get(ssid, psk)
+
+
+class NetworkStore:
+    """
+    Networks this device has joined, persisted as JSON. Only the derived
+    PSK is kept, never the passphrase, together with what is needed for a
+    fast reconnect: the NetworkManager profile UUID and the last BSSID and
+    channel.
+    """
+    def __init__(self, path=NETWORK_STORE_PATH):
+        self.path = path
+        self.networks = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                records = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read known networks from {self.path}: {e}")
+            return
+        for record in records:
+            try:
+                network = KnownNetwork(**record)
+            except TypeError:
+                logger.warning(f"Skipping malformed known network record: {record}")
+                continue
+            self.networks[network.ssid] = network
+        logger.info(f"Loaded {len(self.networks)} known networks")
+
+    def save(self):
+        """
+        Write the store atomically, readable by the owner only.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump([network._asdict() for network in self.networks.values()], f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def get(self, ssid):
+        return self.networks.get(ssid)
+
+    def list(self):
+        """
+        Known networks, most recently connected first.
+        """
+        return sorted(self.networks.values(), key=lambda network: network.last_connected, reverse=True)
+
+    def remember(self, ssid, psk_hash, bssid=None, channel=None, profile=None, hidden=False):
+        """
+        Record a successful connection. Details that were not reported this
+        time are kept from the previous record if the PSK is unchanged.
+        """
+        previous = self.networks.get(ssid)
+        if previous is not None and previous.psk_hash == psk_hash:
+            bssid = bssid or previous.bssid
+            channel = channel or previous.channel
+            profile = profile or previous.profile
+        self.networks[ssid] = KnownNetwork(ssid, psk_hash, bssid, channel, profile, int(time.time()), hidden)
+        self.persist()
+
+    def forget(self, ssid):
+        """
+        Remove a network, returning the removed record or None.
+        """
+        network = self.networks.pop(ssid, None)
+        if network is not None:
+            self.persist()
+        return network
+
+    def persist(self):
+        try:
+            self.save()
+        except OSError as e:
+            logger.error(f"Could not save known networks to {self.path}: {e}")
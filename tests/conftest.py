@@ -0,0 +1,193 @@
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+# The modules live at the repository root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BUS_CONFIG = """<!DOCTYPE busconfig PUBLIC "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <type>session</type>
+  <listen>unix:tmpdir=/tmp</listen>
+  <policy context="default">
+    <allow send_destination="*" eavesdrop="true"/>
+    <allow eavesdrop="true"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+"""
+
+
+def run_until(condition, timeout=5):
+    """
+    Iterate the default GLib main context until condition() holds or the
+    timeout passes, and return the last result.
+    """
+    from gi.repository import GLib
+
+    context = GLib.MainContext.default()
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return condition()
+        context.iteration(False)
+        time.sleep(0.001)
+    return True
+
+
+@pytest.fixture(autouse=True, scope='session')
+def no_log_file():
+    """
+    Keep gatt_server from writing gatt_module.log into the working tree.
+    """
+    try:
+        import gatt_server
+    except ImportError:
+        yield
+        return
+    gatt_server.logger.removeHandler(gatt_server.loghandlerfile)
+    yield
+
+
+@pytest.fixture
+def bus_address(tmp_path):
+    """
+    Address of a private dbus-daemon that lives for one test.
+    """
+    daemon = shutil.which('dbus-daemon')
+    if daemon is None:
+        pytest.skip("dbus-daemon is not installed")
+    config = tmp_path / 'bus.conf'
+    config.write_text(BUS_CONFIG)
+    process = subprocess.Popen([daemon, '--config-file', str(config), '--nofork', '--print-address'],
+                               stdout=subprocess.PIPE, text=True)
+    yield process.stdout.readline().strip()
+    process.terminate()
+    process.wait()
+    process.stdout.close()
+
+
+@pytest.fixture
+def session_bus(bus_address):
+    """
+    Factory for dbus-python connections to the private bus, driven by the
+    default GLib main context.
+    """
+    pytest.importorskip("dbus")
+    pytest.importorskip("gi")
+    import dbus.bus
+    from dbus.mainloop.glib import DBusGMainLoop
+
+    mainloop = DBusGMainLoop()
+    buses = []
+
+    def connect():
+        bus = dbus.bus.BusConnection(bus_address, mainloop=mainloop)
+        buses.append(bus)
+        return bus
+
+    yield connect
+    for bus in buses:
+        bus.close()
+
+
+class Bluez:
+    """
+    Handle on a fake_bluez process: `bus` is the connection the code under
+    test uses, `control` the fake's test interface.
+    """
+    def __init__(self, bus, process):
+        import dbus
+        from fake_bluez import ADAPTER_PATH, CONTROL_IFACE
+        self.bus = bus
+        self.process = process
+        self.adapter_path = ADAPTER_PATH
+        self.control = dbus.Interface(bus.get_object('org.bluez', '/'), CONTROL_IFACE)
+        self.adapter_props = dbus.Interface(bus.get_object('org.bluez', ADAPTER_PATH),
+                                            'org.freedesktop.DBus.Properties')
+
+    def calls(self, method=None):
+        return [str(path) for name, path in self.control.Calls() if method is None or name == method]
+
+    def adapter_property(self, name):
+        return self.adapter_props.Get('org.bluez.Adapter1', name)
+
+
+@pytest.fixture
+def bluez(session_bus, bus_address, monkeypatch):
+    """
+    A fake bluetoothd on the private bus. The BlueZ object cache is reset
+    so the code under test loads it from this fake.
+    """
+    import gatt_server
+
+    bus = session_bus()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    process = subprocess.Popen([sys.executable, os.path.join(TESTS_DIR, 'fake_bluez.py'), bus_address], env=env)
+    deadline = time.monotonic() + 10
+    while not bus.name_has_owner('org.bluez'):
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.kill()
+            pytest.fail("fake bluetoothd did not start")
+        time.sleep(0.01)
+    monkeypatch.setattr(gatt_server, 'object_caches', {})
+    yield Bluez(bus, process)
+    process.terminate()
+    process.wait()
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    """
+    A fresh shared DeadlineScheduler, with calls still pending at the end
+    of the test cancelled so they cannot fire in a later one.
+    """
+    pytest.importorskip("dbus")
+    pytest.importorskip("gi")
+    from gi.repository import GLib
+    import ble_characteristic_trigger
+    import gatt_server
+    import wpa_characteristics
+
+    scheduler = gatt_server.DeadlineScheduler()
+    for module in (gatt_server, wpa_characteristics, ble_characteristic_trigger):
+        monkeypatch.setattr(module, 'scheduler', scheduler)
+    yield scheduler
+    for _, _, call in scheduler.heap:
+        call.cancel()
+    if scheduler.timer_id is not None:
+        GLib.source_remove(scheduler.timer_id)
+
+
+@pytest.fixture
+def wpa_service(bluez, scheduler, tmp_path):
+    """
+    WPAService registered in an Application on the fake bluetoothd, with a
+    FakeWifiBackend and a network store under tmp_path. Every
+    characteristic collects the values it notifies in `notifications`.
+    """
+    from fake_wifi import FakeWifiBackend
+    from gatt_server import Application
+    from network_store import NetworkStore
+    from wpa_characteristics import WPAService
+
+    service = WPAService(bluez.bus, 0)
+    Application(bluez.bus, None).add_service(service)
+    wifi_manager = service.wpa_characteristic.wifi_manager
+    wifi_manager._backend = FakeWifiBackend()
+    wifi_manager._store = NetworkStore(str(tmp_path / 'networks.json'))
+    for characteristic in service.characteristics:
+        characteristic.notifications = []
+        characteristic.PropertiesChanged = (lambda interface, changed, invalidated, sent=characteristic.notifications:
+                                            sent.append(bytes(changed['Value'])))
+    yield service
+    for device in list(service.wpa_characteristic.sessions):
+        service.wpa_characteristic.close_session(device)
+    service.wpa_characteristic.scan_cache.stop()
@@ -0,0 +1,241 @@
+"""
+Just enough of bluetoothd for the GATT server, run as its own process on a
+private bus: the GATT code makes blocking calls to BlueZ that a fake in the
+test process could never answer. Tests drive it through the
+org.bluez.test.Control1 interface on "/".
+
+Usage: python fake_bluez.py <bus address>
+"""
+import sys
+
+import dbus
+import dbus.exceptions
+import dbus.mainloop.glib
+import dbus.service
+from gi.repository import GLib
+
+from gatt_common import (
+    BLUEZ_SERVICE_NAME, BLUEZ_SERVICE_PATH, DBUS_OM_IFACE, DBUS_PROPERTIES_IFACE, GATT_ADAPTER_IFACE,
+    GATT_ADVERTISEMENT_IFACE, GATT_DEVICE_IFACE, GATT_LE_ADVERTISING_MANAGER_IFACE, GATT_MANAGER_IFACE,
+)
+
+
+CONTROL_IFACE = 'org.bluez.test.Control1'
+AGENT_MANAGER_IFACE = 'org.bluez.AgentManager1'
+ADAPTER_PATH = '/org/bluez/hci0'
+
+
+class Failed(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.Failed'
+
+
+class PropertiesObject(dbus.service.Object):
+    """
+    Serves org.freedesktop.DBus.Properties from a dict of interfaces and
+    signals every change.
+    """
+    def __init__(self, bus, path, properties):
+        super().__init__(bus, path)
+        self.path = dbus.ObjectPath(path)
+        self.properties = properties
+
+    @dbus.service.method(DBUS_PROPERTIES_IFACE, in_signature='ss', out_signature='v')
+    def Get(self, interface, name):
+        return self.properties[interface][name]
+
+    @dbus.service.method(DBUS_PROPERTIES_IFACE, in_signature='s', out_signature='a{sv}')
+    def GetAll(self, interface):
+        return dbus.Dictionary(self.properties.get(interface, {}), signature='sv')
+
+    @dbus.service.method(DBUS_PROPERTIES_IFACE, in_signature='ssv', out_signature='')
+    def Set(self, interface, name, value):
+        self.update(interface, {name: value})
+
+    @dbus.service.signal(DBUS_PROPERTIES_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    def update(self, interface, changed):
+        self.properties[interface].update(changed)
+        self.PropertiesChanged(interface, dbus.Dictionary(changed, signature='sv'), dbus.Array([], signature='s'))
+
+
+class FakeAdapter(PropertiesObject):
+    def __init__(self, bus, bluez):
+        super().__init__(bus, ADAPTER_PATH, {
+            GATT_ADAPTER_IFACE: {
+                'Address': dbus.String('00:11:22:33:44:55'),
+                'Powered': dbus.Boolean(True),
+                'Discoverable': dbus.Boolean(False),
+                'DiscoverableTimeout': dbus.UInt32(180),
+                'Pairable': dbus.Boolean(False),
+                'PairableTimeout': dbus.UInt32(0),
+            },
+            GATT_MANAGER_IFACE: {},
+            GATT_LE_ADVERTISING_MANAGER_IFACE: {
+                'SupportedInstances': dbus.Byte(4),
+                'SupportedSecondaryChannels': dbus.Array([], signature='s'),
+            },
+        })
+        self.bluez = bluez
+
+    @dbus.service.method(GATT_ADAPTER_IFACE, in_signature='o', out_signature='')
+    def RemoveDevice(self, path):
+        self.bluez.record('RemoveDevice', path)
+        self.bluez.remove_device(path)
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature='oa{sv}', out_signature='', sender_keyword='sender',
+                         async_callbacks=('reply', 'error'))
+    def RegisterApplication(self, path, options, sender, reply, error):
+        # bluetoothd reads the whole tree before it replies
+        def on_objects(objects):
+            self.bluez.record('RegisterApplication', path)
+            self.bluez.applications[path] = objects
+            reply()
+        self.bluez.check('RegisterApplication')
+        application = self.connection.get_object(sender, path, introspect=False)
+        application.GetManagedObjects(dbus_interface=DBUS_OM_IFACE, reply_handler=on_objects,
+                                      error_handler=lambda e: error(Failed(str(e))))
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature='o', out_signature='')
+    def UnregisterApplication(self, path):
+        self.bluez.record('UnregisterApplication', path)
+        self.bluez.applications.pop(path, None)
+
+    @dbus.service.method(GATT_LE_ADVERTISING_MANAGER_IFACE, in_signature='oa{sv}', out_signature='',
+                         sender_keyword='sender', async_callbacks=('reply', 'error'))
+    def RegisterAdvertisement(self, path, options, sender, reply, error):
+        def on_properties(properties):
+            self.bluez.record('RegisterAdvertisement', path)
+            self.bluez.advertisements[path] = properties
+            reply()
+        try:
+            self.bluez.check('RegisterAdvertisement')
+        except Failed as e:
+            error(e)
+            return
+        advertisement = self.connection.get_object(sender, path, introspect=False)
+        advertisement.GetAll(GATT_ADVERTISEMENT_IFACE, dbus_interface=DBUS_PROPERTIES_IFACE,
+                             reply_handler=on_properties, error_handler=lambda e: error(Failed(str(e))))
+
+    @dbus.service.method(GATT_LE_ADVERTISING_MANAGER_IFACE, in_signature='o', out_signature='')
+    def UnregisterAdvertisement(self, path):
+        self.bluez.record('UnregisterAdvertisement', path)
+        self.bluez.advertisements.pop(path, None)
+
+
+class FakeAgentManager(dbus.service.Object):
+    def __init__(self, bus, bluez):
+        super().__init__(bus, BLUEZ_SERVICE_PATH)
+        self.bluez = bluez
+
+    @dbus.service.method(AGENT_MANAGER_IFACE, in_signature='os', out_signature='')
+    def RegisterAgent(self, path, capability):
+        self.bluez.record('RegisterAgent', path)
+
+    @dbus.service.method(AGENT_MANAGER_IFACE, in_signature='o', out_signature='')
+    def RequestDefaultAgent(self, path):
+        self.bluez.record('RequestDefaultAgent', path)
+
+
+class FakeBluez(dbus.service.Object):
+    """
+    The object manager on "/" plus the test control interface.
+    """
+    def __init__(self, bus):
+        super().__init__(bus, '/')
+        self.bus = bus
+        self.calls = []
+        self.failures = {}
+        self.applications = {}
+        self.advertisements = {}
+        self.agent_manager = FakeAgentManager(bus, self)
+        self.adapter = FakeAdapter(bus, self)
+        self.devices = {}
+
+    def record(self, method, path):
+        self.calls.append((method, str(path)))
+
+    def check(self, method):
+        if self.failures.get(method, 0) > 0:
+            self.failures[method] -= 1
+            self.record(method + 'Failed', '')
+            raise Failed(f"{method} failed")
+
+    def objects(self):
+        objects = {self.adapter.path: self.adapter.properties}
+        for device in self.devices.values():
+            objects[device.path] = device.properties
+        return objects
+
+    def remove_device(self, path):
+        device = self.devices.pop(str(path), None)
+        if device is None:
+            raise Failed(f"No device {path}")
+        device.remove_from_connection()
+        self.InterfacesRemoved(device.path, dbus.Array(list(device.properties), signature='s'))
+
+    @dbus.service.method(DBUS_OM_IFACE, in_signature='', out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        return self.objects()
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+    @dbus.service.method(CONTROL_IFACE, in_signature='sb', out_signature='o')
+    def AddDevice(self, address, connected):
+        path = f"{ADAPTER_PATH}/dev_{address.replace(':', '_')}"
+        device = PropertiesObject(self.bus, path, {GATT_DEVICE_IFACE: {
+            'Address': dbus.String(address),
+            'Adapter': dbus.ObjectPath(ADAPTER_PATH),
+            'Connected': dbus.Boolean(connected),
+        }})
+        self.devices[path] = device
+        self.InterfacesAdded(device.path, device.properties)
+        return device.path
+
+    @dbus.service.method(CONTROL_IFACE, in_signature='ob', out_signature='')
+    def SetConnected(self, path, connected):
+        self.devices[str(path)].update(GATT_DEVICE_IFACE, {'Connected': dbus.Boolean(connected)})
+
+    @dbus.service.method(CONTROL_IFACE, in_signature='o', out_signature='')
+    def RemoveDevice(self, path):
+        self.remove_device(path)
+
+    @dbus.service.method(CONTROL_IFACE, in_signature='su', out_signature='')
+    def FailNext(self, method, count):
+        self.failures[method] = count
+
+    @dbus.service.method(CONTROL_IFACE, in_signature='', out_signature='a(ss)')
+    def Calls(self):
+        return dbus.Array(self.calls, signature='(ss)')
+
+    @dbus.service.method(CONTROL_IFACE, in_signature='o', out_signature='a{oa{sa{sv}}}')
+    def Application(self, path):
+        if str(path) not in self.applications:
+            raise Failed(f"{path} is not registered")
+        return self.applications[str(path)]
+
+    @dbus.service.method(CONTROL_IFACE, in_signature='o', out_signature='a{sv}')
+    def Advertisement(self, path):
+        if str(path) not in self.advertisements:
+            raise Failed(f"{path} is not registered")
+        return self.advertisements[str(path)]
+
+
+def main(address):
+    mainloop = dbus.mainloop.glib.DBusGMainLoop()
+    bus = dbus.bus.BusConnection(address, mainloop=mainloop)
+    bluez = FakeBluez(bus)
+    # Owned last, so the name appearing means everything is exported
+    bluez.name = dbus.service.BusName(BLUEZ_SERVICE_NAME, bus)
+    GLib.MainLoop().run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -0,0 +1,99 @@
+"""
+In-memory Wi-Fi backend for driving WiFiManager and the characteristics
+without NetworkManager. Connects stay pending until the test completes
+them.
+"""
+
+
+class PendingConnect:
+    """
+    One backend.connect or activate_profile call waiting for its result.
+    """
+    def __init__(self, ssid, psk, callback, progress, **kwargs):
+        self.ssid = ssid
+        self.psk = psk
+        self.callback = callback
+        self.progress = progress
+        self.kwargs = kwargs
+
+    def stage(self, stage):
+        if self.progress:
+            self.progress(stage)
+
+    def succeed(self, ip="192.168.1.50", **result):
+        self.callback(dict({"success": True, "message": "Connected successfully", "ip": ip}, **result))
+
+    def fail(self, message="Connection failed", error=None):
+        self.callback({"success": False, "message": message, "ip": None, "error": error})
+
+
+class FakeWatch:
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.callback = callback
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        self.backend.watches.remove(self)
+
+
+class FakeWifiBackend:
+    name = 'fake'
+
+    def __init__(self, networks=()):
+        self.networks = list(networks)
+        self.scans = []
+        self.connects = []
+        self.watches = []
+        self.deleted = []
+        self.connectivity = None
+        # Set to hold scan results until complete_scans() is called
+        self.hold_scans = False
+        self.held_scans = []
+
+    def scan(self, callback, rescan=False):
+        self.scans.append(rescan)
+        if self.hold_scans:
+            self.held_scans.append(callback)
+        else:
+            callback(list(self.networks))
+
+    def complete_scans(self, networks=None):
+        held, self.held_scans = self.held_scans, []
+        for callback in held:
+            callback(list(self.networks) if networks is None else networks)
+
+    def fail_scans(self):
+        held, self.held_scans = self.held_scans, []
+        for callback in held:
+            callback(None)
+
+    def scan_for(self, ssids, callback, channels=None, timeout=None):
+        callback([ap for ap in self.networks if ap.ssid in ssids and (not channels or ap.channel in channels)])
+
+    def connect(self, ssid, psk, callback, timeout=None, progress=None, **kwargs):
+        self.connects.append(PendingConnect(ssid, psk, callback, progress, timeout=timeout, **kwargs))
+
+    def activate_profile(self, uuid, callback, timeout=None, progress=None):
+        self.connects.append(PendingConnect(None, None, callback, progress, profile=uuid, timeout=timeout))
+
+    def check_connectivity(self, callback):
+        callback(self.connectivity)
+
+    def delete_profile(self, uuid):
+        self.deleted.append(uuid)
+
+    def watch(self, callback):
+        watch = FakeWatch(self, callback)
+        self.watches.append(watch)
+        callback(list(self.networks))
+        return watch
+
+    def report(self, networks):
+        """
+        Change the scan list and tell every watch.
+        """
+        self.networks = list(networks)
+        for watch in list(self.watches):
+            watch.callback(list(self.networks))
@@ -0,0 +1,68 @@
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+from gatt_server import Advertisement  # noqa: E402
+
+SERVICE_UUID = '00001800-0000-1000-6000-00805f9b34fb'
+
+
+@pytest.fixture
+def advertisement(bluez):
+    advertisement = Advertisement(bluez.bus, 0, 'peripheral', None)
+    advertisement.add_service_uuid(SERVICE_UUID)
+    advertisement.events = []
+    advertisement.add_listener(lambda _, event: advertisement.events.append(event))
+    return advertisement
+
+
+def test_bluez_gets_the_planned_payload(advertisement, bluez):
+    advertisement.add_local_name('provisioning-device-with-a-long-name')
+    advertisement.set_interval(20, 30)
+    advertisement.start_advertisement()
+    assert run_until(lambda: advertisement.events == ['registered'])
+    properties = bluez.control.Advertisement(advertisement.get_path())
+    assert list(properties['ServiceUUIDs']) == [SERVICE_UUID]
+    # The legacy scan response leaves room for 29 bytes of name
+    assert properties['LocalName'] == 'provisioning-device-with-a-lo'
+    assert (properties['MinInterval'], properties['MaxInterval']) == (20, 30)
+    assert 'SecondaryChannel' not in properties
+
+
+def test_registered_callbacks_run_once(advertisement):
+    calls = []
+    advertisement.add_registered_callback(lambda: calls.append(advertisement.active))
+    advertisement.start_advertisement()
+    assert run_until(lambda: advertisement.events == ['registered'])
+    advertisement.stop_advertisement()
+    advertisement.start_advertisement()
+    assert run_until(lambda: advertisement.events == ['registered', 'registered'])
+    assert calls == [True]
+
+
+def test_bluez_errors_are_reported(advertisement, bluez):
+    bluez.control.FailNext('RegisterAdvertisement', 1)
+    advertisement.start_advertisement()
+    assert run_until(lambda: advertisement.events == ['failed'])
+    assert not advertisement.active
+
+
+def test_release_is_reported_while_active(advertisement):
+    advertisement.Release()
+    assert advertisement.events == []
+    advertisement.start_advertisement()
+    assert run_until(lambda: advertisement.events == ['registered'])
+    advertisement.Release()
+    assert advertisement.events == ['registered', 'released']
+    assert not advertisement.active
+
+
+def test_payload_that_cannot_fit_is_not_registered(advertisement, bluez):
+    advertisement.add_manufacturer_data(0xFFFF, bytes(27))
+    advertisement.add_service_data('180f', bytes(20))
+    advertisement.start_advertisement()
+    assert advertisement.events == ['invalid']
+    assert not advertisement.active
+    assert bluez.calls('RegisterAdvertisement') == []
@@ -0,0 +1,220 @@
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+import gatt_server  # noqa: E402
+from gatt_server import AdvertisingController, InvalidArgsException  # noqa: E402
+
+
+class FakeAdvertisement:
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.timeout = timeout
+        self.active = False
+        self.listeners = []
+        self.registered_callbacks = []
+        self.log = []
+
+    def get_path(self):
+        return self.name
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def add_registered_callback(self, callback):
+        self.registered_callbacks.append(callback)
+
+    def start_advertisement(self):
+        self.active = True
+        self.log.append('start')
+
+    def stop_advertisement(self):
+        self.active = False
+        self.log.append('stop')
+
+    def event(self, event):
+        if event == 'registered':
+            callbacks, self.registered_callbacks = self.registered_callbacks, []
+            for callback in callbacks:
+                callback()
+        else:
+            self.active = False
+        for callback in self.listeners:
+            callback(self, event)
+
+
+class ManualScheduler:
+    """
+    Collects scheduled calls; tests run them with fire().
+    """
+    class Call:
+        def __init__(self, delay, callback, args):
+            self.delay = delay
+            self.callback = callback
+            self.args = args
+            self.cancelled = False
+
+        def cancel(self):
+            self.cancelled = True
+
+    def __init__(self):
+        self.calls = []
+
+    def schedule(self, delay, callback, *args):
+        call = self.Call(delay, callback, args)
+        self.calls.append(call)
+        return call
+
+    def pending(self):
+        return [call for call in self.calls if not call.cancelled]
+
+    def fire(self):
+        call, = self.pending()
+        call.cancel()
+        call.callback(*call.args)
+        return call.delay
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = ManualScheduler()
+    monkeypatch.setattr(gatt_server, 'scheduler', scheduler)
+    return scheduler
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(gatt_server.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def phases():
+    return [FakeAdvertisement('fast'), FakeAdvertisement('slow')]
+
+
+@pytest.fixture
+def controller(phases, scheduler, clock):
+    return AdvertisingController([(phases[0], 30), (phases[1], None)])
+
+
+def test_needs_a_phase():
+    with pytest.raises(InvalidArgsException):
+        AdvertisingController([])
+
+
+def test_phases_rotate_after_registration(controller, phases, scheduler):
+    fast, slow = phases
+    controller.start()
+    assert controller.current() is fast and fast.active
+    assert scheduler.pending() == []
+    fast.event('registered')
+    assert scheduler.fire() == 30
+    assert controller.current() is slow
+    # The next phase is registered before the previous one is dropped
+    assert (fast.log, slow.log) == (['start', 'stop'], ['start'])
+    slow.event('registered')
+    assert scheduler.pending() == []
+
+
+def test_last_timed_phase_halts(phases, scheduler, clock):
+    fast = phases[0]
+    controller = AdvertisingController([(fast, 30)])
+    controller.start()
+    fast.event('registered')
+    scheduler.fire()
+    assert controller.current() is None and not controller.running
+    assert fast.log == ['start', 'stop']
+
+
+def test_release_at_the_timeout_moves_on(phases, scheduler, clock):
+    fast, slow = FakeAdvertisement('fast', timeout=30), phases[1]
+    controller = AdvertisingController([(fast, 30), (slow, None)])
+    controller.start()
+    fast.event('registered')
+    fast.event('released')
+    assert controller.current() is slow
+    assert scheduler.pending() == []
+
+
+def test_failures_retry_with_backoff(controller, phases, scheduler):
+    fast = phases[0]
+    controller.start()
+    delays = []
+    for _ in range(8):
+        fast.event('failed')
+        delays.append(scheduler.fire())
+    assert delays == [1, 2, 4, 8, 16, 32, 60, 60]
+    assert fast.active
+    fast.event('registered')
+    scheduler.fire()
+    controller.phases[1].advertisement.event('failed')
+    assert scheduler.pending()[0].delay == 1
+
+
+def test_payload_that_cannot_fit_skips_the_phase(controller, phases, scheduler):
+    fast, slow = phases
+    controller.start()
+    fast.event('invalid')
+    assert scheduler.pending() == []
+    assert controller.current() is slow
+    slow.event('invalid')
+    assert scheduler.pending() == []
+    assert controller.current() is None and not controller.running
+
+
+def test_events_from_other_phases_are_ignored(controller, phases, scheduler):
+    controller.start()
+    phases[1].event('failed')
+    assert scheduler.pending() == []
+
+
+def test_registered_callback_runs_once(controller, phases):
+    calls = []
+    controller.add_registered_callback(lambda: calls.append('up'))
+    controller.start()
+    phases[0].event('registered')
+    controller.restart()
+    phases[0].event('registered')
+    assert calls == ['up']
+
+
+def test_restarts_are_rate_limited_and_coalesced(controller, phases, scheduler, clock):
+    fast, slow = phases
+    controller.start()
+    controller.restart()
+    assert fast.log == ['start', 'stop', 'start']
+    clock.now += 2
+    controller.restart()
+    controller.restart()
+    restart, = scheduler.pending()
+    assert restart.delay == pytest.approx(3)
+    assert fast.log == ['start', 'stop', 'start']
+    clock.now += 3
+    scheduler.fire()
+    assert fast.log == ['start', 'stop', 'start', 'stop', 'start']
+
+
+def test_stop_cancels_everything_and_blocks_restarts(controller, phases, scheduler, clock):
+    fast = phases[0]
+    controller.start()
+    controller.restart()
+    controller.restart()
+    controller.stop()
+    assert scheduler.pending() == []
+    assert not fast.active and controller.current() is None
+    clock.now += 60
+    controller.restart()
+    assert fast.log == ['start', 'stop', 'start', 'stop']
+    controller.start()
+    assert fast.active
@@ -0,0 +1,42 @@
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+
+
+@pytest.fixture
+def daemon(bluez, scheduler):
+    from ble_characteristic_trigger import AdvertisingDaemon
+    from fake_wifi import FakeWifiBackend
+
+    daemon = AdvertisingDaemon(bluez.bus)
+    daemon.wpa_service.wpa_characteristic.wifi_manager._backend = FakeWifiBackend()
+    daemon.start()
+    assert run_until(lambda: bluez.calls('RegisterApplication') == ['/'])
+    yield daemon
+    daemon.stop_advertising()
+
+
+def adapter_open(bluez):
+    return bool(bluez.adapter_property('Discoverable')), bool(bluez.adapter_property('Pairable'))
+
+
+def test_adapter_is_only_open_while_advertising(daemon, bluez):
+    assert adapter_open(bluez) == (False, False)
+    daemon.start_advertising()
+    assert run_until(lambda: adapter_open(bluez) == (True, True))
+    assert bluez.adapter_property('DiscoverableTimeout') == 0
+    daemon.stop_advertising()
+    assert run_until(lambda: adapter_open(bluez) == (False, False))
+
+
+def test_stop_before_registration_leaves_the_adapter_closed(daemon, bluez):
+    advertisement = daemon.advertising.phases[0].advertisement
+    daemon.start_advertising()
+    daemon.stop_advertising()
+    assert advertisement.configure_adapter not in advertisement.registered_callbacks
+    assert advertisement.adapter_ready is None
+    run_until(lambda: False, timeout=0.2)
+    assert adapter_open(bluez) == (False, False)
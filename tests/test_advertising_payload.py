@@ -0,0 +1,84 @@
+import pytest
+
+from advertising_payload import (
+    AD_HEADER_SIZE, FLAGS_SIZE, LEGACY_ADV_LENGTH, TX_POWER_SIZE, plan_payload, shorten_name, uuid_length,
+    uuid_list_size,
+)
+
+
+SERVICE_UUID = '00001801-0000-1000-9000-00805f9b34fb'
+
+
+def test_uuid_length():
+    assert uuid_length('180f') == 2
+    assert uuid_length('0000180f-0000-1000-8000-00805f9b34fb') == 2
+    assert uuid_length('1234180f-0000-1000-8000-00805f9b34fb') == 4
+    assert uuid_length(SERVICE_UUID) == 16
+
+
+def test_uuid_list_size_groups_by_width():
+    assert uuid_list_size(['180f', '180a', SERVICE_UUID]) == AD_HEADER_SIZE + 4 + AD_HEADER_SIZE + 16
+    assert uuid_list_size(None) == 0
+
+
+def test_shorten_name_keeps_whole_characters():
+    assert shorten_name('héllo', 2) == 'h'
+    assert shorten_name('hello', 0) == ''
+
+
+def test_legacy_layout_puts_name_in_scan_response():
+    plan = plan_payload(service_uuids=[SERVICE_UUID], local_name='raspberrypi')
+    assert plan.adv == ('flags', 'service_uuids')
+    assert plan.scan_response == ('local_name',)
+    assert plan.adv_size == FLAGS_SIZE + AD_HEADER_SIZE + 16
+    assert plan.local_name == 'raspberrypi'
+    assert not plan.name_shortened
+    assert not plan.extended
+
+
+def test_data_moves_to_scan_response_when_adv_is_full():
+    plan = plan_payload(service_uuids=[SERVICE_UUID], manufacturer_data={0xFFFF: b'x' * 8}, local_name='pi')
+    assert 'manufacturer_data' in plan.scan_response
+    assert plan.scan_response_size <= LEGACY_ADV_LENGTH
+
+
+def test_data_stays_in_adv_when_it_fits():
+    plan = plan_payload(manufacturer_data={0xFFFF: b'x' * 4}, include_tx_power=True)
+    assert plan.adv == ('flags', 'tx_power', 'manufacturer_data')
+    assert plan.adv_size == FLAGS_SIZE + TX_POWER_SIZE + AD_HEADER_SIZE + 2 + 4
+
+
+def test_long_name_is_shortened_to_the_space_left():
+    plan = plan_payload(service_uuids=[SERVICE_UUID], local_name='n' * 40)
+    assert plan.name_shortened
+    assert len(plan.local_name) == LEGACY_ADV_LENGTH - AD_HEADER_SIZE
+    assert plan.scan_response_size == LEGACY_ADV_LENGTH
+
+
+def test_broadcast_has_no_flags():
+    plan = plan_payload(service_uuids=['180f'], include_flags=False)
+    assert plan.adv == ('service_uuids',)
+
+
+def test_extended_layout_uses_one_pdu():
+    plan = plan_payload(service_uuids=[SERVICE_UUID], manufacturer_data={0xFFFF: b'x' * 40}, local_name='n' * 40,
+                        max_adv_length=251)
+    assert plan.extended
+    assert plan.scan_response == ()
+    assert plan.adv == ('flags', 'service_uuids', 'manufacturer_data', 'local_name')
+    assert not plan.name_shortened
+
+
+def test_required_fields_that_do_not_fit_raise():
+    with pytest.raises(ValueError):
+        plan_payload(service_uuids=[SERVICE_UUID, '12345678-0000-1000-9000-00805f9b34fb'])
+
+
+def test_optional_fields_that_do_not_fit_raise():
+    with pytest.raises(ValueError):
+        plan_payload(service_data={'180f': b'x' * 40})
+
+
+def test_no_room_for_name_raises():
+    with pytest.raises(ValueError):
+        plan_payload(manufacturer_data={0xFFFF: b'x' * 24, 0xFFFE: b'y' * 25}, local_name='pi')
@@ -0,0 +1,109 @@
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+from gatt_server import (  # noqa: E402
+    Application, Characteristic, CUDDiscriptor, Descriptor, InvalidArgsException, NotFoundException, Service,
+)
+
+
+class ValueCharacteristic(Characteristic):
+    DESCRIPTORS = [CUDDiscriptor]
+
+    def __init__(self, bus, index, service):
+        super().__init__(bus, index, '00002a00-0000-1000-8000-00805f9b34fb', ['read', 'write'], service)
+
+
+class OtherCharacteristic(Characteristic):
+    DESCRIPTORS = [CUDDiscriptor]
+
+    def __init__(self, bus, index, service):
+        super().__init__(bus, index, '00002a01-0000-1000-8000-00805f9b34fb', ['read'], service)
+
+
+class TestService(Service):
+    __test__ = False
+    CHARACTERISTICS = [ValueCharacteristic]
+
+    def __init__(self, bus, index, uuid='00001800-0000-1000-8000-00805f9b34fb'):
+        super().__init__(bus, index, uuid)
+
+
+@pytest.fixture
+def application(bluez):
+    application = Application(bluez.bus, None)
+    application.add_service(TestService(bluez.bus, 0))
+    return application
+
+
+def test_managed_objects_are_built_once(application):
+    objects = application.GetManagedObjects()
+    assert application.GetManagedObjects() is objects
+    assert sorted(objects) == ['/org/bluez/ble/service/0', '/org/bluez/ble/service/0/char1',
+                               '/org/bluez/ble/service/0/char1/descriptor1']
+
+
+def test_adding_a_service_invalidates_the_tree(application, bluez):
+    objects = application.GetManagedObjects()
+    application.add_service(TestService(bluez.bus, 1, uuid='180f'))
+    assert application.GetManagedObjects() is not objects
+    assert '/org/bluez/ble/service/1' in application.GetManagedObjects()
+
+
+def test_adding_a_characteristic_invalidates_the_tree(application, bluez):
+    objects = application.GetManagedObjects()
+    service = application.services[0]
+    service.add_characteristic(OtherCharacteristic(bluez.bus, 2, service))
+    assert '/org/bluez/ble/service/0/char2' in application.GetManagedObjects()
+    assert application.GetManagedObjects() is not objects
+
+
+def test_adding_a_descriptor_invalidates_the_tree(application, bluez):
+    objects = application.GetManagedObjects()
+    characteristic = application.services[0].characteristics[0]
+    characteristic.add_descriptor(Descriptor(bluez.bus, 2, '2904', ['read'], characteristic))
+    assert '/org/bluez/ble/service/0/char1/descriptor2' in application.GetManagedObjects()
+    assert application.GetManagedObjects() is not objects
+
+
+def test_bluez_reads_the_tree_on_registration(application, bluez):
+    application.register_application()
+    assert run_until(lambda: bluez.calls('RegisterApplication') == ['/'])
+    registered = bluez.control.Application('/')
+    assert sorted(registered) == sorted(application.GetManagedObjects())
+    assert registered['/org/bluez/ble/service/0']['org.bluez.GattService1']['UUID'] == \
+        '00001800-0000-1000-8000-00805f9b34fb'
+
+
+def test_objects_are_looked_up_by_path_and_uuid(application):
+    service = application.services[0]
+    characteristic = service.characteristics[0]
+    assert application.get_object('/org/bluez/ble/service/0/char1') is characteristic
+    assert application.get_service('00001800-0000-1000-8000-00805f9b34fb') is service
+    assert service.get_characteristic(characteristic.uuid) is characteristic
+    assert characteristic.get_descriptor(CUDDiscriptor.CUD_UUID) is characteristic.descriptors[0]
+    with pytest.raises(NotFoundException):
+        application.get_object('/org/bluez/ble/service/0/char9')
+    with pytest.raises(NotFoundException):
+        application.get_service('180f')
+
+
+def test_index_is_rebuilt_after_a_change(application, bluez):
+    application.get_service('00001800-0000-1000-8000-00805f9b34fb')
+    application.add_service(TestService(bluez.bus, 1, uuid='180f'))
+    assert application.get_service('180f') is application.services[1]
+
+
+def test_duplicate_characteristic_uuid_is_rejected(application, bluez):
+    service = application.services[0]
+    with pytest.raises(InvalidArgsException):
+        service.add_characteristic(ValueCharacteristic(bluez.bus, 2, service))
+
+
+def test_invalid_tree_is_not_registered(application, bluez):
+    application.add_service(TestService(bluez.bus, 1))
+    with pytest.raises(InvalidArgsException, match="Duplicate service UUID"):
+        application.register_application()
+    assert bluez.calls('RegisterApplication') == []
@@ -0,0 +1,61 @@
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+from gatt_common import GATT_ADAPTER_IFACE, GATT_DEVICE_IFACE  # noqa: E402
+from gatt_server import get_object_cache  # noqa: E402
+
+
+ADDRESS = 'AA:AA:AA:AA:AA:01'
+
+
+@pytest.fixture
+def cache(bluez):
+    cache = get_object_cache(bluez.bus)
+    cache.events = []
+    cache.add_listener(lambda path, connected: cache.events.append((path, connected)))
+    return cache
+
+
+def test_cache_is_shared_per_bus(bluez, cache):
+    assert get_object_cache(bluez.bus) is cache
+
+
+def test_initial_tree_is_loaded(cache, bluez):
+    assert cache.find_adapter() == bluez.adapter_path
+    assert cache.get_properties(bluez.adapter_path, GATT_ADAPTER_IFACE)['Powered']
+    assert cache.get_paths(GATT_DEVICE_IFACE) == []
+
+
+def test_added_device_is_tracked(cache, bluez):
+    path = str(bluez.control.AddDevice(ADDRESS, True))
+    assert run_until(lambda: cache.get_connected_devices() == [path])
+    assert cache.get_properties(path, GATT_DEVICE_IFACE)['Address'] == ADDRESS
+    assert cache.events == [(path, True)]
+
+
+def test_properties_changed_updates_connection_state(cache, bluez):
+    path = str(bluez.control.AddDevice(ADDRESS, False))
+    assert run_until(lambda: cache.get_paths(GATT_DEVICE_IFACE) == [path])
+    assert cache.events == []
+    bluez.control.SetConnected(path, True)
+    assert run_until(lambda: cache.events == [(path, True)])
+    bluez.control.SetConnected(path, False)
+    assert run_until(lambda: cache.events == [(path, True), (path, False)])
+    assert not cache.get_properties(path, GATT_DEVICE_IFACE)['Connected']
+
+
+def test_adapter_property_changes_are_cached(cache, bluez):
+    bluez.adapter_props.Set(GATT_ADAPTER_IFACE, 'Discoverable', True)
+    assert run_until(lambda: cache.get_properties(bluez.adapter_path, GATT_ADAPTER_IFACE)['Discoverable'])
+
+
+def test_removed_device_is_dropped(cache, bluez):
+    path = str(bluez.control.AddDevice(ADDRESS, True))
+    assert run_until(lambda: cache.get_connected_devices() == [path])
+    bluez.control.RemoveDevice(path)
+    assert run_until(lambda: cache.get_paths(GATT_DEVICE_IFACE) == [])
+    assert cache.get_connected_devices() == []
+    assert cache.events == [(path, True), (path, False)]
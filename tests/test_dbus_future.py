@@ -0,0 +1,72 @@
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+from gatt_common import GATT_ADAPTER_IFACE  # noqa: E402
+from gatt_server import CancelledException, DBusFuture, FailedException, call_async, gather  # noqa: E402
+
+
+def test_callbacks_run_on_completion_and_when_added_late():
+    future = DBusFuture("call")
+    seen = []
+    future.add_done_callback(lambda f: seen.append(f.result()))
+    with pytest.raises(FailedException):
+        future.result()
+    future.set_result(1, 2)
+    future.add_done_callback(lambda f: seen.append(f.result()))
+    assert seen == [(1, 2), (1, 2)]
+
+
+def test_first_completion_wins():
+    future = DBusFuture("call")
+    future.cancel()
+    future.set_result(1)
+    assert future.cancelled()
+    with pytest.raises(CancelledException):
+        future.result()
+
+
+def test_failing_callback_does_not_stop_the_others():
+    future = DBusFuture("call")
+    seen = []
+    future.add_done_callback(lambda f: 1 / 0)
+    future.add_done_callback(lambda f: seen.append(f.result()))
+    future.set_result()
+    assert seen == [None]
+
+
+def test_gather_collects_results_in_order():
+    first, second = DBusFuture("first"), DBusFuture("second")
+    combined = gather(first, second)
+    second.set_result('b')
+    assert not combined.done()
+    first.set_result('a')
+    assert combined.result() == ['a', 'b']
+    assert gather().result() == []
+
+
+def test_gather_waits_for_all_and_reports_the_first_error():
+    first, second = DBusFuture("first"), DBusFuture("second")
+    combined = gather(first, second)
+    error = FailedException("first failed")
+    first.set_exception(error)
+    assert not combined.done()
+    second.set_exception(FailedException("second failed"))
+    assert combined.exception() is error
+
+
+def test_call_async_does_not_block(bluez):
+    props = dbus.Interface(bluez.bus.get_object('org.bluez', bluez.adapter_path), 'org.freedesktop.DBus.Properties')
+    future = call_async(props.Get, GATT_ADAPTER_IFACE, 'Address')
+    assert not future.done()
+    assert run_until(future.done)
+    assert future.result() == '00:11:22:33:44:55'
+
+
+def test_call_async_reports_errors(bluez):
+    adapter = dbus.Interface(bluez.bus.get_object('org.bluez', bluez.adapter_path), GATT_ADAPTER_IFACE)
+    future = call_async(adapter.RemoveDevice, dbus.ObjectPath(bluez.adapter_path + '/dev_00'))
+    assert run_until(future.done)
+    assert future.exception().get_dbus_name() == 'org.bluez.Error.Failed'
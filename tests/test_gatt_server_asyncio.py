@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("dbus_fast")
+
+from dbus_fast import Message, MessageType  # noqa: E402
+from dbus_fast.aio import MessageBus  # noqa: E402
+
+from gatt_common import (  # noqa: E402
+    DBUS_OM_IFACE, DBUS_PROPERTIES_IFACE, GATT_ADVERTISEMENT_IFACE, GATT_CHARACTERISTIC_IFACE,
+    GATT_DESCRIPTOR_IFACE, GATT_SERVICE_IFACE,
+)
+from gatt_server_asyncio import (  # noqa: E402
+    Advertisement, Application, Characteristic, CUDDescriptor, Service, serve,
+)
+
+
+SERVICE_UUID = '12345678-1234-5678-1234-56789abcdef0'
+CHARACTERISTIC_UUID = '12345678-1234-5678-1234-56789abcdef1'
+
+
+class ValueCharacteristic(Characteristic):
+    DESCRIPTORS = [CUDDescriptor]
+
+    def __init__(self, bus, index, service):
+        super().__init__(bus, index, CHARACTERISTIC_UUID, ['read', 'notify'], service)
+        self.value = b'hello'
+
+    async def read_value(self, options):
+        return self.value[options.get('offset', 0):]
+
+
+class TestService(Service):
+    __test__ = False
+    CHARACTERISTICS = [ValueCharacteristic]
+
+    def __init__(self, bus, index):
+        super().__init__(bus, index, SERVICE_UUID)
+
+
+async def call(bus, destination, path, interface, member, signature='', body=()):
+    reply = await bus.call(Message(destination=destination, path=path, interface=interface, member=member,
+                                   signature=signature, body=list(body)))
+    assert reply.message_type == MessageType.METHOD_RETURN, reply.body
+    return reply.body[0] if reply.body else None
+
+
+def unwrap(properties):
+    return {name: variant.value for name, variant in properties.items()}
+
+
+def build(bus):
+    application = Application(bus)
+    application.add_service(TestService(bus, 0))
+    advertisement = Advertisement(bus, 0, 'peripheral', 'RPi-WiFi-Config')
+    advertisement.add_service_uuid(SERVICE_UUID)
+    advertisement.add_manufacturer_data(0xffff, b'\x01\x02')
+    return application, advertisement
+
+
+def test_exported_tree_is_served_to_other_clients(bus_address):
+    async def scenario():
+        server = await MessageBus(bus_address=bus_address).connect()
+        client = await MessageBus(bus_address=bus_address).connect()
+        application, advertisement = build(server)
+        application.export()
+
+        objects = await call(client, server.unique_name, '/', DBUS_OM_IFACE, 'GetManagedObjects')
+        service_path = '/org/bluez/ble/service/0'
+        char_path = service_path + '/char1'
+        assert set(objects) == {service_path, char_path, char_path + '/descriptor1'}
+        assert unwrap(objects[service_path][GATT_SERVICE_IFACE]) == {
+            'UUID': SERVICE_UUID, 'Primary': True, 'Characteristics': [char_path]}
+        assert unwrap(objects[char_path][GATT_CHARACTERISTIC_IFACE])['Flags'] == ['read', 'notify']
+        assert unwrap(objects[char_path + '/descriptor1'][GATT_DESCRIPTOR_IFACE])['UUID'] == '2901'
+
+        value = await call(client, server.unique_name, char_path, GATT_CHARACTERISTIC_IFACE, 'ReadValue',
+                           'a{sv}', [{}])
+        assert value == b'hello'
+
+        advertisement.plan_payload()
+        server.export(advertisement.path, advertisement)
+        properties = unwrap(await call(client, server.unique_name, advertisement.path, DBUS_PROPERTIES_IFACE,
+                                       'GetAll', 's', [GATT_ADVERTISEMENT_IFACE]))
+        assert properties['Type'] == 'peripheral'
+        assert properties['LocalName'] == 'RPi-WiFi-Config'
+        assert properties['ServiceUUIDs'] == [SERVICE_UUID]
+        assert {key: value.value for key, value in properties['ManufacturerData'].items()} == {0xffff: b'\x01\x02'}
+
+        application.unexport()
+        objects = await call(client, server.unique_name, '/', DBUS_OM_IFACE, 'GetManagedObjects')
+        assert service_path not in objects
+        server.disconnect()
+        client.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_serve_registers_with_bluez_and_tears_down(bluez, bus_address):
+    async def scenario():
+        bus = await MessageBus(bus_address=bus_address).connect()
+        application, advertisement = build(bus)
+        stop_event = asyncio.Event()
+        task = asyncio.create_task(serve(application, advertisement, stop_event))
+        while not advertisement.registered:
+            assert not task.done(), task.exception()
+            await asyncio.sleep(0.01)
+        # The fake read both over the bus before replying
+        registered = bluez.control.Application('/'), bluez.control.Advertisement(advertisement.path)
+        stop_event.set()
+        await task
+        bus.disconnect()
+        return application, advertisement, registered
+
+    application, advertisement, (objects, properties) = asyncio.run(scenario())
+    assert '/org/bluez/ble/service/0/char1' in objects
+    assert str(properties['LocalName']) == 'RPi-WiFi-Config'
+    assert bluez.calls('RegisterApplication') == bluez.calls('UnregisterApplication') == ['/']
+    assert bluez.calls('RegisterAdvertisement') == bluez.calls('UnregisterAdvertisement') == [advertisement.path]
+    assert not application.exported and not advertisement.registered
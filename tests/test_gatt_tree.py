@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import pytest
+
+from gatt_common import index_gatt_tree
+
+
+def descriptor(path, uuid='2901', flags=('read',)):
+    return SimpleNamespace(path=path, uuid=uuid, flags=list(flags))
+
+
+def characteristic(path, uuid='00001801-0000-1000-6000-00805f9b34fb', flags=('read', 'notify'), descriptors=None):
+    if descriptors is None:
+        descriptors = [descriptor(path + '/desc1')]
+    return SimpleNamespace(path=path, uuid=uuid, flags=list(flags), descriptors=descriptors)
+
+
+def service(path, uuid='00001800-0000-1000-6000-00805f9b34fb', characteristics=None):
+    if characteristics is None:
+        characteristics = [characteristic(path + '/char1')]
+    return SimpleNamespace(path=path, uuid=uuid, characteristics=characteristics)
+
+
+def test_tree_is_indexed_by_path_and_uuid():
+    first = service('/service0')
+    second = service('/service1', uuid='180f')
+    objects_by_path, services_by_uuid = index_gatt_tree([first, second])
+    assert services_by_uuid == {first.uuid: first, '180f': second}
+    assert set(objects_by_path) == {'/service0', '/service0/char1', '/service0/char1/desc1',
+                                    '/service1', '/service1/char1', '/service1/char1/desc1'}
+    assert objects_by_path['/service0/char1/desc1'] is first.characteristics[0].descriptors[0]
+
+
+def test_duplicate_service_uuid():
+    with pytest.raises(ValueError, match="Duplicate service UUID"):
+        index_gatt_tree([service('/service0'), service('/service1')])
+
+
+def test_duplicate_path():
+    with pytest.raises(ValueError, match="Duplicate object path /service0"):
+        index_gatt_tree([service('/service0'), service('/service0', uuid='180f')])
+
+
+@pytest.mark.parametrize('uuid', ['18', '0000180g', '00001800-0000-1000-8000-00805f9b34f'])
+def test_invalid_uuid(uuid):
+    with pytest.raises(ValueError, match="Invalid UUID"):
+        index_gatt_tree([service('/service0', characteristics=[characteristic('/service0/char1', uuid=uuid)])])
+
+
+def test_invalid_characteristic_flags():
+    with pytest.raises(ValueError, match=r"Invalid flags \['sing'\] at /service0/char1$"):
+        index_gatt_tree([service('/service0', characteristics=[
+            characteristic('/service0/char1', flags=('read', 'sing'))])])
+
+
+def test_descriptors_cannot_notify():
+    with pytest.raises(ValueError, match="Invalid flags \\['notify'\\]"):
+        index_gatt_tree([service('/service0', characteristics=[characteristic('/service0/char1', descriptors=[
+            descriptor('/service0/char1/desc1', flags=('read', 'notify'))])])])
+
+
+def test_empty_service_and_characteristic():
+    with pytest.raises(ValueError, match="Service /service0 has no characteristics"):
+        index_gatt_tree([service('/service0', characteristics=[])])
+    with pytest.raises(ValueError, match="Characteristic /service0/char1 has no descriptors"):
+        index_gatt_tree([service('/service0', characteristics=[characteristic('/service0/char1', descriptors=[])])])
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from wpa_codec import FORMAT_BINARY, MSG_KNOWN  # noqa: E402
+
+
+DEVICE = '/org/bluez/hci0/dev_AA_AA_AA_AA_AA_01'
+PSK = 'ab' * 32
+OPTIONS = {'device': dbus.ObjectPath(DEVICE)}
+
+
+@pytest.fixture
+def known(wpa_service):
+    store = wpa_service.wpa_characteristic.wifi_manager.store
+    store.remember('home', PSK, '00:11:22:33:44:55', 6, 'uuid-1')
+    return wpa_service.known_networks_characteristic
+
+
+def write(characteristic, payload):
+    characteristic.WriteValue([dbus.Byte(b) for b in json.dumps(payload).encode('utf-8')], OPTIONS)
+
+
+def test_read_lists_networks_without_psks(known):
+    value = bytes(known.ReadValue(OPTIONS))
+    networks = json.loads(value)
+    assert [network['ssid'] for network in networks] == ['home']
+    assert PSK not in value.decode('utf-8')
+
+
+def test_read_follows_the_session_format(wpa_service, known):
+    wpa_service.wpa_characteristic.set_format(wpa_service.wpa_characteristic.get_session(OPTIONS), FORMAT_BINARY)
+    assert bytes(known.ReadValue(OPTIONS))[0] == MSG_KNOWN
+
+
+def test_forget(wpa_service, known):
+    write(known, {"command": "forget", "ssid": "home"})
+    assert json.loads(bytes(known.ReadValue(OPTIONS))) == []
+    assert wpa_service.wpa_characteristic.wifi_manager.backend.deleted == ['uuid-1']
+
+
+@pytest.mark.parametrize('payload', [{"command": "forget"}, {"command": "drop", "ssid": "home"},
+                                     {"command": "forget", "ssid": "office"}])
+def test_bad_commands_are_rejected(known, payload):
+    with pytest.raises(dbus.exceptions.DBusException):
+        write(known, payload)
@@ -0,0 +1,142 @@
+import json
+import os
+import stat
+
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from gi.repository import GLib  # noqa: E402
+
+import network_store  # noqa: E402
+from network_store import NetworkStore, PmkCache, derive_pmk, is_psk_hash  # noqa: E402
+
+
+# IEEE 802.11i-2004 H.4 test vector
+IEEE_PSK = 'f42c6fc52df0ebef9ebb4b90b38a5f902e83fe1b135a70e23aed762e9710a12e'
+PSK_HASH = 'ab' * 32
+
+
+def wait_for(future):
+    context = GLib.MainContext.default()
+    while not future.done():
+        context.iteration(True)
+    return future.result()
+
+
+def test_is_psk_hash():
+    assert is_psk_hash(IEEE_PSK)
+    assert is_psk_hash(IEEE_PSK.upper())
+    assert not is_psk_hash(IEEE_PSK[:-1])
+    assert not is_psk_hash('g' * 64)
+
+
+def test_derive_pmk_matches_test_vector():
+    assert derive_pmk('IEEE', 'password') == IEEE_PSK
+
+
+def test_get_derives_once(monkeypatch):
+    calls = []
+
+    def counting_derive(ssid, psk):
+        calls.append((ssid, psk))
+        return derive_pmk(ssid, psk)
+
+    monkeypatch.setattr(network_store, 'derive_pmk', counting_derive)
+    cache = PmkCache()
+    assert cache.get('IEEE', 'password') == IEEE_PSK
+    assert cache.get('IEEE', 'password') == IEEE_PSK
+    assert len(calls) == 1
+
+
+def test_get_passes_hashes_through():
+    assert PmkCache().get('home', IEEE_PSK.upper()) == IEEE_PSK
+
+
+def test_cache_keeps_the_most_recent_entries():
+    cache = PmkCache(size=2)
+    for ssid in ('a', 'b'):
+        cache.store(cache.key(ssid, 'password'), ssid)
+    cache.lookup(cache.key('a', 'password'))
+    cache.store(cache.key('c', 'password'), 'c')
+    assert cache.lookup(cache.key('a', 'password')) == 'a'
+    assert cache.lookup(cache.key('b', 'password')) is None
+    assert cache.lookup(cache.key('c', 'password')) == 'c'
+
+
+def test_cache_keys_do_not_hold_the_passphrase():
+    ssid, digest = PmkCache().key('home', 'password')
+    assert ssid == 'home'
+    assert b'password' not in digest
+
+
+def test_derive_runs_off_the_main_loop_and_shares_pending_requests():
+    cache = PmkCache()
+    first = cache.derive('IEEE', 'password')
+    second = cache.derive('IEEE', 'password')
+    assert first is second
+    assert wait_for(first) == IEEE_PSK
+    assert cache.lookup(cache.key('IEEE', 'password')) == IEEE_PSK
+    # Answered from the cache
+    assert cache.derive('IEEE', 'password').done()
+
+
+def test_derive_completes_hashes_immediately():
+    future = PmkCache().derive('home', IEEE_PSK)
+    assert future.done()
+    assert future.result() == IEEE_PSK
+
+
+def test_store_round_trip(tmp_path):
+    path = str(tmp_path / 'state' / 'networks.json')
+    store = NetworkStore(path)
+    store.remember('home', PSK_HASH, 'aa:bb:cc:dd:ee:ff', 6, 'uuid-1', hidden=True)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    loaded = NetworkStore(path).get('home')
+    assert (loaded.psk_hash, loaded.bssid, loaded.channel, loaded.profile, loaded.hidden) == \
+        (PSK_HASH, 'aa:bb:cc:dd:ee:ff', 6, 'uuid-1', True)
+
+
+def test_remember_keeps_details_for_the_same_psk(tmp_path):
+    store = NetworkStore(str(tmp_path / 'networks.json'))
+    store.remember('home', PSK_HASH, 'aa:bb:cc:dd:ee:ff', 6, 'uuid-1')
+    store.remember('home', PSK_HASH)
+    assert store.get('home').profile == 'uuid-1'
+    store.remember('home', 'cd' * 32)
+    assert store.get('home').profile is None
+    assert store.get('home').bssid is None
+
+
+def test_list_is_most_recent_first(tmp_path, monkeypatch):
+    store = NetworkStore(str(tmp_path / 'networks.json'))
+    for now, ssid in enumerate(('old', 'new'), start=1):
+        monkeypatch.setattr(network_store.time, 'time', lambda: now)
+        store.remember(ssid, PSK_HASH)
+    assert [network.ssid for network in store.list()] == ['new', 'old']
+
+
+def test_forget(tmp_path):
+    path = str(tmp_path / 'networks.json')
+    store = NetworkStore(path)
+    store.remember('home', PSK_HASH)
+    assert store.forget('home').ssid == 'home'
+    assert store.forget('home') is None
+    assert NetworkStore(path).get('home') is None
+
+
+def test_load_skips_malformed_records(tmp_path):
+    path = tmp_path / 'networks.json'
+    path.write_text(json.dumps([
+        {"ssid": "home", "psk_hash": PSK_HASH, "bssid": None, "channel": None, "profile": None,
+         "last_connected": 1},
+        {"ssid": "broken"},
+    ]))
+    store = NetworkStore(str(path))
+    assert [network.ssid for network in store.list()] == ['home']
+
+
+def test_load_survives_corrupt_files(tmp_path):
+    path = tmp_path / 'networks.json'
+    path.write_text('{not json')
+    assert NetworkStore(str(path)).list() == []
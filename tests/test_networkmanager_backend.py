@@ -0,0 +1,312 @@
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+import dbus.service  # noqa: E402
+from gi.repository import GLib  # noqa: E402
+
+from conftest import run_until  # noqa: E402
+from gatt_server import DBUS_PROPERTIES_IFACE  # noqa: E402
+from wifi_backends import (  # noqa: E402
+    NM_ACCESS_POINT_IFACE, NM_ACTIVE_CONNECTION_IFACE, NM_DEVICE_IFACE, NM_IFACE, NM_IP4_CONFIG_IFACE, NM_PATH,
+    NM_SERVICE_NAME, NM_SETTINGS_CONNECTION_IFACE, NM_SETTINGS_IFACE, NM_SETTINGS_PATH,
+    NM_SETTINGS_UPDATE2_FLAG_TO_DISK, NM_WIRELESS_IFACE, AccessPoint, NetworkManagerBackend, NmcliBackend,
+    key_management,
+)
+
+
+DEVICE_PATH = '/org/freedesktop/NetworkManager/Devices/1'
+AP_PATH = '/org/freedesktop/NetworkManager/AccessPoint/1'
+WEAK_AP_PATH = '/org/freedesktop/NetworkManager/AccessPoint/2'
+IP4_CONFIG_PATH = '/org/freedesktop/NetworkManager/IP4Config/1'
+
+# NMActiveConnectionState / NMDeviceState values the fake emits
+ACTIVATED = 2
+DEACTIVATED = 4
+DEVICE_STATES = (40, 60, 70)
+DEVICE_FAILED = 120
+DEVICE_REASON_NO_SECRETS = 7
+ACTIVE_REASON_NO_SECRETS = 9
+CONNECTIVITY_FULL = 4
+CONNECTIVITY_PORTAL = 2
+
+
+class FakeObject(dbus.service.Object):
+    """
+    Serves org.freedesktop.DBus.Properties from a dict of interfaces.
+    """
+    def __init__(self, bus, path, properties=None):
+        super().__init__(bus, path)
+        self.path = dbus.ObjectPath(path)
+        self.properties = properties or {}
+
+    @dbus.service.method(DBUS_PROPERTIES_IFACE, in_signature='ss', out_signature='v')
+    def Get(self, interface, name):
+        return self.properties[interface][name]
+
+    @dbus.service.method(DBUS_PROPERTIES_IFACE, in_signature='s', out_signature='a{sv}')
+    def GetAll(self, interface):
+        return dbus.Dictionary(self.properties.get(interface, {}), signature='sv')
+
+
+def access_point_properties(ssid, bssid, strength, frequency):
+    return {NM_ACCESS_POINT_IFACE: {
+        'Ssid': dbus.ByteArray(ssid.encode('utf-8')),
+        'HwAddress': dbus.String(bssid),
+        'Strength': dbus.Byte(strength),
+        'Flags': dbus.UInt32(1),
+        'WpaFlags': dbus.UInt32(0),
+        'RsnFlags': dbus.UInt32(0x100),
+        'Frequency': dbus.UInt32(frequency),
+    }}
+
+
+class FakeDevice(FakeObject):
+    def __init__(self, bus):
+        super().__init__(bus, DEVICE_PATH, {NM_WIRELESS_IFACE: {'ActiveAccessPoint': dbus.ObjectPath(AP_PATH)}})
+        self.access_points = [
+            FakeObject(bus, AP_PATH, access_point_properties('home', 'AA:BB:CC:DD:EE:01', 80, 2437)),
+            FakeObject(bus, WEAK_AP_PATH, access_point_properties('home', 'AA:BB:CC:DD:EE:02', 30, 5180)),
+        ]
+
+    @dbus.service.method(NM_WIRELESS_IFACE, in_signature='', out_signature='ao')
+    def GetAllAccessPoints(self):
+        return [ap.path for ap in self.access_points]
+
+    @dbus.service.signal(NM_DEVICE_IFACE, signature='uuu')
+    def StateChanged(self, new_state, old_state, reason):
+        pass
+
+
+class FakeActiveConnection(FakeObject):
+    def __init__(self, bus, path, uuid):
+        super().__init__(bus, path, {NM_ACTIVE_CONNECTION_IFACE: {
+            'Uuid': dbus.String(uuid),
+            'Ip4Config': dbus.ObjectPath(IP4_CONFIG_PATH),
+        }})
+
+    @dbus.service.signal(NM_ACTIVE_CONNECTION_IFACE, signature='uu')
+    def StateChanged(self, state, reason):
+        pass
+
+
+class FakeConnection(FakeObject):
+    def __init__(self, bus, path, uuid, network_manager):
+        super().__init__(bus, path)
+        self.uuid = uuid
+        self.network_manager = network_manager
+
+    @dbus.service.method(NM_SETTINGS_CONNECTION_IFACE, in_signature='a{sa{sv}}ua{sv}', out_signature='a{sv}')
+    def Update2(self, settings, flags, args):
+        self.network_manager.saved.append((self.uuid, int(flags)))
+        return dbus.Dictionary({}, signature='sv')
+
+    @dbus.service.method(NM_SETTINGS_CONNECTION_IFACE, in_signature='', out_signature='')
+    def Delete(self):
+        self.network_manager.deleted.append(self.uuid)
+
+
+class FakeSettings(FakeObject):
+    def __init__(self, bus, network_manager):
+        super().__init__(bus, NM_SETTINGS_PATH)
+        self.network_manager = network_manager
+
+    @dbus.service.method(NM_SETTINGS_IFACE, in_signature='s', out_signature='o')
+    def GetConnectionByUuid(self, uuid):
+        for connection in self.network_manager.connections:
+            if connection.uuid == uuid:
+                return connection.path
+        raise dbus.exceptions.DBusException("No such connection", name='org.freedesktop.NetworkManager.Settings.InvalidConnection')
+
+
+class FakeNetworkManager(FakeObject):
+    """
+    Just enough of NetworkManager for NetworkManagerBackend. `outcome`
+    decides how an activation ends: "activated", "no_secrets" or "hang".
+    """
+    def __init__(self, bus):
+        super().__init__(bus, NM_PATH)
+        self.bus = bus
+        self.device = FakeDevice(bus)
+        self.settings = FakeSettings(bus, self)
+        self.ip4_config = FakeObject(bus, IP4_CONFIG_PATH, {NM_IP4_CONFIG_IFACE: {
+            'AddressData': dbus.Array([dbus.Dictionary({'address': '192.168.1.50', 'prefix': dbus.UInt32(24)},
+                                                       signature='sv')], signature='a{sv}'),
+        }})
+        self.outcome = "activated"
+        self.connectivity = CONNECTIVITY_FULL
+        self.connections = []
+        self.added = []
+        self.saved = []
+        self.deleted = []
+        self.deactivated = []
+
+    @dbus.service.method(NM_IFACE, in_signature='s', out_signature='o')
+    def GetDeviceByIpIface(self, interface):
+        if interface != 'wlan0':
+            raise dbus.exceptions.DBusException("No such device", name='org.freedesktop.NetworkManager.UnknownDevice')
+        return dbus.ObjectPath(DEVICE_PATH)
+
+    @dbus.service.method(NM_IFACE, in_signature='a{sa{sv}}ooa{sv}', out_signature='ooa{sv}')
+    def AddAndActivateConnection2(self, settings, device, specific_object, options):
+        index = len(self.connections) + 1
+        uuid = f'00000000-0000-0000-0000-{index:012d}'
+        self.added.append((settings, options))
+        connection = FakeConnection(self.bus, f'{NM_SETTINGS_PATH}/{index}', uuid, self)
+        self.connections.append(connection)
+        active = FakeActiveConnection(self.bus, f'/org/freedesktop/NetworkManager/ActiveConnection/{index}', uuid)
+        # Signals follow the reply, like NetworkManager's
+        GLib.timeout_add(10, self.activate, active)
+        return connection.path, active.path, dbus.Dictionary({}, signature='sv')
+
+    @dbus.service.method(NM_IFACE, in_signature='o', out_signature='')
+    def DeactivateConnection(self, active_path):
+        self.deactivated.append(str(active_path))
+
+    @dbus.service.method(NM_IFACE, in_signature='', out_signature='u')
+    def CheckConnectivity(self):
+        return dbus.UInt32(self.connectivity)
+
+    def activate(self, active):
+        if self.outcome == "hang":
+            return False
+        old_state = 30
+        for state in DEVICE_STATES:
+            self.device.StateChanged(dbus.UInt32(state), dbus.UInt32(old_state), dbus.UInt32(0))
+            old_state = state
+        if self.outcome == "activated":
+            active.StateChanged(dbus.UInt32(ACTIVATED), dbus.UInt32(0))
+        else:
+            self.device.StateChanged(dbus.UInt32(DEVICE_FAILED), dbus.UInt32(old_state),
+                                     dbus.UInt32(DEVICE_REASON_NO_SECRETS))
+            active.StateChanged(dbus.UInt32(DEACTIVATED), dbus.UInt32(ACTIVE_REASON_NO_SECRETS))
+        return False
+
+
+@pytest.fixture
+def network_manager(session_bus):
+    bus = session_bus()
+    name = dbus.service.BusName(NM_SERVICE_NAME, bus)
+    network_manager = FakeNetworkManager(bus)
+    network_manager.name = name
+    return network_manager
+
+
+@pytest.fixture
+def backend(session_bus, network_manager):
+    backend = NetworkManagerBackend(session_bus(), 'wlan0')
+    assert run_until(backend.ready.done)
+    return backend
+
+
+def test_device_is_looked_up_without_blocking(session_bus, network_manager):
+    backend = NetworkManagerBackend(session_bus(), 'wlan0')
+    assert not backend.ready.done()
+    results = []
+    # Queued until the lookup finishes
+    backend.check_connectivity(results.append)
+    assert run_until(lambda: results)
+    assert backend.device_path == DEVICE_PATH
+    assert results == [None]
+
+
+def test_unknown_interface_falls_back_to_nmcli(session_bus, network_manager):
+    backend = NetworkManagerBackend(session_bus(), 'wlan9')
+    assert run_until(backend.ready.done)
+    assert isinstance(backend.fallback, NmcliBackend)
+    assert backend.device_path is None
+
+
+def test_scan_keeps_the_strongest_access_point(backend):
+    results = []
+    backend.scan(results.append)
+    assert run_until(lambda: results)
+    assert results == [[AccessPoint('home', 'AA:BB:CC:DD:EE:01', 80, 'WPA2', 6)]]
+
+
+def test_connect_adds_a_volatile_profile_and_saves_it(backend, network_manager):
+    results, stages = [], []
+    backend.connect('home', 'a' * 64, results.append, timeout=5, progress=stages.append)
+    assert run_until(lambda: results)
+    uuid = network_manager.connections[0].uuid
+    assert results == [{"success": True, "message": "Connected successfully", "ip": "192.168.1.50",
+                        "profile": uuid, "bssid": "AA:BB:CC:DD:EE:01", "channel": 6}]
+    assert stages == ["associating", "authenticating", "dhcp"]
+    settings, options = network_manager.added[0]
+    assert bytes(settings['802-11-wireless']['ssid']) == b'home'
+    assert settings['802-11-wireless-security'] == {'key-mgmt': 'wpa-psk', 'psk': 'a' * 64}
+    assert options['persist'] == 'volatile'
+    assert network_manager.saved == [(uuid, NM_SETTINGS_UPDATE2_FLAG_TO_DISK)]
+
+
+def test_wpa3_networks_get_sae_with_the_passphrase(backend, network_manager):
+    results = []
+    backend.connect('home', 'a' * 64, results.append, timeout=5, passphrase='correct horse', security='WPA3')
+    assert run_until(lambda: results)
+    settings, _ = network_manager.added[0]
+    assert settings['802-11-wireless-security'] == {'key-mgmt': 'sae', 'psk': 'correct horse'}
+
+
+@pytest.mark.parametrize('security, passphrase, expected', [
+    ('WPA2', 'correct horse', ('wpa-psk', 'a' * 64)),
+    ('WPA1 WPA2', 'correct horse', ('wpa-psk', 'a' * 64)),
+    ('WPA3', 'correct horse', ('sae', 'correct horse')),
+    ('WPA2 WPA3', 'correct horse', ('wpa-psk', 'correct horse')),
+    (None, 'correct horse', ('wpa-psk', 'correct horse')),
+    ('WPA3', None, ('wpa-psk', 'a' * 64)),
+    (None, None, ('wpa-psk', 'a' * 64)),
+])
+def test_key_management_follows_the_access_point(security, passphrase, expected):
+    assert key_management('a' * 64, passphrase, security) == expected
+
+
+@pytest.mark.parametrize('rsn_flags, security', [
+    (0x100, 'WPA2'),
+    (0x400, 'WPA3'),
+    (0x500, 'WPA2 WPA3'),
+    (0x200, 'WPA2 802.1X'),
+])
+def test_access_point_security_from_the_rsn_flags(rsn_flags, security):
+    properties = access_point_properties('home', 'AA:BB:CC:DD:EE:01', 80, 2437)[NM_ACCESS_POINT_IFACE]
+    properties['RsnFlags'] = dbus.UInt32(rsn_flags)
+    assert NetworkManagerBackend.access_point_from_properties(None, properties).security == security
+
+
+def test_failed_connect_reports_the_device_error(backend, network_manager):
+    network_manager.outcome = "no_secrets"
+    results = []
+    backend.connect('home', 'a' * 64, results.append, timeout=5)
+    assert run_until(lambda: results)
+    assert results[0]["success"] is False
+    assert results[0]["error"] == "auth_failed"
+    # The volatile profile goes away with the activation, nothing to save
+    assert network_manager.saved == []
+
+
+def test_connect_timeout_abandons_the_activation(backend, network_manager):
+    network_manager.outcome = "hang"
+    results = []
+    backend.connect('home', 'a' * 64, results.append, timeout=1)
+    assert run_until(lambda: results)
+    assert results[0]["error"] == "timeout"
+    assert run_until(lambda: network_manager.deactivated)
+    assert network_manager.deactivated == ['/org/freedesktop/NetworkManager/ActiveConnection/1']
+    assert network_manager.saved == []
+
+
+def test_check_connectivity_reports_captive_portals(backend, network_manager):
+    network_manager.connectivity = CONNECTIVITY_PORTAL
+    results = []
+    backend.check_connectivity(results.append)
+    assert run_until(lambda: results)
+    assert results == ["captive_portal"]
+
+
+def test_delete_profile(backend, network_manager):
+    results = []
+    backend.connect('home', 'a' * 64, results.append, timeout=5)
+    assert run_until(lambda: results)
+    backend.delete_profile(network_manager.connections[0].uuid)
+    assert run_until(lambda: network_manager.deleted)
+    assert network_manager.deleted == [network_manager.connections[0].uuid]
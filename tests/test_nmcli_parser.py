@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from wifi_backends import AccessPoint, NmcliBackend  # noqa: E402
+
+
+@pytest.fixture
+def backend():
+    return NmcliBackend("wlan0")
+
+
+def test_split_terse_plain_fields(backend):
+    assert backend._split_terse('home:AA\\:BB:80') == ['home', 'AA:BB', '80']
+
+
+def test_split_terse_escapes(backend):
+    assert backend._split_terse('a\\:b\\\\c:') == ['a:b\\c', '']
+    assert backend._split_terse('') == ['']
+
+
+def test_parse_scan(backend):
+    output = '\n'.join([
+        'home:AA\\:BB\\:CC\\:DD\\:EE\\:01:70:WPA2:6',
+        'cafe\\:wifi:AA\\:BB\\:CC\\:DD\\:EE\\:02:90::11',
+    ])
+    assert backend.parse_scan(output) == [
+        AccessPoint('cafe:wifi', 'AA:BB:CC:DD:EE:02', 90, '', 11),
+        AccessPoint('home', 'AA:BB:CC:DD:EE:01', 70, 'WPA2', 6),
+    ]
+
+
+def test_parse_scan_keeps_the_strongest_bssid(backend):
+    output = '\n'.join([
+        'home:AA\\:BB\\:CC\\:DD\\:EE\\:01:40:WPA2:1',
+        'home:AA\\:BB\\:CC\\:DD\\:EE\\:02:75:WPA2:36',
+    ])
+    assert backend.parse_scan(output) == [AccessPoint('home', 'AA:BB:CC:DD:EE:02', 75, 'WPA2', 36)]
+
+
+def test_parse_scan_skips_bad_lines(backend):
+    output = '\n'.join([
+        'too:few',
+        'home:AA\\:BB\\:CC\\:DD\\:EE\\:01:strong:WPA2:6',
+        ':AA\\:BB\\:CC\\:DD\\:EE\\:03:60:WPA2:6',
+        'ok:AA\\:BB\\:CC\\:DD\\:EE\\:04:50:WPA1 WPA2:11',
+    ])
+    # Hidden networks without an SSID are dropped too
+    assert backend.parse_scan(output) == [AccessPoint('ok', 'AA:BB:CC:DD:EE:04', 50, 'WPA1 WPA2', 11)]
@@ -0,0 +1,167 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+from gatt_server import InvalidArgsException  # noqa: E402
+from wpa_characteristics import ProvisioningStateMachine, WiFiManager  # noqa: E402
+from wpa_codec import (  # noqa: E402
+    ERROR_CODES, FORMAT_BINARY, MAX_STATE_REASON_LENGTH, MSG_STATE, STATE_HEADER, STATUS_CODES,
+)
+
+
+DEVICE = '/org/bluez/hci0/dev_AA_AA_AA_AA_AA_01'
+OTHER_DEVICE = '/org/bluez/hci0/dev_AA_AA_AA_AA_AA_02'
+PSK = 'ab' * 32
+
+
+class Session:
+    device = DEVICE
+
+    def __init__(self):
+        self.states = []
+
+    def set_state(self, state, reason, error, elapsed_ms):
+        self.states.append(SimpleNamespace(state=state, reason=reason, error=error, elapsed_ms=elapsed_ms))
+
+
+def test_transitions_are_sent_with_the_elapsed_time():
+    session = Session()
+    machine = ProvisioningStateMachine(session)
+    machine.started -= 0.25
+    machine.transition("validating")
+    machine.transition("failed", "Bad PSK", "auth_failed")
+    assert [(s.state, s.reason, s.error) for s in session.states] == [
+        ("validating", None, None), ("failed", "Bad PSK", "auth_failed")]
+    assert all(s.elapsed_ms >= 250 for s in session.states)
+    assert [name for name, _ in machine.durations] == ["idle", "validating"]
+
+
+def test_terminal_states_are_final():
+    session = Session()
+    machine = ProvisioningStateMachine(session)
+    machine.transition("connected")
+    machine.transition("failed", "late", "timeout")
+    assert [s.state for s in session.states] == ["connected"]
+
+
+def test_unknown_states_are_rejected():
+    with pytest.raises(ValueError):
+        ProvisioningStateMachine(Session()).transition("rebooting")
+
+
+def write(characteristic, value, device=DEVICE):
+    if isinstance(value, dict):
+        value = json.dumps(value).encode('utf-8')
+    characteristic.WriteValue([dbus.Byte(b) for b in value], {'device': dbus.ObjectPath(device)})
+
+
+def states(characteristic):
+    return [json.loads(value) for value in characteristic.notifications if b'"t":' in value]
+
+
+@pytest.fixture
+def characteristic(wpa_service, monkeypatch):
+    monkeypatch.setattr(WiFiManager, 'RETRY_DELAY', 0)
+    characteristic = wpa_service.wpa_characteristic
+    characteristic.StartNotify()
+    return characteristic
+
+
+def test_every_stage_is_notified(characteristic):
+    backend = characteristic.wifi_manager.backend
+    write(characteristic, {"ssid": "home", "psk": "correct horse"})
+    assert run_until(lambda: backend.connects)
+    backend.connects[0].stage("authenticating")
+    backend.connects[0].stage("dhcp")
+    backend.connects[0].succeed()
+    sent = states(characteristic)
+    assert [state["status"] for state in sent] == [
+        "validating", "scanning", "associating", "authenticating", "dhcp", "online_check", "connected"]
+    assert [state["t"] for state in sent] == sorted(state["t"] for state in sent)
+    assert sent[-1]["ip"] == "192.168.1.50"
+
+
+def test_failed_stage_names_the_error(characteristic):
+    backend = characteristic.wifi_manager.backend
+    write(characteristic, {"ssid": "home", "psk": PSK})
+    for attempt in range(3):
+        assert run_until(lambda: len(backend.connects) == attempt + 1)
+        backend.connects[attempt].stage("authenticating")
+        backend.connects[attempt].fail("Secrets were required")
+    final = states(characteristic)[-1]
+    assert (final["status"], final["error"]) == ("failed", "auth_failed")
+
+
+def test_backend_error_wins_over_the_stage(characteristic):
+    backend = characteristic.wifi_manager.backend
+    write(characteristic, {"ssid": "home", "psk": PSK})
+    for attempt in range(3):
+        assert run_until(lambda: len(backend.connects) == attempt + 1)
+        backend.connects[attempt].fail("Timed out", error="timeout")
+    assert states(characteristic)[-1]["error"] == "timeout"
+
+
+def test_unknown_network_without_psk(characteristic):
+    write(characteristic, {"ssid": "home"})
+    sent = states(characteristic)
+    assert [state["status"] for state in sent] == ["validating", "failed"]
+    assert sent[-1]["error"] == "unknown_network"
+    assert characteristic.active_connect is None
+
+
+@pytest.mark.parametrize('value', [{"ssid": "home", "psk": "short"}, {"ssid": "", "psk": PSK},
+                                   {"ssid": "home", "psk": 12345678}, b'{"ssid": ', b'\xff\xfe', b'[1, 2, 3]'])
+def test_invalid_writes_fail_with_invalid_credentials(characteristic, value):
+    with pytest.raises(InvalidArgsException):
+        write(characteristic, value)
+    sent = states(characteristic)
+    assert [state["status"] for state in sent] == ["validating", "failed"]
+    assert sent[-1]["error"] == "invalid_credentials"
+    assert characteristic.wifi_manager.backend.connects == []
+
+
+@pytest.mark.parametrize('queued', [False, True])
+def test_invalid_write_keeps_a_pending_connect(characteristic, queued):
+    backend = characteristic.wifi_manager.backend
+    if queued:
+        write(characteristic, {"ssid": "office", "psk": PSK}, OTHER_DEVICE)
+    write(characteristic, {"ssid": "home", "psk": PSK})
+    session = characteristic.sessions[DEVICE]
+    provisioning = session.provisioning
+    sent = len(states(characteristic))
+    with pytest.raises(InvalidArgsException):
+        write(characteristic, b'{"ssid": ')
+    assert session.provisioning is provisioning
+    assert provisioning.state != "failed"
+    assert len(states(characteristic)) == sent
+    if queued:
+        backend.connects[0].succeed()
+    assert run_until(lambda: [connect.ssid for connect in backend.connects][-1:] == ["home"])
+    backend.connects[-1].succeed()
+    assert states(characteristic)[-1]["status"] == "connected"
+
+
+def test_captive_portal_is_reported(characteristic):
+    backend = characteristic.wifi_manager.backend
+    backend.connectivity = "captive_portal"
+    write(characteristic, {"ssid": "home", "psk": PSK})
+    backend.connects[0].succeed()
+    final = states(characteristic)[-1]
+    assert (final["status"], final["error"]) == ("failed", "captive_portal")
+    # The credentials worked, so the network is kept
+    assert characteristic.wifi_manager.store.get("home") is not None
+
+
+def test_binary_state_notifications(characteristic):
+    write(characteristic, [FORMAT_BINARY, 3])
+    characteristic.notifications.clear()
+    write(characteristic, {"ssid": "home"})
+    value = characteristic.notifications[-1]
+    kind, tag, state, error, elapsed_ms, ip = STATE_HEADER.unpack(value[:STATE_HEADER.size])
+    assert (kind, tag, state, error) == (MSG_STATE, 3, STATUS_CODES["failed"], ERROR_CODES["unknown_network"])
+    assert value[STATE_HEADER.size:] == b"Unknown network home"[:MAX_STATE_REASON_LENGTH]
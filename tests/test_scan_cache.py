@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+from fake_wifi import FakeWifiBackend  # noqa: E402
+from wifi_backends import AccessPoint  # noqa: E402
+from wpa_characteristics import ScanCache, WiFiManager  # noqa: E402
+
+
+def ap(ssid, signal=80):
+    return AccessPoint(ssid, '00:11:22:33:44:55', signal, 'WPA2', 6)
+
+
+@pytest.fixture
+def backend():
+    backend = FakeWifiBackend([ap('home')])
+    backend.hold_scans = True
+    return backend
+
+
+@pytest.fixture
+def cache(backend, scheduler):
+    cache = ScanCache(WiFiManager(backend=backend), ttl=30)
+    yield cache
+    cache.stop()
+
+
+def test_start_scans_right_away(cache, backend):
+    cache.start()
+    assert backend.scans == [False]
+    assert cache.get() == []
+    backend.complete_scans()
+    assert cache.get() == [ap('home')]
+
+
+def test_next_refresh_is_due_a_ttl_after_the_scan_completed(cache, backend):
+    cache.start()
+    # Nothing is scheduled while the first scan runs
+    assert cache.timer is None
+    backend.complete_scans()
+    assert cache.timer.deadline - time.monotonic() == pytest.approx(cache.ttl, abs=1)
+
+
+def test_every_tick_refreshes(cache, backend):
+    cache.ttl = 0.05
+    backend.hold_scans = False
+    cache.start()
+    assert run_until(lambda: len(backend.scans) >= 3)
+
+
+def test_client_scan_restarts_the_timer(cache, backend):
+    cache.start()
+    backend.complete_scans()
+    first = cache.timer
+    cache.refresh(rescan=True)
+    backend.complete_scans()
+    assert first.cancelled
+    assert cache.timer is not first and not cache.timer.cancelled
+
+
+def test_stop_cancels_the_timer(cache, backend):
+    cache.start()
+    backend.complete_scans()
+    timer = cache.timer
+    cache.stop()
+    assert timer.cancelled
+    cache.refresh()
+    backend.complete_scans()
+    assert cache.timer is None
+
+
+def test_callers_share_a_running_scan(cache, backend):
+    results = []
+    cache.refresh(callback=results.append)
+    cache.refresh(callback=results.append)
+    assert backend.scans == [False]
+    backend.complete_scans()
+    assert results == [[ap('home')], [ap('home')]]
+
+
+def test_rescan_during_a_cached_scan_runs_after_it(cache, backend):
+    results = []
+    cache.refresh()
+    cache.refresh(rescan=True, callback=results.append)
+    backend.complete_scans([ap('stale')])
+    # The callback waits for the forced rescan
+    assert (backend.scans, results) == ([False, True], [])
+    backend.complete_scans()
+    assert results == [[ap('home')]]
+
+
+def test_failed_scan_keeps_the_previous_list(cache, backend):
+    cache.refresh()
+    backend.complete_scans()
+    cache.refresh()
+    backend.fail_scans()
+    assert cache.get() == [ap('home')]
+
+
+def test_merge_replaces_entries_for_the_same_ssid(cache, backend):
+    cache.networks = [ap('home', 40), ap('office', 60)]
+    cache.merge([ap('home', 90), ap('hidden', 50)])
+    assert cache.get() == [ap('home', 90), ap('office', 60), ap('hidden', 50)]
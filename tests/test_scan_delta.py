@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from wifi_backends import AccessPoint  # noqa: E402
+from wpa_characteristics import ScanDeltaTracker  # noqa: E402
+from wpa_codec import DELTA_ADDED, DELTA_CHANGED, DELTA_REMOVED  # noqa: E402
+
+
+def ap(ssid, signal=80, channel=6):
+    return AccessPoint(ssid, '00:11:22:33:44:55', signal, 'WPA2', channel)
+
+
+def test_first_update_adds_everything():
+    tracker = ScanDeltaTracker()
+    assert tracker.update([ap('a'), ap('b')]) == [(DELTA_ADDED, ap('a')), (DELTA_ADDED, ap('b'))]
+
+
+def test_unchanged_networks_are_not_resent():
+    tracker = ScanDeltaTracker()
+    tracker.update([ap('a')])
+    assert tracker.update([ap('a')]) == []
+
+
+def test_small_rssi_changes_are_ignored():
+    tracker = ScanDeltaTracker(rssi_threshold=3)
+    tracker.update([ap('a', signal=80)])
+    # 4 signal points are 2 dB
+    assert tracker.update([ap('a', signal=84)]) == []
+    assert tracker.update([ap('a', signal=86)]) == [(DELTA_CHANGED, ap('a', signal=86))]
+
+
+def test_threshold_is_measured_from_the_last_sent_value():
+    tracker = ScanDeltaTracker(rssi_threshold=3)
+    tracker.update([ap('a', signal=80)])
+    tracker.update([ap('a', signal=84)])
+    assert tracker.update([ap('a', signal=88)]) == [(DELTA_CHANGED, ap('a', signal=88))]
+    assert tracker.update([ap('a', signal=90)]) == []
+
+
+def test_channel_change_is_reported():
+    tracker = ScanDeltaTracker()
+    tracker.update([ap('a', channel=6)])
+    assert tracker.update([ap('a', channel=11)]) == [(DELTA_CHANGED, ap('a', channel=11))]
+
+
+def test_missing_networks_are_removed_once():
+    tracker = ScanDeltaTracker()
+    tracker.update([ap('a'), ap('b')])
+    assert tracker.update([ap('a')]) == [(DELTA_REMOVED, ap('b'))]
+    assert tracker.update([ap('a')]) == []
+    assert tracker.update([ap('a'), ap('b')]) == [(DELTA_ADDED, ap('b'))]
@@ -0,0 +1,145 @@
+import json
+
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+from wifi_backends import AccessPoint  # noqa: E402
+from wpa_characteristics import ScanStreamCharacteristic  # noqa: E402
+from wpa_codec import FORMAT_JSON_DETAILED  # noqa: E402
+
+
+DEVICE = '/org/bluez/hci0/dev_AA_AA_AA_AA_AA_01'
+MTU = 23
+CHUNK_SIZE = MTU - ScanStreamCharacteristic.ATT_NOTIFY_OVERHEAD - ScanStreamCharacteristic.FRAME_HEADER_SIZE
+
+
+def networks(count):
+    return [AccessPoint(f'network-{i:02d}', f'AA:BB:CC:DD:EE:{i:02X}', 90 - i, 'WPA2', 6) for i in range(count)]
+
+
+def write(characteristic, value, mtu=MTU):
+    characteristic.WriteValue([dbus.Byte(b) for b in value],
+                              {'device': dbus.ObjectPath(DEVICE), 'mtu': dbus.UInt16(mtu)})
+
+
+def frames(stream, count):
+    assert run_until(lambda: len(stream.notifications) >= count)
+    return stream.notifications[:count]
+
+
+@pytest.fixture
+def stream(wpa_service):
+    wpa_service.wpa_characteristic.scan_cache.networks = networks(20)
+    # Long enough to need several pages
+    wpa_service.wpa_characteristic.get_session({'device': DEVICE}).format = FORMAT_JSON_DETAILED
+    stream = wpa_service.get_characteristic(ScanStreamCharacteristic.SCAN_STREAM_CHAR_UUID)
+    stream.StartNotify()
+    return stream
+
+
+def payload(wpa_service):
+    characteristic = wpa_service.wpa_characteristic
+    return characteristic.encode_scan_list(characteristic.get_session({'device': DEVICE}))
+
+
+def test_page_is_split_into_mtu_sized_frames(wpa_service, stream):
+    data = payload(wpa_service)
+    assert len(data) > ScanStreamCharacteristic.PAGE_SIZE
+    write(stream, [ScanStreamCharacteristic.OP_PAGE_REQUEST, 0])
+    count = -(-ScanStreamCharacteristic.PAGE_SIZE // CHUNK_SIZE)
+    sent = frames(stream, count)
+    assert all(len(frame) <= MTU - ScanStreamCharacteristic.ATT_NOTIFY_OVERHEAD for frame in sent)
+    assert [frame[:3] for frame in sent] == [bytes((0, 0, seq)) for seq in range(count)]
+    assert [frame[3] for frame in sent] == [0] * (count - 1) + [ScanStreamCharacteristic.FLAG_LAST_FRAME]
+    assert b''.join(frame[4:] for frame in sent) == data[:ScanStreamCharacteristic.PAGE_SIZE]
+
+
+def test_last_page_is_flagged(wpa_service, stream):
+    data = payload(wpa_service)
+    last = (len(data) - 1) // ScanStreamCharacteristic.PAGE_SIZE
+    write(stream, [ScanStreamCharacteristic.OP_PAGE_REQUEST, 0])
+    run_until(lambda: stream.sender_id is None)
+    stream.notifications.clear()
+    write(stream, [ScanStreamCharacteristic.OP_PAGE_REQUEST, last])
+    rest = data[last * ScanStreamCharacteristic.PAGE_SIZE:]
+    sent = frames(stream, -(-len(rest) // CHUNK_SIZE))
+    assert sent[-1][:2] == bytes((0, last))
+    assert sent[-1][3] == ScanStreamCharacteristic.FLAG_LAST_FRAME | ScanStreamCharacteristic.FLAG_LAST_PAGE
+    assert b''.join(frame[4:] for frame in sent) == rest
+
+
+def test_page_out_of_range_is_rejected(stream):
+    write(stream, [ScanStreamCharacteristic.OP_PAGE_REQUEST, 0])
+    with pytest.raises(dbus.exceptions.DBusException):
+        write(stream, [ScanStreamCharacteristic.OP_PAGE_REQUEST, 9])
+
+
+def test_frames_carry_the_session_tag(wpa_service, stream):
+    wpa_service.wpa_characteristic.get_session({'device': DEVICE}).set_tag(5)
+    write(stream, [ScanStreamCharacteristic.OP_PAGE_REQUEST, 0])
+    assert frames(stream, 1)[0][0] == 5
+
+
+def test_nothing_is_sent_without_subscribers(wpa_service, stream):
+    stream.StopNotify()
+    write(stream, [ScanStreamCharacteristic.OP_PAGE_REQUEST, 0])
+    assert run_until(lambda: stream.sender_id is None)
+    assert stream.notifications == []
+
+
+def deltas(stream, count):
+    """
+    Reassemble the delta messages among the sent frames.
+    """
+    def messages():
+        out, data = [], b''
+        for frame in stream.notifications:
+            if frame[1] != ScanStreamCharacteristic.DELTA_PAGE:
+                continue
+            data += frame[4:]
+            if frame[3] & ScanStreamCharacteristic.FLAG_LAST_FRAME:
+                out.append(json.loads(data))
+                data = b''
+        return out
+    assert run_until(lambda: len(messages()) >= count)
+    return messages()
+
+
+def test_watch_starts_with_everything_added(wpa_service, stream):
+    backend = wpa_service.wpa_characteristic.wifi_manager.backend
+    backend.networks = networks(2)
+    write(stream, [ScanStreamCharacteristic.OP_WATCH, 1])
+    message, = deltas(stream, 1)
+    assert [(change["op"], change["ssid"]) for change in message] == [("added", "network-00"), ("added", "network-01")]
+    last = stream.notifications[-1]
+    assert last[3] == ScanStreamCharacteristic.FLAG_LAST_FRAME | ScanStreamCharacteristic.FLAG_LAST_PAGE
+
+
+def test_watch_sends_only_changes(wpa_service, stream):
+    backend = wpa_service.wpa_characteristic.wifi_manager.backend
+    backend.networks = networks(2)
+    write(stream, [ScanStreamCharacteristic.OP_WATCH, 1])
+    deltas(stream, 1)
+    backend.report(networks(1))
+    backend.report(networks(1))
+    backend.report(networks(1) + [AccessPoint('new', '00:00:00:00:00:01', 50, 'WPA2', 1)])
+    messages = deltas(stream, 2)
+    assert len(messages) == 2
+    # Reports in one burst are sent as one message
+    assert messages[1] == [{"op": "removed", "ssid": "network-01"},
+                           {"op": "added", "ssid": "new", "rssi": -75, "channel": 1}]
+
+
+def test_stop_watch(wpa_service, stream):
+    backend = wpa_service.wpa_characteristic.wifi_manager.backend
+    write(stream, [ScanStreamCharacteristic.OP_WATCH, 1])
+    assert len(backend.watches) == 1
+    write(stream, [ScanStreamCharacteristic.OP_WATCH, 0])
+    assert backend.watches == []
+    stream.StartNotify()
+    write(stream, [ScanStreamCharacteristic.OP_WATCH, 1])
+    stream.StopNotify()
+    assert backend.watches == []
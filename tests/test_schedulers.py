@@ -0,0 +1,153 @@
+import time
+
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+from gatt_server import DeadlineScheduler, NotifyScheduler  # noqa: E402
+
+
+def run_for(seconds):
+    run_until(lambda: False, seconds)
+
+
+class Value:
+    def __init__(self, value):
+        self.value = value
+
+
+def test_calls_run_in_deadline_order():
+    scheduler = DeadlineScheduler()
+    calls = []
+    scheduler.schedule(0.03, calls.append, 'c')
+    scheduler.schedule(0.01, calls.append, 'a')
+    scheduler.schedule(0.02, calls.append, 'b')
+    assert run_until(lambda: len(calls) == 3)
+    assert calls == ['a', 'b', 'c']
+
+
+def test_equal_deadlines_keep_scheduling_order(monkeypatch):
+    scheduler = DeadlineScheduler()
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    calls = []
+    for name in ('first', 'second', 'third'):
+        scheduler.schedule(0, calls.append, name)
+    monkeypatch.undo()
+    assert run_until(lambda: len(calls) == 3)
+    assert calls == ['first', 'second', 'third']
+
+
+def test_cancelled_calls_do_not_run():
+    scheduler = DeadlineScheduler()
+    calls = []
+    scheduler.schedule(0.01, calls.append, 'cancelled').cancel()
+    scheduler.schedule(0.02, calls.append, 'kept')
+    assert run_until(lambda: calls)
+    run_for(0.03)
+    assert calls == ['kept']
+
+
+def test_cancelled_calls_are_compacted():
+    scheduler = DeadlineScheduler()
+    timer = None
+    for _ in range(1000):
+        if timer is not None:
+            timer.cancel()
+        timer = scheduler.schedule(60, lambda: None)
+    assert len(scheduler.heap) <= 2
+    assert scheduler.cancelled * 2 <= len(scheduler.heap)
+
+
+def test_cancel_after_the_call_ran_is_ignored():
+    scheduler = DeadlineScheduler()
+    calls = []
+    call = scheduler.schedule(0, calls.append, 'ran')
+    assert run_until(lambda: calls)
+    call.cancel()
+    assert scheduler.cancelled == 0
+
+
+def test_failing_call_does_not_stop_the_others():
+    scheduler = DeadlineScheduler()
+    calls = []
+    scheduler.schedule(0.01, lambda: 1 / 0)
+    scheduler.schedule(0.02, calls.append, 'after')
+    assert run_until(lambda: calls == ['after'])
+
+
+def test_notify_start_sends_the_current_value():
+    sent = []
+    notifier = NotifyScheduler(Value([1]), coalesce_ms=5, send=sent.append)
+    notifier.start()
+    assert run_until(lambda: sent)
+    assert sent == [[1]]
+
+
+def test_notify_coalesces_bursts_to_the_latest_value():
+    sent = []
+    source = Value([1])
+    notifier = NotifyScheduler(source, coalesce_ms=20, send=sent.append)
+    notifier.start()
+    for value in ([2], [3], [4]):
+        source.value = value
+        notifier.value_changed()
+    assert run_until(lambda: sent)
+    run_for(0.05)
+    assert sent == [[4]]
+
+
+def test_notify_skips_unchanged_values():
+    sent = []
+    source = Value([1])
+    notifier = NotifyScheduler(source, coalesce_ms=5, send=sent.append)
+    notifier.start()
+    assert run_until(lambda: sent)
+    notifier.value_changed()
+    run_for(0.03)
+    assert sent == [[1]]
+
+
+def test_notify_flush_sends_every_value_in_order():
+    sent = []
+    source = Value([0])
+    notifier = NotifyScheduler(source, coalesce_ms=50, send=sent.append)
+    notifier.notifying = True
+    for value in ([1], [2], [3]):
+        source.value = value
+        notifier.flush()
+    assert sent == [[1], [2], [3]]
+
+
+def test_notify_flush_replaces_a_pending_coalesced_send():
+    sent = []
+    source = Value([1])
+    notifier = NotifyScheduler(source, coalesce_ms=20, send=sent.append)
+    notifier.start()
+    source.value = [2]
+    notifier.flush()
+    run_for(0.05)
+    assert sent == [[2]]
+
+
+def test_notify_stop_drops_pending_sends():
+    sent = []
+    source = Value([1])
+    notifier = NotifyScheduler(source, coalesce_ms=10, send=sent.append)
+    notifier.start()
+    notifier.stop()
+    notifier.value_changed()
+    notifier.flush()
+    run_for(0.03)
+    assert sent == []
+
+
+def test_notify_keepalive_resends():
+    sent = []
+    notifier = NotifyScheduler(Value([1]), coalesce_ms=5, keepalive_seconds=0.02, send=sent.append)
+    notifier.start()
+    assert run_until(lambda: len(sent) >= 3)
+    notifier.stop()
+    assert sent[:3] == [[1], [1], [1]]
@@ -0,0 +1,119 @@
+import pytest
+
+pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+from fake_wifi import FakeWifiBackend  # noqa: E402
+from network_store import NetworkStore  # noqa: E402
+from wifi_backends import AccessPoint  # noqa: E402
+from wpa_characteristics import WiFiManager  # noqa: E402
+
+
+PSK = 'ab' * 32
+OTHER_PSK = 'cd' * 32
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(WiFiManager, 'RETRY_DELAY', 0)
+    return WiFiManager(backend=FakeWifiBackend(), store=NetworkStore(str(tmp_path / 'networks.json')))
+
+
+def connect(manager, ssid, psk=PSK, retries=3):
+    results, stages = [], []
+    manager.set_credentials(ssid, psk)
+    manager.connect(results.append, retries=retries, progress=lambda stage, reason: stages.append(stage))
+    return results, stages
+
+
+def test_unknown_network_gets_full_connects(manager):
+    manager.set_credentials('home', PSK)
+    manager.psk_hash = PSK
+    assert manager.connect_plan(2) == [WiFiManager.CONNECT_FULL] * 2
+
+
+def test_known_network_tries_its_profile_and_access_point_first(manager):
+    manager.store.remember('home', PSK, '00:11:22:33:44:55', 6, 'uuid-1')
+    manager.set_credentials('home', PSK)
+    manager.psk_hash = PSK
+    assert manager.connect_plan(1) == [WiFiManager.CONNECT_PROFILE, WiFiManager.CONNECT_TARGETED,
+                                       WiFiManager.CONNECT_FULL]
+    manager.psk_hash = OTHER_PSK
+    assert manager.connect_plan(1) == [WiFiManager.CONNECT_FULL]
+
+
+def test_successful_connect_is_remembered(manager):
+    backend = manager.backend
+    backend.networks = [AccessPoint('home', '00:11:22:33:44:55', 80, 'WPA2', 6)]
+    results, stages = connect(manager, 'home')
+    backend.connects[0].succeed(bssid='00:11:22:33:44:55', channel=6, profile='uuid-1')
+    assert results[0]["success"]
+    assert stages == ["scanning", "associating", "online_check"]
+    known = manager.store.get('home')
+    assert (known.psk_hash, known.bssid, known.channel, known.profile) == (PSK, '00:11:22:33:44:55', 6, 'uuid-1')
+
+
+def test_fast_paths_fall_through_without_waiting(manager):
+    backend = manager.backend
+    manager.store.remember('home', PSK, '00:11:22:33:44:55', 6, 'uuid-1')
+    results, _ = connect(manager, 'home', retries=1)
+    assert backend.connects[0].kwargs['profile'] == 'uuid-1'
+    backend.connects[0].fail()
+    assert backend.connects[1].kwargs['bssid'] == '00:11:22:33:44:55'
+    assert backend.connects[1].kwargs['timeout'] <= WiFiManager.FAST_CONNECT_TIMEOUT
+    backend.connects[1].fail()
+    assert len(backend.connects) == 3 and 'bssid' not in backend.connects[2].kwargs
+    backend.connects[2].fail()
+    assert results and not results[0]["success"]
+
+
+def test_full_connect_passes_the_scanned_security(manager):
+    backend = manager.backend
+    backend.networks = [AccessPoint('home', '00:11:22:33:44:55', 80, 'WPA3', 6)]
+    connect(manager, 'home', psk='correct horse')
+    assert run_until(lambda: backend.connects)
+    assert backend.connects[0].kwargs['security'] == 'WPA3'
+    assert backend.connects[0].kwargs['passphrase'] == 'correct horse'
+
+
+def test_hex_psk_leaves_no_passphrase(manager):
+    backend = manager.backend
+    connect(manager, 'home')
+    assert backend.connects[0].kwargs['passphrase'] is None
+    assert backend.connects[0].kwargs['security'] is None
+
+
+def test_full_connects_are_retried(manager):
+    backend = manager.backend
+    results, _ = connect(manager, 'home', retries=2)
+    backend.connects[0].fail()
+    assert run_until(lambda: len(backend.connects) == 2)
+    backend.connects[1].succeed()
+    assert results[0]["success"]
+
+
+def test_replaced_profile_is_deleted(manager):
+    backend = manager.backend
+    manager.store.remember('home', OTHER_PSK, profile='uuid-old')
+    connect(manager, 'home')
+    backend.connects[0].succeed(profile='uuid-new')
+    assert backend.deleted == ['uuid-old']
+    assert manager.store.get('home').profile == 'uuid-new'
+
+
+def test_forget_deletes_the_profile(manager):
+    manager.store.remember('home', PSK, profile='uuid-1')
+    manager.forget('home')
+    assert manager.store.get('home') is None
+    assert manager.backend.deleted == ['uuid-1']
+    with pytest.raises(ValueError):
+        manager.forget('home')
+
+
+def test_known_network_is_connected_with_its_stored_psk(manager):
+    manager.store.remember('home', PSK, hidden=True)
+    manager.set_known_network('home')
+    assert (manager.ssid, manager.hidden) == ('home', True)
+    with pytest.raises(ValueError):
+        manager.set_known_network('office')
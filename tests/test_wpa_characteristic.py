@@ -0,0 +1,172 @@
+import json
+
+import pytest
+
+dbus = pytest.importorskip("dbus")
+pytest.importorskip("gi")
+
+from conftest import run_until  # noqa: E402
+from gatt_server import InvalidOffsetException  # noqa: E402
+from wifi_backends import AccessPoint  # noqa: E402
+from wpa_codec import FORMAT_BINARY, FORMAT_JSON, MSG_SCAN  # noqa: E402
+
+
+DEVICE_A = '/org/bluez/hci0/dev_AA_AA_AA_AA_AA_01'
+DEVICE_B = '/org/bluez/hci0/dev_AA_AA_AA_AA_AA_02'
+MTU = 23
+PSK = 'ab' * 32
+
+
+def networks(count):
+    return [AccessPoint(f'network-{i:02d}', f'AA:BB:CC:DD:EE:{i:02X}', 90 - i, 'WPA2', 6) for i in range(count)]
+
+
+def read(characteristic, device, offset=0, mtu=None):
+    options = {'device': dbus.ObjectPath(device), 'offset': dbus.UInt16(offset)}
+    if mtu is not None:
+        options['mtu'] = dbus.UInt16(mtu)
+    return bytes(characteristic.ReadValue(options))
+
+
+def write(characteristic, device, value):
+    if isinstance(value, dict):
+        value = json.dumps(value).encode('utf-8')
+    characteristic.WriteValue([dbus.Byte(b) for b in value], {'device': dbus.ObjectPath(device)})
+
+
+def notified(characteristic):
+    return [json.loads(value) for value in characteristic.notifications]
+
+
+@pytest.fixture
+def characteristic(wpa_service):
+    characteristic = wpa_service.wpa_characteristic
+    characteristic.scan_cache.networks = networks(10)
+    return characteristic
+
+
+def test_read_returns_the_encoded_scan_list(characteristic):
+    session = characteristic.get_session({'device': DEVICE_A})
+    assert read(characteristic, DEVICE_A) == characteristic.encode_scan_list(session)
+
+
+def test_long_read_is_served_from_one_snapshot(characteristic):
+    first = read(characteristic, DEVICE_A, mtu=MTU)
+    assert len(first) > 2 * (MTU - 1)
+    characteristic.scan_cache.networks = networks(3)
+    assert read(characteristic, DEVICE_A, MTU - 1, mtu=MTU) == first[MTU - 1:]
+    assert read(characteristic, DEVICE_A, 2 * (MTU - 1), mtu=MTU) == first[2 * (MTU - 1):]
+
+
+def test_snapshot_is_dropped_after_the_last_chunk(characteristic):
+    first = read(characteristic, DEVICE_A, mtu=MTU)
+    session = characteristic.sessions[DEVICE_A]
+    characteristic.scan_cache.networks = networks(3)
+    assert read(characteristic, DEVICE_A, len(first) - 5, mtu=MTU) == first[-5:]
+    assert session.read_buffer is None
+    assert read(characteristic, DEVICE_A, mtu=MTU) == characteristic.encode_scan_list(session)
+
+
+def test_offset_at_the_end_is_empty_and_past_it_is_rejected(characteristic):
+    first = read(characteristic, DEVICE_A, mtu=MTU)
+    with pytest.raises(InvalidOffsetException):
+        read(characteristic, DEVICE_A, len(first) + 1, mtu=MTU)
+    assert read(characteristic, DEVICE_A, len(first), mtu=MTU) == b''
+
+
+def test_snapshots_are_kept_per_device(characteristic):
+    first = read(characteristic, DEVICE_A, mtu=MTU)
+    characteristic.scan_cache.networks = networks(3)
+    assert read(characteristic, DEVICE_B, mtu=MTU) != first
+    assert read(characteristic, DEVICE_A, MTU - 1, mtu=MTU) == first[MTU - 1:]
+
+
+@pytest.fixture
+def devices(bluez):
+    return [str(bluez.control.AddDevice(address, True)) for address in ('AA:AA:AA:AA:AA:01', 'AA:AA:AA:AA:AA:02')]
+
+
+def test_default_read_lists_one_ssid_per_line(characteristic):
+    assert read(characteristic, DEVICE_A).split(b'\n') == [f'network-{i:02d}'.encode() for i in range(10)]
+
+
+def test_payload_format_is_kept_per_device(characteristic):
+    write(characteristic, DEVICE_A, [FORMAT_BINARY])
+    assert read(characteristic, DEVICE_A)[0] == MSG_SCAN
+    assert read(characteristic, DEVICE_B) == characteristic.encode_scan_list(characteristic.sessions[DEVICE_B])
+    assert characteristic.sessions[DEVICE_B].format == FORMAT_JSON
+
+
+def test_connects_run_one_at_a_time(characteristic):
+    backend = characteristic.wifi_manager.backend
+    write(characteristic, DEVICE_A, {"ssid": "home", "psk": PSK})
+    write(characteristic, DEVICE_B, {"ssid": "office", "psk": PSK})
+    assert [connect.ssid for connect in backend.connects] == ["home"]
+    session_b = characteristic.sessions[DEVICE_B]
+    assert (session_b.status, session_b.reason) == ("queued", "Position 1")
+    backend.connects[0].succeed()
+    assert characteristic.sessions[DEVICE_A].status == "connected"
+    assert [connect.ssid for connect in backend.connects] == ["home", "office"]
+    assert characteristic.active_connect is session_b
+
+
+def test_write_while_a_connect_is_pending_is_ignored(characteristic):
+    backend = characteristic.wifi_manager.backend
+    write(characteristic, DEVICE_A, {"ssid": "home", "psk": PSK})
+    write(characteristic, DEVICE_A, {"ssid": "office", "psk": PSK})
+    assert [connect.ssid for connect in backend.connects] == ["home"]
+    assert not characteristic.connect_queue
+
+
+def test_disconnected_device_leaves_the_queue(characteristic, devices):
+    device_a, device_b = devices
+    backend = characteristic.wifi_manager.backend
+    write(characteristic, device_a, {"ssid": "home", "psk": PSK})
+    write(characteristic, device_b, {"ssid": "office", "psk": PSK})
+    characteristic.devices.bus.get_object('org.bluez', '/').SetConnected(
+        device_b, False, dbus_interface='org.bluez.test.Control1')
+    assert run_until(lambda: device_b not in characteristic.sessions)
+    assert not characteristic.connect_queue
+    backend.connects[0].succeed()
+    assert [connect.ssid for connect in backend.connects] == ["home"]
+    assert characteristic.active_connect is None
+
+
+def test_notifications_carry_the_session_tag(characteristic):
+    characteristic.StartNotify()
+    write(characteristic, DEVICE_A, [FORMAT_JSON, 7])
+    write(characteristic, DEVICE_B, [FORMAT_JSON, 9])
+    write(characteristic, DEVICE_A, {"ssid": "home", "psk": PSK})
+    write(characteristic, DEVICE_B, {"ssid": "office", "psk": PSK})
+    characteristic.wifi_manager.backend.connects[0].succeed()
+    by_tag = {}
+    for payload in notified(characteristic):
+        by_tag.setdefault(payload["tag"], []).append(payload["status"])
+    assert by_tag[7][-1] == "connected"
+    assert by_tag[9][-1] == "associating"
+    assert "connected" not in by_tag[9]
+
+
+def test_tag_must_fit_in_a_byte(characteristic):
+    with pytest.raises(dbus.exceptions.DBusException):
+        write(characteristic, DEVICE_A, {"tag": 256, "command": "rescan"})
+    assert characteristic.sessions[DEVICE_A].tag == 0
+
+
+def test_targeted_rescan_merges_into_the_list(characteristic):
+    characteristic.StartNotify()
+    backend = characteristic.wifi_manager.backend
+    backend.networks = [AccessPoint('hidden', '00:00:00:00:00:01', 95, 'WPA2', 11),
+                        AccessPoint('other', '00:00:00:00:00:02', 95, 'WPA2', 1)]
+    write(characteristic, DEVICE_A, {"command": "rescan", "ssids": ["hidden"], "channels": [11]})
+    assert characteristic.scan_cache.get()[0].ssid == 'hidden'
+    assert 'other' not in [ap.ssid for ap in characteristic.scan_cache.get()]
+    assert run_until(lambda: notified(characteristic)[-1:] == [
+        {"tag": 0, "status": "scanned", "reason": "1 networks", "ip": None}])
+
+
+@pytest.mark.parametrize('command', [{"command": "rescan", "ssids": "hidden"},
+                                     {"command": "rescan", "ssids": ["hidden"], "channels": ["11"]}])
+def test_malformed_rescan_is_rejected(characteristic, command):
+    with pytest.raises(dbus.exceptions.DBusException):
+        write(characteristic, DEVICE_A, command)
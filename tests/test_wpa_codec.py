@@ -0,0 +1,138 @@
+import json
+import struct
+from collections import namedtuple
+
+from wpa_codec import (
+    DELTA_ADDED, DELTA_CHANGED, DELTA_REMOVED, ERROR_CODES, ERROR_UNKNOWN, FORMAT_BINARY, FORMAT_JSON_DETAILED,
+    MAX_REASON_LENGTH, MAX_SSID_LENGTH, MAX_STATE_REASON_LENGTH, MSG_KNOWN, MSG_SCAN, MSG_SCAN_DELTA, MSG_STATE,
+    MSG_STATUS, SCAN_ENTRY_HEADER, SECURITY_ENTERPRISE, SECURITY_OPEN, SECURITY_WEP, SECURITY_WPA2, SECURITY_WPA3,
+    STATE_HEADER, STATUS_CODES, STATUS_HEADER, STATUS_UNKNOWN, encode_bssid, encode_ipv4, encode_known,
+    encode_scan, encode_scan_delta, encode_state, encode_status, encode_utf8, security_flags, signal_to_rssi,
+)
+
+
+AccessPoint = namedtuple('AccessPoint', ['ssid', 'bssid', 'signal', 'security', 'channel'])
+KnownNetwork = namedtuple('KnownNetwork', ['ssid', 'bssid', 'channel', 'last_connected'])
+
+
+def test_encode_utf8_keeps_whole_characters():
+    assert encode_utf8('aé', 2) == b'a'
+    assert encode_utf8('aé', 3) == 'aé'.encode('utf-8')
+    assert encode_utf8(None, 10) == b''
+
+
+def test_encode_ipv4_falls_back_to_zero_address():
+    assert encode_ipv4('192.168.1.20') == bytes((192, 168, 1, 20))
+    assert encode_ipv4(None) == bytes(4)
+    assert encode_ipv4('not an address') == bytes(4)
+
+
+def test_encode_bssid_rejects_malformed_addresses():
+    assert encode_bssid('AA:bb:01:02:03:04') == bytes((0xAA, 0xBB, 1, 2, 3, 4))
+    assert encode_bssid('AA:BB') == bytes(6)
+    assert encode_bssid('zz:zz:zz:zz:zz:zz') == bytes(6)
+    assert encode_bssid(None) == bytes(6)
+
+
+def test_security_flags():
+    assert security_flags('') == SECURITY_OPEN
+    assert security_flags('WEP') == SECURITY_WEP
+    assert security_flags('WPA2 WPA3') == SECURITY_WPA2 | SECURITY_WPA3
+    assert security_flags('WPA2 802.1X') & SECURITY_ENTERPRISE
+
+
+def test_signal_to_rssi_is_clamped():
+    assert signal_to_rssi(100) == -50
+    assert signal_to_rssi(0) == -100
+    assert signal_to_rssi(500) == 0
+
+
+def test_encode_status_json():
+    payload = json.loads(encode_status("connected", "Connected successfully", "10.0.0.2", tag=4))
+    assert payload == {"tag": 4, "status": "connected", "reason": "Connected successfully", "ip": "10.0.0.2"}
+
+
+def test_encode_status_binary_fits_one_notification():
+    value = encode_status("failed", "x" * 100, "10.0.0.2", FORMAT_BINARY, tag=9)
+    msg_type, tag, status, ip = STATUS_HEADER.unpack(value[:STATUS_HEADER.size])
+    assert (msg_type, tag, status, ip) == (MSG_STATUS, 9, STATUS_CODES["failed"], bytes((10, 0, 0, 2)))
+    assert value[STATUS_HEADER.size:] == b'x' * MAX_REASON_LENGTH
+    assert len(value) == 20
+
+
+def test_encode_status_binary_unknown_status():
+    value = encode_status("bogus", fmt=FORMAT_BINARY)
+    assert value[2] == STATUS_UNKNOWN
+
+
+def test_encode_status_binary_truncates_on_character_boundary():
+    value = encode_status("failed", "é" * 20, fmt=FORMAT_BINARY)
+    assert value[STATUS_HEADER.size:].decode('utf-8') == 'é' * (MAX_REASON_LENGTH // 2)
+
+
+def test_encode_state_json():
+    payload = json.loads(encode_state("failed", "Wrong password", None, "auth_failed", 1234, tag=2))
+    assert payload == {"tag": 2, "status": "failed", "reason": "Wrong password", "error": "auth_failed",
+                       "ip": None, "t": 1234}
+
+
+def test_encode_state_binary():
+    value = encode_state("dhcp", "r" * 50, "1.2.3.4", None, 2 ** 40, FORMAT_BINARY, tag=1)
+    msg_type, tag, state, error, elapsed, ip = STATE_HEADER.unpack(value[:STATE_HEADER.size])
+    assert (msg_type, tag, state, error) == (MSG_STATE, 1, STATUS_CODES["dhcp"], ERROR_CODES[None])
+    assert elapsed == 0xFFFFFFFF
+    assert ip == bytes((1, 2, 3, 4))
+    assert len(value[STATE_HEADER.size:]) == MAX_STATE_REASON_LENGTH
+
+
+def test_encode_state_binary_unknown_error():
+    value = encode_state("failed", error="bogus", fmt=FORMAT_BINARY)
+    assert value[3] == ERROR_UNKNOWN
+
+
+def test_encode_scan_default_is_one_ssid_per_line():
+    networks = [AccessPoint('home', 'aa:bb:cc:dd:ee:ff', 80, 'WPA2', 6),
+                AccessPoint('café', 'aa:bb:cc:dd:ee:00', 40, '', 1)]
+    assert encode_scan(networks) == 'home\ncafé'.encode('utf-8')
+    assert encode_scan([]) == b''
+
+
+def test_encode_scan_detailed_json_carries_all_fields():
+    networks = [AccessPoint('home', 'aa:bb:cc:dd:ee:ff', 80, 'WPA2', 6)]
+    assert json.loads(encode_scan(networks, FORMAT_JSON_DETAILED)) == [
+        {"ssid": "home", "rssi": -60, "security": "WPA2", "channel": 6}]
+
+
+def test_encode_scan_binary():
+    long_ssid = 'n' * 40
+    value = encode_scan([AccessPoint('home', None, 80, 'WPA2', 6), AccessPoint(long_ssid, None, 20, '', 36)],
+                        FORMAT_BINARY)
+    assert value[0] == MSG_SCAN
+    offset = 1
+    entries = []
+    while offset < len(value):
+        rssi, security, channel, length = SCAN_ENTRY_HEADER.unpack_from(value, offset)
+        offset += SCAN_ENTRY_HEADER.size
+        entries.append((rssi, security, channel, value[offset:offset + length].decode('utf-8')))
+        offset += length
+    assert entries == [(-60, SECURITY_WPA2, 6, 'home'), (-90, SECURITY_OPEN, 36, 'n' * MAX_SSID_LENGTH)]
+
+
+def test_encode_known():
+    networks = [KnownNetwork('home', 'aa:bb:cc:dd:ee:ff', 11, 1700000000)]
+    assert json.loads(encode_known(networks)) == [
+        {"ssid": "home", "bssid": "aa:bb:cc:dd:ee:ff", "channel": 11, "last_connected": 1700000000}]
+    value = encode_known([KnownNetwork('home', None, None, 0)], FORMAT_BINARY)
+    assert value == bytes((MSG_KNOWN,)) + bytes(6) + struct.pack('!BB', 0, 4) + b'home'
+
+
+def test_encode_scan_delta():
+    ap = AccessPoint('home', None, 80, 'WPA2', 6)
+    deltas = [(DELTA_ADDED, ap), (DELTA_CHANGED, ap), (DELTA_REMOVED, ap)]
+    assert json.loads(encode_scan_delta(deltas)) == [
+        {"op": "added", "ssid": "home", "rssi": -60, "channel": 6},
+        {"op": "changed", "ssid": "home", "rssi": -60, "channel": 6},
+        {"op": "removed", "ssid": "home"},
+    ]
+    value = encode_scan_delta([(DELTA_REMOVED, ap)], FORMAT_BINARY)
+    assert value == bytes((MSG_SCAN_DELTA, DELTA_REMOVED)) + SCAN_ENTRY_HEADER.pack(0, 0, 0, 4) + b'home'
@@ -0,0 +1,1006 @@
+import functools
+import re
+import dbus
+import dbus.exceptions
+from collections import namedtuple
+from gi.repository import GLib
+from gatt_server import logger, call_async, DBUS_PROPERTIES_IFACE
+
+
+NM_SERVICE_NAME = 'org.freedesktop.NetworkManager'
+NM_PATH = '/org/freedesktop/NetworkManager'
+NM_SETTINGS_PATH = '/org/freedesktop/NetworkManager/Settings'
+NM_IFACE = 'org.freedesktop.NetworkManager'
+NM_SETTINGS_IFACE = 'org.freedesktop.NetworkManager.Settings'
+NM_SETTINGS_CONNECTION_IFACE = 'org.freedesktop.NetworkManager.Settings.Connection'
+NM_DEVICE_IFACE = 'org.freedesktop.NetworkManager.Device'
+NM_WIRELESS_IFACE = 'org.freedesktop.NetworkManager.Device.Wireless'
+NM_ACCESS_POINT_IFACE = 'org.freedesktop.NetworkManager.AccessPoint'
+NM_ACTIVE_CONNECTION_IFACE = 'org.freedesktop.NetworkManager.Connection.Active'
+NM_IP4_CONFIG_IFACE = 'org.freedesktop.NetworkManager.IP4Config'
+
+# NMActiveConnectionState values
+NM_ACTIVE_CONNECTION_STATE_ACTIVATING = 1
+NM_ACTIVE_CONNECTION_STATE_ACTIVATED = 2
+NM_ACTIVE_CONNECTION_STATE_DEACTIVATED = 4
+
+# NMSettingsUpdate2Flags value that writes a profile to disk
+NM_SETTINGS_UPDATE2_FLAG_TO_DISK = 0x1
+
+# NMActiveConnectionStateReason values worth a readable message
+NM_ACTIVE_CONNECTION_REASONS = {
+    5: "IP configuration could not be obtained",
+    6: "Timed out while connecting",
+    9: "Wrong password or missing secrets",
+    10: "Authentication failed",
+    11: "Connection was removed",
+}
+NM_ACTIVE_CONNECTION_ERRORS = {5: "dhcp_failed", 6: "timeout", 9: "auth_failed", 10: "auth_failed"}
+
+# NMDeviceState values and the connect stages they belong to
+NM_DEVICE_STATE_FAILED = 120
+NM_DEVICE_STAGES = {40: "associating", 50: "associating", 60: "authenticating", 70: "dhcp"}
+# NMDeviceStateReason values of a failed device
+NM_DEVICE_FAILURE_ERRORS = {
+    5: "dhcp_failed",
+    6: "dhcp_failed",
+    7: "auth_failed",
+    8: "auth_failed",
+    9: "association_failed",
+    10: "association_failed",
+    11: "timeout",
+    53: "network_not_found",
+}
+
+# wpa_supplicant runs the association and key handshakes inside NetworkManager's config stage
+WPA_SUPPLICANT_SERVICE = 'fi.w1.wpa_supplicant1'
+WPA_SUPPLICANT_IFACE = 'fi.w1.wpa_supplicant1.Interface'
+WPA_SUPPLICANT_STAGES = {
+    "authenticating": "associating",
+    "associating": "associating",
+    "associated": "associating",
+    "4way_handshake": "authenticating",
+    "group_handshake": "authenticating",
+}
+
+# Stages a connect attempt reports through its progress callback, in order
+CONNECT_STAGES = ("associating", "authenticating", "dhcp")
+
+# NMConnectivityState values that mean no internet access
+NM_CONNECTIVITY_ERRORS = {1: "no_internet", 2: "captive_portal", 3: "no_internet"}
+
+# NM80211ApFlags / NM80211ApSecurityFlags bits used to describe security
+NM_AP_FLAGS_PRIVACY = 0x1
+NM_AP_SEC_KEY_MGMT_PSK = 0x100
+NM_AP_SEC_KEY_MGMT_802_1X = 0x200
+NM_AP_SEC_KEY_MGMT_SAE = 0x400
+
+SCAN_FIELDS = 'SSID,BSSID,SIGNAL,SECURITY,CHAN'
+
+# nmcli error messages and the errors they stand for
+NMCLI_ERRORS = (
+    ("Secrets were required", "auth_failed"),
+    ("No network with SSID", "network_not_found"),
+    ("IP configuration", "dhcp_failed"),
+    ("Timeout", "timeout"),
+)
+NMCLI_CONNECTIVITY_ERRORS = {"none": "no_internet", "portal": "captive_portal", "limited": "no_internet"}
+
+CONNECT_TIMEOUT = 30
+CONNECTIVITY_TIMEOUT = 15
+# Upper bound for a targeted scan, it normally returns as soon as the targets are seen
+TARGETED_SCAN_TIMEOUT = 5
+# nmcli has no change signals, watching falls back to polling its cached list
+NMCLI_WATCH_INTERVAL = 2
+
+# nmcli reports the profile it created as "... successfully activated with '<uuid>'."
+NMCLI_ACTIVATED_UUID = re.compile(r"activated with '([0-9a-fA-F-]{36})'")
+
+AccessPoint = namedtuple('AccessPoint', ['ssid', 'bssid', 'signal', 'security', 'channel'])
+
+
+def strongest_per_ssid(access_points):
+    """
+    Keep the strongest BSSID of every named network, sorted by signal.
+    """
+    strongest = {}
+    for ap in access_points:
+        if not ap.ssid:
+            continue
+        if ap.ssid not in strongest or ap.signal > strongest[ap.ssid].signal:
+            strongest[ap.ssid] = ap
+    return sorted(strongest.values(), key=lambda ap: ap.signal, reverse=True)
+
+
+def match_targets(access_points, ssids, channels=None):
+    """
+    Keep the access points of the wanted SSIDs, optionally only on the given
+    channels, strongest BSSID per SSID.
+    """
+    return strongest_per_ssid(ap for ap in access_points
+                              if ap.ssid in ssids and (not channels or ap.channel in channels))
+
+
+def key_management(psk, passphrase=None, security=None):
+    """
+    Pick the key management and the secret to send for an access point
+    whose scan reported `security`, e.g. "WPA2 WPA3". The derived `psk` only
+    works for WPA1/WPA2-PSK; WPA3-SAE needs the `passphrase`, so does
+    transition mode, where NetworkManager picks the method. Without a scan
+    result the passphrase is sent too. Returns (key_mgmt, secret).
+    """
+    modes = set(security.split()) if security else set()
+    sae_only = 'WPA3' in modes and not modes & {'WPA1', 'WPA2'}
+    if passphrase is None:
+        if sae_only:
+            logger.warning("WPA3-only network but only the derived PSK is known, connecting with WPA2-PSK")
+        return 'wpa-psk', psk
+    if sae_only:
+        return 'sae', passphrase
+    if modes and 'WPA3' not in modes:
+        return 'wpa-psk', psk
+    return 'wpa-psk', passphrase
+
+
+def frequency_to_channel(frequency):
+    """
+    Convert a centre frequency in MHz to its Wi-Fi channel number.
+    """
+    if frequency == 2484:
+        return 14
+    if 2412 <= frequency < 2484:
+        return (frequency - 2407) // 5
+    if 5950 <= frequency <= 7125:
+        return (frequency - 5950) // 5
+    if 5000 <= frequency < 5950:
+        return (frequency - 5000) // 5
+    return 0
+
+
+class NmcliBackend:
+    """
+    Wi-Fi backend driving the nmcli command line tool through Gio.Subprocess.
+    """
+    name = 'nmcli'
+
+    def __init__(self, interface="wlan0"):
+        self.interface = interface
+
+    def spawn(self, cmd, capture_stderr):
+        # Gio is only loaded once the nmcli fallback is actually used
+        from gi.repository import Gio
+        stderr = Gio.SubprocessFlags.STDERR_PIPE if capture_stderr else Gio.SubprocessFlags.STDERR_SILENCE
+        return Gio.Subprocess.new(cmd, Gio.SubprocessFlags.STDOUT_PIPE | stderr)
+
+    def connect(self, ssid, psk, callback, timeout=CONNECT_TIMEOUT, bssid=None, channel=None, hidden=False,
+                progress=None, passphrase=None, security=None):
+        """
+        Connect with `nmcli device wifi connect`. nmcli can pin the BSSID but
+        has no channel option, so `channel` is ignored. nmcli does not report
+        intermediate stages, `progress` is never called. nmcli picks the key
+        management itself, `passphrase` and `security` only decide whether
+        the passphrase or the derived `psk` is sent (see key_management).
+        """
+        _, secret = key_management(psk, passphrase, security)
+        cmd = [
+            "nmcli", "--wait", str(int(timeout)), "device", "wifi", "connect", ssid,
+            "password", secret,
+            "ifname", self.interface
+        ]
+        if bssid:
+            cmd += ["bssid", bssid]
+        if hidden:
+            cmd += ["hidden", "yes"]
+        logger.info(f"Running command: nmcli device wifi connect {ssid} ifname {self.interface}"
+                    + (f" bssid {bssid}" if bssid else ""))
+        self.run_connect(cmd, callback, None)
+
+    def activate_profile(self, uuid, callback, timeout=CONNECT_TIMEOUT, progress=None):
+        cmd = ["nmcli", "--wait", str(int(timeout)), "connection", "up", "uuid", uuid, "ifname", self.interface]
+        logger.info(f"Running command: nmcli connection up uuid {uuid} ifname {self.interface}")
+        self.run_connect(cmd, callback, uuid)
+
+    def delete_profile(self, uuid):
+        def on_finished(process, result):
+            try:
+                _, _, stderr = process.communicate_utf8_finish(result)
+            except GLib.Error as e:
+                logger.warning(f"Could not delete profile {uuid}: {e.message}")
+                return
+            if process.get_successful():
+                logger.info(f"Deleted profile {uuid}")
+            else:
+                logger.warning(f"Could not delete profile {uuid}: {(stderr or '').strip()}")
+        try:
+            process = self.spawn(["nmcli", "connection", "delete", "uuid", uuid], capture_stderr=True)
+        except GLib.Error as e:
+            logger.warning(f"Could not delete profile {uuid}: {e.message}")
+            return
+        process.communicate_utf8_async(None, None, on_finished)
+
+    def run_connect(self, cmd, callback, profile):
+        try:
+            process = self.spawn(cmd, capture_stderr=True)
+        except GLib.Error as e:
+            callback({"success": False, "message": e.message, "ip": None})
+            return
+        process.communicate_utf8_async(None, None, self._on_connect_finished, (callback, profile))
+
+    def _on_connect_finished(self, process, result, context):
+        callback, profile = context
+        try:
+            _, stdout, stderr = process.communicate_utf8_finish(result)
+        except GLib.Error as e:
+            callback({"success": False, "message": e.message, "ip": None})
+            return
+        if process.get_successful():
+            logger.info(f"nmcli: {(stdout or '').strip()}")
+            match = NMCLI_ACTIVATED_UUID.search(stdout or "")
+            if match:
+                profile = match.group(1)
+            callback({"success": True, "message": "Connected successfully", "ip": None, "profile": profile})
+            return
+        message = (stderr or "").strip() or "Unknown error"
+        error = next((error for text, error in NMCLI_ERRORS if text in message), None)
+        callback({"success": False, "message": message, "ip": None, "error": error})
+
+    def check_connectivity(self, callback):
+        """
+        Run `nmcli networking connectivity check` and report None when the
+        internet is reachable or the state is unknown, otherwise the error.
+        """
+        def on_finished(process, result):
+            try:
+                _, stdout, _ = process.communicate_utf8_finish(result)
+            except GLib.Error as e:
+                logger.warning(f"Connectivity check failed: {e.message}")
+                callback(None)
+                return
+            callback(NMCLI_CONNECTIVITY_ERRORS.get((stdout or "").strip()))
+        try:
+            process = self.spawn(["nmcli", "networking", "connectivity", "check"], capture_stderr=False)
+        except GLib.Error as e:
+            logger.warning(f"Connectivity check failed: {e.message}")
+            callback(None)
+            return
+        process.communicate_utf8_async(None, None, on_finished)
+
+    def scan(self, callback, rescan=False):
+        cmd = ['nmcli', '-t', '-f', SCAN_FIELDS, 'device', 'wifi', 'list', '--rescan', 'yes' if rescan else 'no']
+        try:
+            process = self.spawn(cmd, capture_stderr=False)
+        except GLib.Error as e:
+            logger.error(f"Error scanning Wi-Fi networks: {e.message}")
+            callback(None)
+            return
+        process.communicate_utf8_async(None, None, self._on_scan_finished, callback)
+
+    def _on_scan_finished(self, process, result, callback):
+        try:
+            _, stdout, _ = process.communicate_utf8_finish(result)
+        except GLib.Error as e:
+            logger.error(f"Error scanning Wi-Fi networks: {e.message}")
+            callback(None)
+            return
+        if not process.get_successful():
+            logger.error(f"Error scanning Wi-Fi networks: nmcli exited with {process.get_exit_status()}")
+            callback(None)
+            return
+        callback(self.parse_scan(stdout or ""))
+
+    def scan_for(self, ssids, callback, channels=None, timeout=TARGETED_SCAN_TIMEOUT):
+        """
+        Look for specific networks, hidden ones included. The cached list is
+        checked first; only when a target is missing are the SSIDs probed
+        with `nmcli device wifi rescan ssid ...`, which cannot return before
+        the scan ends.
+        """
+        def on_rescanned(process, result):
+            try:
+                process.communicate_utf8_finish(result)
+            except GLib.Error as e:
+                logger.warning(f"Targeted scan failed: {e.message}")
+            self.scan(lambda access_points: callback(match_targets(access_points or [], ssids, channels)))
+
+        def on_cached(access_points):
+            found = match_targets(access_points or [], ssids, channels)
+            if len(found) == len(set(ssids)):
+                callback(found)
+                return
+            cmd = ['nmcli', '--wait', str(int(timeout)), 'device', 'wifi', 'rescan', 'ifname', self.interface]
+            for ssid in ssids:
+                cmd += ['ssid', ssid]
+            try:
+                process = self.spawn(cmd, capture_stderr=False)
+            except GLib.Error as e:
+                logger.warning(f"Targeted scan failed: {e.message}")
+                callback(found)
+                return
+            process.communicate_utf8_async(None, None, on_rescanned)
+
+        self.scan(on_cached)
+
+    def watch(self, callback):
+        """
+        Report the scan list to callback(access_points) after a fresh scan
+        and then every NMCLI_WATCH_INTERVAL seconds. Returns an object with
+        stop().
+        """
+        return NmcliAccessPointWatch(self, callback)
+
+    def parse_scan(self, output):
+        """
+        Parse terse nmcli output into AccessPoints. Lines that do not parse
+        are skipped.
+        """
+        access_points = []
+        for line in output.splitlines():
+            fields = self._split_terse(line)
+            if len(fields) != 5:
+                continue
+            ssid, bssid, signal, security, channel = fields
+            try:
+                access_points.append(AccessPoint(ssid, bssid, int(signal), security, int(channel)))
+            except ValueError:
+                continue
+        return strongest_per_ssid(access_points)
+
+    def _split_terse(self, line):
+        # nmcli -t separates fields with ':' and escapes literal ':' and '\\'
+        fields, current, escaped = [], [], False
+        for char in line:
+            if escaped:
+                current.append(char)
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == ':':
+                fields.append(''.join(current))
+                current = []
+            else:
+                current.append(char)
+        fields.append(''.join(current))
+        return fields
+
+
+class NmcliAccessPointWatch:
+    """
+    Polls nmcli's cached scan list, the closest nmcli gets to change signals.
+    """
+    def __init__(self, backend, callback, interval=NMCLI_WATCH_INTERVAL):
+        self.backend = backend
+        self.callback = callback
+        self.stopped = False
+        self.backend.scan(self.on_scan, rescan=True)
+        self.timer_id = GLib.timeout_add_seconds(interval, self.on_timer)
+
+    def on_scan(self, access_points):
+        if not self.stopped and access_points is not None:
+            self.callback(access_points)
+
+    def on_timer(self):
+        self.backend.scan(self.on_scan)
+        return True
+
+    def stop(self):
+        self.stopped = True
+        if self.timer_id is not None:
+            GLib.source_remove(self.timer_id)
+            self.timer_id = None
+
+
+def until_ready(method):
+    """
+    Run a NetworkManagerBackend method once the device lookup has finished,
+    or the nmcli fallback's method of the same name if the lookup failed.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        def run(_):
+            if self.fallback is not None:
+                getattr(self.fallback, method.__name__)(*args, **kwargs)
+            else:
+                method(self, *args, **kwargs)
+
+        self.ready.add_done_callback(run)
+    return wrapper
+
+
+class DeferredWatch:
+    """
+    Watch handle handed out before the backend is ready. The real watch is
+    started once it is, unless stop() was called first.
+    """
+    def __init__(self):
+        self.watch = None
+        self.stopped = False
+
+    def start(self, create):
+        if not self.stopped:
+            self.watch = create()
+
+    def stop(self):
+        self.stopped = True
+        if self.watch is not None:
+            self.watch.stop()
+            self.watch = None
+
+
+class NetworkManagerBackend:
+    """
+    Wi-Fi backend talking to NetworkManager over D-Bus. Every call uses
+    reply/error handlers so nothing blocks the main loop. Pass a session bus
+    and a fake NetworkManager service to run it off-target.
+
+    The device is looked up asynchronously; calls made before the lookup
+    finishes wait for `ready`, and if it fails they go to nmcli instead.
+    """
+    name = 'networkmanager'
+
+    SCAN_TIMEOUT = 10
+
+    def __init__(self, bus, interface="wlan0"):
+        self.bus = bus
+        self.interface = interface
+        self.nm = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, NM_PATH, introspect=False), NM_IFACE)
+        self.settings = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, NM_SETTINGS_PATH, introspect=False),
+                                       NM_SETTINGS_IFACE)
+        self.device_path = None
+        self.device_obj = None
+        self.wireless = None
+        self.fallback = None
+        self.ready = call_async(self.nm.GetDeviceByIpIface, interface)
+        self.ready.add_done_callback(self.on_device_found)
+
+    def on_device_found(self, future):
+        if future.exception() is not None:
+            logger.warning(f"NetworkManager has no device {self.interface}, using nmcli: {future.exception()}")
+            self.fallback = NmcliBackend(self.interface)
+            return
+        self.device_path = future.result()
+        self.device_obj = self.bus.get_object(NM_SERVICE_NAME, self.device_path)
+        self.wireless = dbus.Interface(self.device_obj, NM_WIRELESS_IFACE)
+        logger.info(f"NetworkManager device for {self.interface}: {self.device_path}")
+
+    @until_ready
+    def scan(self, callback, rescan=False):
+        if not rescan:
+            self._get_access_points(callback)
+            return
+        scan = {'done': False}
+
+        def finish(*args):
+            if scan['done']:
+                return False
+            scan['done'] = True
+            match.remove()
+            GLib.source_remove(timeout_id)
+            self._get_access_points(callback)
+            return False
+
+        def on_properties_changed(interface, changed, invalidated):
+            if 'LastScan' in changed:
+                finish()
+
+        def on_error(error):
+            # NM refuses scans that are already running or too frequent,
+            # the cached list is still the best answer in that case
+            logger.warning(f"RequestScan failed: {error}")
+            finish()
+
+        match = self.bus.add_signal_receiver(
+            on_properties_changed, dbus_interface=DBUS_PROPERTIES_IFACE, signal_name='PropertiesChanged',
+            bus_name=NM_SERVICE_NAME, path=self.device_path, arg0=NM_WIRELESS_IFACE)
+        timeout_id = GLib.timeout_add_seconds(self.SCAN_TIMEOUT, finish)
+        self.wireless.RequestScan(dbus.Dictionary({}, signature='sv'), reply_handler=lambda: None, error_handler=on_error)
+
+    @until_ready
+    def scan_for(self, ssids, callback, channels=None, timeout=TARGETED_SCAN_TIMEOUT):
+        """
+        Look for specific networks, hidden ones included, and report the
+        matches as soon as every target has been seen. Targets already in
+        NetworkManager's list are answered without scanning; otherwise only
+        the wanted SSIDs are probed and each new access point is checked as
+        NetworkManager adds it. NetworkManager cannot limit a scan to
+        channels, so `channels` only filters the matches.
+        """
+        targets = set(ssids)
+        found = {}
+        scan = {'done': False, 'requested': False}
+
+        def finish(*args):
+            if scan['done']:
+                return False
+            scan['done'] = True
+            for match in matches:
+                match.remove()
+            GLib.source_remove(timeout_id)
+            callback(strongest_per_ssid(found.values()))
+            return False
+
+        def add(access_points):
+            for ap in match_targets(access_points, targets, channels):
+                if ap.ssid not in found or ap.signal > found[ap.ssid].signal:
+                    found[ap.ssid] = ap
+            if set(found) >= targets:
+                finish()
+
+        def on_access_point_added(path):
+            props = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, path), DBUS_PROPERTIES_IFACE)
+            props.GetAll(NM_ACCESS_POINT_IFACE,
+                         reply_handler=lambda p: add([self.access_point_from_properties(p)]) if not scan['done'] else None,
+                         error_handler=lambda e: None)
+
+        def on_properties_changed(interface, changed, invalidated):
+            # Hidden networks get their SSID once the probe is answered, read the list again
+            if 'LastScan' in changed and scan['requested'] and not scan['done']:
+                self._get_access_points(lambda access_points: (add(access_points or []), finish()))
+
+        def on_cached(access_points):
+            add(access_points or [])
+            if scan['done']:
+                return
+            scan['requested'] = True
+            options = dbus.Dictionary({
+                'ssids': dbus.Array([dbus.ByteArray(ssid.encode('utf-8')) for ssid in ssids], signature='ay'),
+            }, signature='sv')
+            self.wireless.RequestScan(options, reply_handler=lambda: None, error_handler=on_error)
+
+        def on_error(error):
+            logger.warning(f"Targeted scan failed: {error}")
+            finish()
+
+        matches = [
+            self.bus.add_signal_receiver(
+                on_access_point_added, dbus_interface=NM_WIRELESS_IFACE, signal_name='AccessPointAdded',
+                bus_name=NM_SERVICE_NAME, path=self.device_path),
+            self.bus.add_signal_receiver(
+                on_properties_changed, dbus_interface=DBUS_PROPERTIES_IFACE, signal_name='PropertiesChanged',
+                bus_name=NM_SERVICE_NAME, path=self.device_path, arg0=NM_WIRELESS_IFACE),
+        ]
+        timeout_id = GLib.timeout_add_seconds(timeout, finish)
+        self._get_access_points(on_cached)
+
+    def watch(self, callback):
+        """
+        Report the scan list to callback(access_points) every time
+        NetworkManager adds, removes or updates an access point, starting
+        with the ones it already knows. Returns an object with stop().
+        """
+        handle = DeferredWatch()
+        self.ready.add_done_callback(lambda _: handle.start(
+            lambda: self.fallback.watch(callback) if self.fallback is not None
+            else NetworkManagerAccessPointWatch(self, callback)))
+        return handle
+
+    def _get_access_points(self, callback):
+        def on_error(error):
+            logger.error(f"Error scanning Wi-Fi networks: {error}")
+            callback(None)
+
+        def on_paths(paths):
+            if not paths:
+                callback([])
+                return
+            access_points = []
+            remaining = {'count': len(paths)}
+
+            def collect(ap):
+                if ap is not None:
+                    access_points.append(ap)
+                remaining['count'] -= 1
+                if remaining['count'] == 0:
+                    callback(strongest_per_ssid(access_points))
+
+            for path in paths:
+                props = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, path), DBUS_PROPERTIES_IFACE)
+                props.GetAll(NM_ACCESS_POINT_IFACE,
+                             reply_handler=lambda p: collect(self.access_point_from_properties(p)),
+                             error_handler=lambda e: collect(None))
+
+        self.wireless.GetAllAccessPoints(reply_handler=on_paths, error_handler=on_error)
+
+    def access_point_from_properties(self, props):
+        ssid = bytes(bytearray(props.get('Ssid', []))).decode('utf-8', errors='replace')
+        wpa_flags = int(props.get('WpaFlags', 0))
+        rsn_flags = int(props.get('RsnFlags', 0))
+        security = []
+        if int(props.get('Flags', 0)) & NM_AP_FLAGS_PRIVACY and not (wpa_flags or rsn_flags):
+            security.append('WEP')
+        if wpa_flags:
+            security.append('WPA1')
+        if rsn_flags & NM_AP_SEC_KEY_MGMT_SAE:
+            # Transition mode networks offer both PSK and SAE
+            if rsn_flags & NM_AP_SEC_KEY_MGMT_PSK:
+                security.append('WPA2')
+            security.append('WPA3')
+        elif rsn_flags:
+            security.append('WPA2')
+        if (wpa_flags | rsn_flags) & NM_AP_SEC_KEY_MGMT_802_1X:
+            security.append('802.1X')
+        return AccessPoint(ssid, str(props.get('HwAddress', '')), int(props.get('Strength', 0)),
+                           ' '.join(security), frequency_to_channel(int(props.get('Frequency', 0))))
+
+    @until_ready
+    def connect(self, ssid, psk, callback, timeout=CONNECT_TIMEOUT, bssid=None, channel=None, hidden=False,
+                progress=None, passphrase=None, security=None):
+        """
+        Activate a new connection with AddAndActivateConnection2. The result,
+        including the DHCP address, is reported as soon as NetworkManager
+        signals it, or as a failure once `timeout` seconds have passed.
+        With `bssid` and `channel` the connection is pinned to a known
+        access point. `progress` is called with each of CONNECT_STAGES as
+        the connection reaches it. The key management follows the scanned
+        `security` of the network, see key_management.
+        """
+        key_mgmt, secret = key_management(psk, passphrase, security)
+        wireless = dbus.Dictionary({
+            'ssid': dbus.Array(ssid.encode('utf-8'), signature='y'),
+            'mode': dbus.String('infrastructure'),
+        }, signature='sv')
+        if hidden:
+            wireless['hidden'] = dbus.Boolean(True)
+        if bssid:
+            wireless['bssid'] = dbus.Array(bytes.fromhex(bssid.replace(':', '')), signature='y')
+        if channel:
+            wireless['band'] = dbus.String('bg' if channel <= 14 else 'a')
+            wireless['channel'] = dbus.UInt32(channel)
+        settings = dbus.Dictionary({
+            'connection': dbus.Dictionary({
+                'id': dbus.String(ssid),
+                'type': dbus.String('802-11-wireless'),
+            }, signature='sv'),
+            '802-11-wireless': wireless,
+            '802-11-wireless-security': dbus.Dictionary({
+                'key-mgmt': dbus.String(key_mgmt),
+                'psk': dbus.String(secret),
+            }, signature='sv'),
+        }, signature='sa{sv}')
+        logger.info(f"Activating {key_mgmt} connection to {ssid} on {self.device_path}"
+                    + (f" via {bssid} channel {channel}" if bssid else ""))
+        NetworkManagerActivation(self, ssid, callback, timeout, progress).start(settings)
+
+    @until_ready
+    def activate_profile(self, uuid, callback, timeout=CONNECT_TIMEOUT, progress=None):
+        """
+        Activate a saved connection profile. NetworkManager already has the
+        secrets and the last access point, so this skips the full setup.
+        """
+        logger.info(f"Activating profile {uuid} on {self.device_path}")
+        NetworkManagerActivation(self, f"profile {uuid}", callback, timeout, progress).start_profile(uuid)
+
+    @until_ready
+    def check_connectivity(self, callback):
+        """
+        Ask NetworkManager for a fresh connectivity check and report None
+        when the internet is reachable or checking is disabled, otherwise
+        the error.
+        """
+        def on_error(error):
+            logger.warning(f"Connectivity check failed: {error}")
+            callback(None)
+
+        self.nm.CheckConnectivity(reply_handler=lambda state: callback(NM_CONNECTIVITY_ERRORS.get(int(state))),
+                                  error_handler=on_error, timeout=CONNECTIVITY_TIMEOUT)
+
+    @until_ready
+    def delete_profile(self, uuid):
+        def on_error(error):
+            logger.warning(f"Could not delete profile {uuid}: {error}")
+
+        def on_connection(path):
+            connection = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, path), NM_SETTINGS_CONNECTION_IFACE)
+            connection.Delete(reply_handler=lambda: logger.info(f"Deleted profile {uuid}"), error_handler=on_error)
+
+        self.settings.GetConnectionByUuid(uuid, reply_handler=on_connection, error_handler=on_error)
+
+
+class NetworkManagerAccessPointWatch:
+    """
+    Mirrors the device's access points from the AccessPointAdded and
+    AccessPointRemoved signals and the Strength updates of each access
+    point, then requests a scan so new ones show up as they are found.
+    """
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.bus = backend.bus
+        self.callback = callback
+        self.access_points = {}
+        self.stopped = False
+        self.matches = [
+            self.bus.add_signal_receiver(
+                self.on_access_point_added, dbus_interface=NM_WIRELESS_IFACE, signal_name='AccessPointAdded',
+                bus_name=NM_SERVICE_NAME, path=backend.device_path),
+            self.bus.add_signal_receiver(
+                self.on_access_point_removed, dbus_interface=NM_WIRELESS_IFACE, signal_name='AccessPointRemoved',
+                bus_name=NM_SERVICE_NAME, path=backend.device_path),
+            self.bus.add_signal_receiver(
+                self.on_properties_changed, dbus_interface=DBUS_PROPERTIES_IFACE, signal_name='PropertiesChanged',
+                bus_name=NM_SERVICE_NAME, arg0=NM_ACCESS_POINT_IFACE, path_keyword='path'),
+        ]
+        backend.wireless.GetAllAccessPoints(reply_handler=self.on_paths, error_handler=self.on_error)
+
+    def on_paths(self, paths):
+        for path in paths:
+            self.on_access_point_added(path)
+        self.backend.wireless.RequestScan(dbus.Dictionary({}, signature='sv'), reply_handler=lambda: None,
+                                          error_handler=lambda e: logger.warning(f"RequestScan failed: {e}"))
+
+    def on_access_point_added(self, path):
+        props = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, path), DBUS_PROPERTIES_IFACE)
+        props.GetAll(NM_ACCESS_POINT_IFACE, reply_handler=lambda p: self.update(path, p), error_handler=lambda e: None)
+
+    def on_access_point_removed(self, path):
+        if self.access_points.pop(path, None) is not None:
+            self.report()
+
+    def on_properties_changed(self, interface, changed, invalidated, path=None):
+        ap = self.access_points.get(path)
+        if ap is None:
+            return
+        if 'Ssid' in changed:
+            # A hidden network was named by a probe response, read it again
+            self.on_access_point_added(path)
+        elif 'Strength' in changed:
+            self.access_points[path] = ap._replace(signal=int(changed['Strength']))
+            self.report()
+
+    def update(self, path, props):
+        if self.stopped:
+            return
+        self.access_points[path] = self.backend.access_point_from_properties(props)
+        self.report()
+
+    def report(self):
+        if not self.stopped:
+            self.callback(strongest_per_ssid(self.access_points.values()))
+
+    def on_error(self, error):
+        logger.error(f"Error watching Wi-Fi networks: {error}")
+
+    def stop(self):
+        self.stopped = True
+        for match in self.matches:
+            match.remove()
+        self.matches = []
+
+
+class NetworkManagerActivation:
+    """
+    Follows one activation from AddAndActivateConnection2 or
+    ActivateConnection to a final result, driven by the ActiveConnection
+    StateChanged signal and its Ip4Config property rather than by polling.
+    Device and wpa_supplicant state changes are reported as connect stages.
+
+    A new connection is added as a volatile profile, which NetworkManager
+    deletes as soon as it deactivates, and is only saved to disk once it
+    has an address. Failed attempts therefore leave no profiles behind.
+    """
+    def __init__(self, backend, ssid, callback, timeout, progress=None):
+        self.backend = backend
+        self.bus = backend.bus
+        self.ssid = ssid
+        self.callback = callback
+        self.progress = progress
+        self.stage = None
+        self.device_reason = None
+        self.connection_path = None
+        self.active_path = None
+        # Only set for profiles added by start(), saved profiles stay as they are
+        self.save_profile = False
+        self.profile_saved = True
+        self.result = None
+        self.done = False
+        self.early_states = []
+        self.matches = [
+            self.bus.add_signal_receiver(
+                self.on_device_state_changed, dbus_interface=NM_DEVICE_IFACE, signal_name='StateChanged',
+                bus_name=NM_SERVICE_NAME, path=backend.device_path),
+            self.bus.add_signal_receiver(
+                self.on_supplicant_properties_changed, dbus_interface=DBUS_PROPERTIES_IFACE,
+                signal_name='PropertiesChanged', bus_name=WPA_SUPPLICANT_SERVICE, arg0=WPA_SUPPLICANT_IFACE),
+            self.bus.add_signal_receiver(
+                self.on_state_changed, dbus_interface=NM_ACTIVE_CONNECTION_IFACE, signal_name='StateChanged',
+                bus_name=NM_SERVICE_NAME, path_keyword='path'),
+            self.bus.add_signal_receiver(
+                self.on_properties_changed, dbus_interface=DBUS_PROPERTIES_IFACE, signal_name='PropertiesChanged',
+                bus_name=NM_SERVICE_NAME, arg0=NM_ACTIVE_CONNECTION_IFACE, path_keyword='path'),
+        ]
+        self.timeout_id = GLib.timeout_add_seconds(timeout, self.on_timeout)
+
+    def start(self, settings):
+        self.save_profile = True
+        self.backend.nm.AddAndActivateConnection2(
+            settings, self.backend.device_path, dbus.ObjectPath('/'),
+            dbus.Dictionary({'persist': dbus.String('volatile')}, signature='sv'),
+            reply_handler=lambda connection_path, active_path, result: self.on_activation_started(connection_path,
+                                                                                                active_path),
+            error_handler=self.on_error)
+
+    def start_profile(self, uuid):
+        self.backend.settings.GetConnectionByUuid(uuid, reply_handler=self.on_profile_found, error_handler=self.on_error)
+
+    def on_profile_found(self, connection_path):
+        self.backend.nm.ActivateConnection(
+            connection_path, self.backend.device_path, dbus.ObjectPath('/'),
+            reply_handler=lambda active_path: self.on_activation_started(connection_path, active_path),
+            error_handler=self.on_error)
+
+    def on_activation_started(self, connection_path, active_path):
+        self.connection_path = connection_path
+        self.active_path = active_path
+        if self.done:
+            # Timed out before the reply arrived
+            self.deactivate()
+            return
+        # Replay anything signalled before the reply told us which path to watch
+        for path, state, reason in self.early_states:
+            if path == active_path:
+                self.handle_state(state, reason)
+        self.early_states = []
+
+    def on_state_changed(self, state, reason, path=None):
+        if self.done:
+            return
+        if self.active_path is None:
+            self.early_states.append((path, state, reason))
+        elif path == self.active_path:
+            self.handle_state(state, reason)
+
+    def handle_state(self, state, reason):
+        if state == NM_ACTIVE_CONNECTION_STATE_ACTIVATED:
+            self.request_ip4_config()
+        elif state == NM_ACTIVE_CONNECTION_STATE_DEACTIVATED:
+            message = NM_ACTIVE_CONNECTION_REASONS.get(int(reason), f"Activation failed (reason {int(reason)})")
+            # The device's failure reason is more specific than the connection's
+            error = NM_DEVICE_FAILURE_ERRORS.get(self.device_reason) or NM_ACTIVE_CONNECTION_ERRORS.get(int(reason))
+            self.finish({"success": False, "message": message, "ip": None, "error": error})
+
+    def on_device_state_changed(self, new_state, old_state, reason):
+        if self.done:
+            return
+        if new_state == NM_DEVICE_STATE_FAILED:
+            self.device_reason = int(reason)
+        self.report_stage(NM_DEVICE_STAGES.get(int(new_state)))
+
+    def on_supplicant_properties_changed(self, interface, changed, invalidated):
+        if not self.done and 'State' in changed:
+            self.report_stage(WPA_SUPPLICANT_STAGES.get(str(changed['State'])))
+
+    def report_stage(self, stage):
+        # Only forward progress, the device and supplicant signals overlap
+        if stage is None or self.progress is None:
+            return
+        if self.stage is not None and CONNECT_STAGES.index(stage) <= CONNECT_STAGES.index(self.stage):
+            return
+        self.stage = stage
+        self.progress(stage)
+
+    def on_properties_changed(self, interface, changed, invalidated, path=None):
+        if self.done or path != self.active_path:
+            return
+        if changed.get('Ip4Config', '/') != '/':
+            self.request_addresses(changed['Ip4Config'])
+
+    def request_ip4_config(self):
+        props = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, self.active_path), DBUS_PROPERTIES_IFACE)
+        props.Get(NM_ACTIVE_CONNECTION_IFACE, 'Ip4Config',
+                  reply_handler=self.on_ip4_config, error_handler=self.on_error)
+
+    def on_ip4_config(self, config_path):
+        # '/' means DHCP has not finished yet, PropertiesChanged will follow
+        if config_path != '/':
+            self.request_addresses(config_path)
+
+    def request_addresses(self, config_path):
+        props = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, config_path), DBUS_PROPERTIES_IFACE)
+        props.Get(NM_IP4_CONFIG_IFACE, 'AddressData',
+                  reply_handler=self.on_address_data, error_handler=self.on_error)
+
+    def on_address_data(self, address_data):
+        if not address_data:
+            return
+        if self.result is not None:
+            return
+        ip = str(address_data[0]['address'])
+        logger.info(f"Connected to Wi-Fi network {self.ssid} with address {ip}")
+        self.result = {"success": True, "message": "Connected successfully", "ip": ip}
+        if self.save_profile:
+            self.save()
+        else:
+            self.request_details()
+
+    def save(self):
+        """
+        Write the volatile profile to disk now that it has worked.
+        """
+        connection = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, self.connection_path),
+                                    NM_SETTINGS_CONNECTION_IFACE)
+        connection.Update2(dbus.Dictionary({}, signature='sa{sv}'), dbus.UInt32(NM_SETTINGS_UPDATE2_FLAG_TO_DISK),
+                           dbus.Dictionary({}, signature='sv'),
+                           reply_handler=lambda result: self.request_details(), error_handler=self.on_save_error)
+
+    def on_save_error(self, error):
+        # Still connected, but the profile goes away with the connection
+        logger.warning(f"Could not save the profile for {self.ssid}: {error}")
+        self.profile_saved = False
+        self.request_details()
+
+    def request_details(self):
+        """
+        Add the profile UUID and the BSSID and channel of the access point
+        to the result so the network can be reconnected quickly later.
+        Failing to read them does not fail the connection.
+        """
+        props = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, self.active_path), DBUS_PROPERTIES_IFACE)
+        props.Get(NM_ACTIVE_CONNECTION_IFACE, 'Uuid', reply_handler=self.on_uuid, error_handler=self.on_details_error)
+
+    def on_uuid(self, uuid):
+        if self.profile_saved:
+            self.result['profile'] = str(uuid)
+        props = dbus.Interface(self.backend.device_obj, DBUS_PROPERTIES_IFACE)
+        props.Get(NM_WIRELESS_IFACE, 'ActiveAccessPoint',
+                  reply_handler=self.on_active_access_point, error_handler=self.on_details_error)
+
+    def on_active_access_point(self, ap_path):
+        if ap_path == '/':
+            self.finish(self.result)
+            return
+        props = dbus.Interface(self.bus.get_object(NM_SERVICE_NAME, ap_path), DBUS_PROPERTIES_IFACE)
+        props.GetAll(NM_ACCESS_POINT_IFACE, reply_handler=self.on_access_point, error_handler=self.on_details_error)
+
+    def on_access_point(self, props):
+        ap = self.backend.access_point_from_properties(props)
+        self.result['bssid'] = ap.bssid
+        self.result['channel'] = ap.channel
+        self.finish(self.result)
+
+    def on_details_error(self, error):
+        logger.warning(f"Could not read connection details: {error}")
+        self.finish(self.result)
+
+    def on_error(self, error):
+        self.finish({"success": False, "message": error.get_dbus_message(), "ip": None})
+
+    def on_timeout(self):
+        self.timeout_id = None
+        if self.result is None and self.active_path is not None:
+            self.deactivate()
+        # Connected but still reading the details, report what we have
+        self.finish(self.result or {"success": False, "message": "Timed out waiting for activation", "ip": None,
+                                    "error": "timeout"})
+        return False
+
+    def deactivate(self):
+        """
+        Abandon an activation that is still running. NetworkManager deletes
+        a volatile profile along with it.
+        """
+        self.backend.nm.DeactivateConnection(
+            self.active_path, reply_handler=lambda: logger.info(f"Abandoned activation of {self.ssid}"),
+            error_handler=lambda error: logger.warning(f"Could not deactivate {self.ssid}: {error}"))
+
+    def finish(self, result):
+        if self.done:
+            return
+        self.done = True
+        for match in self.matches:
+            match.remove()
+        if self.timeout_id is not None:
+            GLib.source_remove(self.timeout_id)
+        self.callback(result)
+
+
+def create_backend(bus=None, interface="wlan0"):
+    """
+    Prefer the NetworkManager D-Bus backend and fall back to nmcli when
+    NetworkManager cannot be reached over D-Bus. The interface is looked up
+    without blocking; if NetworkManager does not know it, the backend
+    hands its calls to nmcli itself.
+    """
+    if bus is not None:
+        try:
+            return NetworkManagerBackend(bus, interface)
+        except dbus.exceptions.DBusException as e:
+            logger.warning(f"NetworkManager D-Bus backend unavailable, using nmcli: {e}")
+    return NmcliBackend(interface)
@@ -1,92 +1,591 @@
 import json
-import sys
-import array
-import subprocess
 import dbus
 import socket
 import time
+from collections import deque
 from gi.repository import GLib
 from gatt_server import (
     GATT_CHARACTERISTIC_IFACE, CUDDiscriptor, Characteristic, InvalidValueLengthException, 
     logger, InvalidArgsException, NotSupportedException, Advertisement, Service, Application, Agent, 
-    AGENT_PATH, BLUEZ_SERVICE_NAME
+    AGENT_PATH, BLUEZ_SERVICE_NAME, GATT_ADAPTER_IFACE, AdvertisingController, InvalidOffsetException, NotifyScheduler,
+    get_object_cache, scheduler, call_async, gather
+)
+from network_store import NetworkStore, is_psk_hash, pmk_cache
+from wifi_backends import CONNECT_TIMEOUT, TARGETED_SCAN_TIMEOUT, create_backend
+from wpa_codec import (
+    DELTA_ADDED, DELTA_CHANGED, DELTA_REMOVED, FORMAT_JSON, FORMATS, encode_known, encode_scan, encode_scan_delta,
+    encode_state, encode_status, signal_to_rssi
 )
 
 mainloop = GLib.MainLoop()
 
 
 class WiFiManager:
-    def __init__(self, interface="wlan0"):
+    RETRY_DELAY = 1
+    # A saved profile or known access point either comes up quickly or not at all
+    FAST_CONNECT_TIMEOUT = 10
+
+    CONNECT_PROFILE = 'profile'
+    CONNECT_TARGETED = 'targeted'
+    CONNECT_FULL = 'full'
+
+    # Error reported for a failed attempt when the backend did not name one
+    STAGE_ERRORS = {
+        "scanning": "network_not_found",
+        "associating": "association_failed",
+        "authenticating": "auth_failed",
+        "dhcp": "dhcp_failed",
+    }
+
+    def __init__(self, interface="wlan0", bus=None, backend=None, store=None):
         self.interface = interface
         self.ssid = None
-        self.psk = None
+        self.hidden = False
+        self.stage = None
+        # Hex PSK, derived from the passphrase off the main loop
+        self.psk_future = None
+        self.psk_hash = None
+        # Kept for WPA3-SAE, None when only the hex PSK was given
+        self.passphrase = None
+        self.bus = bus
+        self._backend = backend
+        self._store = store
+
+    @property
+    def backend(self):
+        # Created on first use, NetworkManager lookups are not needed to advertise
+        if self._backend is None:
+            self._backend = create_backend(self.bus, self.interface)
+            logger.info(f"Using {self._backend.name} Wi-Fi backend")
+        return self._backend
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = NetworkStore()
+        return self._store
+
+    def set_credentials(self, ssid, psk, hidden=False):
+        """
+        Set the network to connect to. `psk` is the passphrase or the
+        64 hex digit PSK derived from it, `hidden` marks a network that does
+        not broadcast its SSID. Deriving the PSK starts right away on a
+        worker thread, connect() waits for it.
+        """
+        self.validate_credentials(ssid, psk)
+        self.ssid = ssid
+        self.hidden = hidden
+        self.psk_hash = None
+        self.passphrase = None if psk is None or is_psk_hash(psk) else psk
+        self.psk_future = pmk_cache.derive(ssid, psk)
+        logger.info(f"WiFi credentials set: SSID={self.ssid}")
 
-    def set_credentials(self, ssid, psk):
+    @staticmethod
+    def validate_credentials(ssid, psk):
+        """
+        Raise ValueError for an SSID or PSK the network could never accept.
+        A missing PSK is valid, it selects the stored credentials.
+        """
+        if not ssid:
+            raise ValueError("SSID must not be empty")
         if len(ssid) > 32:
             raise ValueError("SSID must be 32 characters or less")
-        if not (8 <= len(psk) <= 63):
+        if psk is not None and not (8 <= len(psk) <= 63 or is_psk_hash(psk)):
             raise ValueError("PSK must be between 8 and 63 characters")
-        self.ssid = ssid
-        self.psk = psk
-        logger.info(f"WiFi credentials set: SSID={self.ssid}")
 
-    def connect(self, retries=3, delay=5):
-        if not self.ssid or not self.psk:
+    def set_known_network(self, ssid):
+        """
+        Set the credentials of a stored network.
+        """
+        network = self.store.get(ssid)
+        if network is None:
+            raise ValueError(f"Unknown network {ssid}")
+        self.set_credentials(network.ssid, network.psk_hash, network.hidden)
+
+    def forget(self, ssid):
+        """
+        Remove a stored network and the NetworkManager profile created for it.
+        """
+        network = self.store.forget(ssid)
+        if network is None:
+            raise ValueError(f"Unknown network {ssid}")
+        if network.profile:
+            self.backend.delete_profile(network.profile)
+        logger.info(f"Forgot Wi-Fi network {ssid}")
+
+    def connect_plan(self, retries):
+        """
+        Connection attempts in order. A network stored with the same PSK is
+        first brought up from its saved profile, then on its last access
+        point, before falling back to `retries` full connects.
+        """
+        plan = []
+        known = self.store.get(self.ssid)
+        if known is not None and known.psk_hash == self.psk_hash:
+            if known.profile:
+                plan.append(self.CONNECT_PROFILE)
+            if known.bssid:
+                plan.append(self.CONNECT_TARGETED)
+        return plan + [self.CONNECT_FULL] * retries
+
+    def connect(self, callback, timeout=CONNECT_TIMEOUT, retries=3, progress=None):
+        """
+        Connect asynchronously through the backend, so this returns
+        immediately. Failed attempts are retried while the overall `timeout`
+        allows. `progress` is called with (stage, reason) as every attempt
+        goes through scanning, associating, authenticating and dhcp, then
+        once more with online_check. `callback` gets the final result dict,
+        whose "error" names the cause of a failure.
+        """
+        if not self.ssid or self.psk_future is None:
             raise ValueError("SSID and PSK must be set before connecting")
+        deadline = time.monotonic() + timeout
 
-        last_error = "Unknown error"
-        for attempt in range(1, retries + 1):
-            cmd = [
-                "nmcli", "device", "wifi", "connect", self.ssid,
-                "password", self.psk,
-                "ifname", self.interface
-            ]
+        def on_psk(future):
+            if future.exception() is not None:
+                logger.error(f"Could not derive PSK for {self.ssid}: {future.exception()}")
+                callback({"success": False, "message": "Could not derive PSK", "ip": None})
+                return
+            self.psk_hash = future.result()
+            self._connect_attempt(1, self.connect_plan(retries), deadline, callback, progress)
 
-            logger.info(f"Attempt {attempt}: Running command: {' '.join(cmd)}")
-            process = subprocess.run(cmd, capture_output=True, text=True)
+        self.psk_future.add_done_callback(on_psk)
 
-            if process.returncode == 0:
-                logger.info(f"Connected to Wi-Fi network {self.ssid}: {process.stdout}")
-                return {"success": True, "message": "Connected successfully"}
+    def _connect_attempt(self, attempt, plan, deadline, callback, progress):
+        strategy = plan[attempt - 1]
+        logger.info(f"Attempt {attempt} ({strategy}): connecting to {self.ssid} on {self.interface}")
+        self.stage = None
+        context = (attempt, plan, deadline, callback, progress)
+        on_result = lambda result: self._on_connect_finished(result, context)
+        on_stage = lambda stage: self._report_stage(stage, attempt, progress)
+        remaining = max(1, int(deadline - time.monotonic()))
+        known = self.store.get(self.ssid)
+        if strategy == self.CONNECT_PROFILE:
+            on_stage("associating")
+            self.backend.activate_profile(known.profile, on_result, min(remaining, self.FAST_CONNECT_TIMEOUT),
+                                          progress=on_stage)
+        elif strategy == self.CONNECT_TARGETED:
+            on_stage("associating")
+            self.backend.connect(self.ssid, self.psk_hash, on_result, min(remaining, self.FAST_CONNECT_TIMEOUT),
+                                 bssid=known.bssid, channel=known.channel, hidden=self.hidden, progress=on_stage,
+                                 passphrase=self.passphrase)
+        else:
+            # Probe for just this SSID first instead of relying on a full sweep
+            on_stage("scanning")
+            self.scan_for([self.ssid], lambda found: self._on_target_scanned(found, on_result, on_stage, deadline))
 
-            error_msg = process.stderr.strip()
-            logger.warning(f"Failed to connect (attempt {attempt}): {error_msg}")
-            last_error = error_msg
+    def _on_target_scanned(self, found, on_result, on_stage, deadline):
+        if not found:
+            logger.warning(f"{self.ssid} not seen by the targeted scan, connecting anyway")
+        on_stage("associating")
+        remaining = max(1, int(deadline - time.monotonic()))
+        # The key management depends on whether the network offers WPA2, WPA3 or both
+        security = found[0].security if found else None
+        self.backend.connect(self.ssid, self.psk_hash, on_result, remaining, hidden=self.hidden, progress=on_stage,
+                             passphrase=self.passphrase, security=security)
 
-            if attempt < retries:
-                time.sleep(delay)
+    def _report_stage(self, stage, attempt, progress):
+        if stage == self.stage:
+            return
+        self.stage = stage
+        if progress:
+            progress(stage, f"Attempt {attempt}")
 
-        logger.error(f"All {retries} connection attempts failed.")
-        return {"success": False, "message": last_error}
+    def _on_connect_finished(self, result, context):
+        attempt, plan, deadline, callback, progress = context
+        if result["success"]:
+            self.remember(result)
+            self._report_stage("online_check", attempt, progress)
+            self.backend.check_connectivity(lambda error: self._on_connectivity_checked(error, result, callback))
+            return
+        result["error"] = result.get("error") or self.STAGE_ERRORS.get(self.stage)
+        logger.warning(f"Failed to connect (attempt {attempt}, {result['error']}): {result['message']}")
+        if attempt < len(plan) and deadline - time.monotonic() > self.RETRY_DELAY:
+            if plan[attempt - 1] != self.CONNECT_FULL:
+                # Fast paths fall through to the next strategy straight away
+                self._connect_attempt(attempt + 1, plan, deadline, callback, progress)
+                return
+            GLib.timeout_add_seconds(self.RETRY_DELAY, self._retry_connect, attempt + 1, plan, deadline, callback, progress)
+            return
+        logger.error(f"Giving up after {attempt} connection attempts.")
+        callback(result)
 
-    def scan_wifi_networks(self):
-        try:
-            output = subprocess.check_output(
-                ['nmcli', '-t', '-f', 'SSID', 'device', 'wifi'],
-                text=True
-            )
-            ssids = list({line.strip() for line in output.splitlines() if line.strip()})
-            logger.info(f"Available Wi-Fi networks: {ssids}")
-            return ssids
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error scanning Wi-Fi networks: {e}")
-            return []
+    def _retry_connect(self, attempt, plan, deadline, callback, progress):
+        self._connect_attempt(attempt, plan, deadline, callback, progress)
+        return False
+
+    def _on_connectivity_checked(self, error, result, callback):
+        if error is not None:
+            # The Wi-Fi credentials worked, so the network stays remembered
+            logger.warning(f"Connected to {self.ssid} but the online check failed: {error}")
+            message = ("Captive portal login required" if error == "captive_portal"
+                       else "Connected to Wi-Fi but no internet access")
+            result = dict(result, success=False, message=message, error=error)
+        callback(result)
+
+    def remember(self, result):
+        """
+        Store the network after a successful connect. A profile replaced by
+        a new one is deleted so NetworkManager does not collect duplicates.
+        """
+        previous = self.store.get(self.ssid)
+        profile = result.get("profile")
+        if previous is not None and previous.profile and profile and previous.profile != profile:
+            self.backend.delete_profile(previous.profile)
+        self.store.remember(self.ssid, self.psk_hash, result.get("bssid"), result.get("channel"), profile, self.hidden)
+
+    def scan_for(self, ssids, callback, channels=None, timeout=TARGETED_SCAN_TIMEOUT):
+        """
+        Targeted scan for specific or hidden SSIDs, optionally only on some
+        channels. Returns as soon as every target is seen, so this usually
+        takes a few hundred milliseconds instead of a full sweep.
+        """
+        started = time.monotonic()
+
+        def on_scan(networks):
+            logger.info(f"Targeted scan for {ssids} found {[ap.ssid for ap in networks]} "
+                        f"in {(time.monotonic() - started) * 1000:.0f} ms")
+            callback(networks)
+        self.backend.scan_for(list(ssids), on_scan, channels=channels, timeout=timeout)
+
+    def watch_scan(self, callback):
+        """
+        Call callback(networks) whenever the backend's scan list changes,
+        until stop() is called on the returned watch.
+        """
+        return self.backend.watch(callback)
+
+    def scan_async(self, callback, rescan=False):
+        """
+        Scan without blocking the main loop. With `rescan` NetworkManager is
+        asked for a fresh sweep instead of returning its cached list.
+        """
+        def on_scan(networks):
+            if networks is not None:
+                logger.info(f"Available Wi-Fi networks: {[ap.ssid for ap in networks]}")
+            callback(networks)
+        self.backend.scan(on_scan, rescan=rescan)
+
+
+class ScanCache:
+    """
+    In-memory Wi-Fi scan results, refreshed in the background so reads
+    never wait on nmcli. The next refresh is due `ttl` seconds after the
+    last scan completed, so the list is never much older than that.
+    """
+    def __init__(self, wifi_manager, ttl=30):
+        self.wifi_manager = wifi_manager
+        self.ttl = ttl
+        self.networks = []
+        self.refreshing = False
+        self.rescan_requested = False
+        self.pending = []
+        self.running = False
+        self.timer = None
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.refresh()
+
+    def stop(self):
+        self.running = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def get(self):
+        return self.networks
+
+    def refresh(self, rescan=False, callback=None):
+        """
+        Start a background scan. Callers arriving while a scan is running
+        share its result instead of starting another one.
+        """
+        if callback:
+            self.pending.append(callback)
+        if self.refreshing:
+            self.rescan_requested = self.rescan_requested or rescan
+            return
+        self.refreshing = True
+        self.wifi_manager.scan_async(self._on_scan, rescan=rescan)
+
+    def _on_scan(self, networks):
+        self.refreshing = False
+        if networks is not None:
+            self.networks = networks
+        if self.rescan_requested:
+            # A forced rescan arrived while a cached read was in flight
+            self.rescan_requested = False
+            self.refresh(rescan=True)
+            return
+        self.schedule_refresh()
+        pending, self.pending = self.pending, []
+        for callback in pending:
+            callback(self.networks)
+
+    def schedule_refresh(self):
+        """
+        Restart the refresh timer from now. A scan a client asked for
+        counts as a refresh too.
+        """
+        if not self.running:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = scheduler.schedule(self.ttl, self._on_timer)
+
+    def merge(self, networks):
+        """
+        Fold targeted scan results into the list, replacing older entries
+        for the same SSIDs.
+        """
+        ssids = {ap.ssid for ap in networks}
+        merged = [ap for ap in self.networks if ap.ssid not in ssids] + list(networks)
+        self.networks = sorted(merged, key=lambda ap: ap.signal, reverse=True)
+
+    def _on_timer(self):
+        self.timer = None
+        self.refresh()
+
+
+class ScanDeltaTracker:
+    """
+    Turns successive scan lists into the changes a client has not seen yet:
+    networks added, removed, or whose RSSI moved by at least
+    `rssi_threshold` dB or that switched channel. Unchanged networks
+    produce nothing.
+    """
+    RSSI_THRESHOLD = 3
+
+    def __init__(self, rssi_threshold=RSSI_THRESHOLD):
+        self.rssi_threshold = rssi_threshold
+        self.sent = {}
+
+    def update(self, networks):
+        deltas = []
+        current = {ap.ssid: ap for ap in networks}
+        for ssid, ap in current.items():
+            previous = self.sent.get(ssid)
+            if previous is None:
+                deltas.append((DELTA_ADDED, ap))
+            elif (abs(signal_to_rssi(ap.signal) - signal_to_rssi(previous.signal)) >= self.rssi_threshold
+                  or ap.channel != previous.channel):
+                deltas.append((DELTA_CHANGED, ap))
+            else:
+                continue
+            self.sent[ssid] = ap
+        for ssid in [ssid for ssid in self.sent if ssid not in current]:
+            deltas.append((DELTA_REMOVED, self.sent.pop(ssid)))
+        return deltas
+
+
+class ProvisioningStateMachine:
+    """
+    Tracks one connect request through the provisioning states and sends
+    every transition to the client, stamped with the milliseconds since the
+    request was written, so logs from the field show where the time goes.
+    """
+    STATES = ("idle", "validating", "scanning", "associating", "authenticating", "dhcp", "online_check",
+              "connected", "failed")
+    TERMINAL_STATES = ("connected", "failed")
+
+    def __init__(self, session):
+        self.session = session
+        self.state = "idle"
+        self.started = time.monotonic()
+        self.entered = self.started
+        self.durations = []
+
+    def elapsed_ms(self, now=None):
+        return int(((now or time.monotonic()) - self.started) * 1000)
+
+    def transition(self, state, reason=None, error=None):
+        """
+        Enter `state` and notify the client right away. A request that has
+        reached connected or failed does not change any more.
+        """
+        if state not in self.STATES:
+            raise ValueError(f"Unknown provisioning state {state}")
+        if self.state in self.TERMINAL_STATES:
+            logger.warning(f"Ignoring {state} for {self.session.device}, provisioning already {self.state}")
+            return
+        now = time.monotonic()
+        self.durations.append((self.state, int((now - self.entered) * 1000)))
+        self.state = state
+        self.entered = now
+        elapsed = self.elapsed_ms(now)
+        logger.info(f"Provisioning {self.session.device}: {state} at {elapsed} ms"
+                    + (f" ({reason})" if reason else "") + (f" [{error}]" if error else ""))
+        if state in self.TERMINAL_STATES:
+            logger.info(f"Provisioning {self.session.device} {state} after {elapsed} ms: "
+                        + ", ".join(f"{name} {ms} ms" for name, ms in self.durations))
+        self.session.set_state(state, reason, error, elapsed)
+
+
+class ScanStreamState:
+    """
+    One session's scan stream: negotiated MTU, the scan snapshot pages are
+    cut from, frames waiting to be sent and the delta watch.
+    """
+    DEFAULT_MTU = 23
+
+    def __init__(self):
+        self.mtu = self.DEFAULT_MTU
+        self.snapshot = memoryview(b'')
+        self.frames = []
+        self.watch = None
+        self.delta_tracker = None
+        self.pending_deltas = []
+        self.flush_id = None
+
+    def stop_watch(self):
+        """
+        Stop the delta watch and drop changes not sent yet. Returns whether
+        a watch was running.
+        """
+        if self.watch is None:
+            return False
+        self.watch.stop()
+        self.watch = None
+        self.delta_tracker = None
+        self.pending_deltas = []
+        if self.flush_id is not None:
+            GLib.source_remove(self.flush_id)
+            self.flush_id = None
+        return True
+
+    def close(self):
+        self.stop_watch()
+        self.frames = []
+        self.snapshot = memoryview(b'')
+
+
+class ProvisioningSession:
+    """
+    State of one BLE client, keyed by the device path BlueZ passes in the
+    read/write options: payload format, session tag, status buffer, scan
+    read snapshot, scan stream, notification scheduler and idle timer.
+
+    Notifications go out as PropertiesChanged on the shared characteristic
+    value, which BlueZ forwards to every subscribed client. Each carries the
+    session tag so a client can drop the ones meant for other clients.
+    """
+    def __init__(self, characteristic, device, idle_timeout):
+        self.characteristic = characteristic
+        self.device = device
+        self.idle_timeout = idle_timeout
+        self.format = FORMAT_JSON
+        self.tag = 0
+        self.status = "idle"
+        self.reason = None
+        # Set while the status is a provisioning state, see set_state
+        self.error = None
+        self.elapsed_ms = None
+        self.provisioning = None
+        self.update_value()
+        self.read_buffer = None
+        self.scan_stream = ScanStreamState()
+        self.notifier = NotifyScheduler(self, keepalive_seconds=characteristic.NOTIFY_KEEPALIVE,
+                                        send=characteristic.send_notification)
+        if characteristic.notifying:
+            self.notifier.start()
+        self.idle_timer = None
+        self.touch()
+
+    def touch(self):
+        """
+        Record client activity and restart the idle timer.
+        """
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.idle_timer = scheduler.schedule(self.idle_timeout, self.on_idle)
+
+    def on_idle(self):
+        self.idle_timer = None
+        logger.info(f"Idle timeout reached. Disconnecting BLE client {self.device}.")
+        self.characteristic.disconnect_device(self.device)
+
+    def set_status(self, status, reason=None):
+        self.status = status
+        self.reason = reason
+        self.error = None
+        self.elapsed_ms = None
+        self.update_value()
+        self.notifier.value_changed()
+
+    def set_state(self, state, reason, error, elapsed_ms):
+        """
+        Send a provisioning state transition. Unlike set_status it is not
+        coalesced, every transition is its own notification.
+        """
+        self.status = state
+        self.reason = reason
+        self.error = error
+        self.elapsed_ms = elapsed_ms
+        self.update_value()
+        self.notifier.flush()
+
+    def set_tag(self, tag):
+        """
+        Set the tag the client filters its notifications by.
+        """
+        if not isinstance(tag, int) or isinstance(tag, bool) or not 0 <= tag <= 0xFF:
+            raise InvalidArgsException(f"Session tag must be 0-255, got {tag!r}")
+        self.tag = tag
+        self.update_value()
+
+    def update_value(self):
+        if self.elapsed_ms is None:
+            value = encode_status(self.status, self.reason, self.characteristic.ip, self.format, self.tag)
+        else:
+            value = encode_state(self.status, self.reason, self.characteristic.ip, self.error, self.elapsed_ms,
+                                 self.format, self.tag)
+        self.value = [dbus.Byte(x) for x in value]
+
+    def close(self):
+        self.notifier.stop()
+        self.scan_stream.close()
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        self.read_buffer = None
 
 
 class WPACharacteristic(Characteristic):
     WPA_CHAR_UUID = '00001801-0000-1000-6000-00805f9b34fb'
     WPA_CHAR_FLAGS = ['read', 'write', 'notify', 'secure-read', 'secure-write']
+    DESCRIPTORS = [CUDDiscriptor]
 
-    def __init__(self, bus, index, service):
+    SCAN_CACHE_TTL = 30
+    MAX_SCAN_RESULTS = 20
+    NOTIFY_KEEPALIVE = 30
+    IDLE_TIMEOUT = 300
+
+    def __init__(self, bus, index, service, scan_ttl=SCAN_CACHE_TTL, max_scan_results=MAX_SCAN_RESULTS):
         super().__init__(bus, index, self.WPA_CHAR_UUID, self.WPA_CHAR_FLAGS, service)
-        self.wifi_manager = WiFiManager()
+        self.wifi_manager = WiFiManager(bus=bus)
+        self.scan_cache = ScanCache(self.wifi_manager, ttl=scan_ttl)
+        self.max_scan_results = max_scan_results
+        # Probed in start_deferred, once advertising is up
+        self.ip = None
         self.notifying = False
-        self.add_descriptor(CUDDiscriptor(bus, 1, self))
+        self.value = [dbus.Byte(x) for x in encode_status("idle", ip=self.ip)]
+        self.sessions = {}
+        self.connect_queue = deque()
+        self.active_connect = None
+        self.devices = get_object_cache(bus)
+        self.devices.add_listener(self.on_device_connection_changed)
+
+    def start_deferred(self):
+        """
+        Start the work that is not needed to advertise: the IP probe, the
+        NetworkManager backend and the first scan.
+        """
         self.ip = self.get_local_ip()
-        msg = json.dumps({"status": "idle", "ip": self.ip})
-        self.value = [dbus.Byte(x) for x in msg.encode('utf-8')]
-        self.last_activity = time.time()
-        GLib.timeout_add_seconds(60, self.idle_timeout_check)
+        if not self.sessions:
+            self.value = [dbus.Byte(x) for x in encode_status("idle", ip=self.ip)]
+        self.scan_cache.start()
 
     def get_local_ip(self):
         try:
@@ -98,89 +597,504 @@ class WPACharacteristic(Characteristic):
         finally:
             s.close()
 
+    def get_session(self, options):
+        device = options.get('device')
+        session = self.sessions.get(device)
+        if session is None:
+            session = ProvisioningSession(self, device, self.IDLE_TIMEOUT)
+            self.sessions[device] = session
+            logger.info(f"New provisioning session for {device}")
+        session.touch()
+        return session
+
+    def close_session(self, device):
+        session = self.sessions.pop(device, None)
+        if session is None:
+            return
+        session.close()
+        self.connect_queue = deque(entry for entry in self.connect_queue if entry[0] is not session)
+        logger.info(f"Closed provisioning session for {device}")
+
+    def send_notification(self, value):
+        """
+        Notify every subscribed client. Sessions share this value, the tag
+        in each payload tells the clients apart.
+        """
+        if not self.notifying:
+            return
+        self.value = value
+        self.PropertiesChanged(GATT_CHARACTERISTIC_IFACE, {'Value': dbus.Array(value, signature='y')}, [])
+
     def ReadValue(self, options):
-        self.last_activity = time.time()
-        wifi_list = self.wifi_manager.scan_wifi_networks()
-        return array.array('B', '\n'.join(wifi_list).encode('utf-8'))
+        """
+        Serve the scan list as a per-device snapshot. The payload is encoded
+        once at offset 0 and Read Blob requests are answered from slices of
+        it, so a long read stays consistent even if the cache refreshes.
+        """
+        session = self.get_session(options)
+        offset = int(options.get('offset', 0))
+        if offset == 0 or session.read_buffer is None:
+            session.read_buffer = memoryview(self.encode_scan_list(session))
+        buffer = session.read_buffer
+        if offset > len(buffer):
+            raise InvalidOffsetException("Offset past end of value")
+        chunk = buffer[offset:]
+        mtu = options.get('mtu')
+        if mtu is not None and len(chunk) <= int(mtu) - 1:
+            # Last chunk for this read, drop the snapshot
+            session.read_buffer = None
+        return chunk
+
+    def encode_scan_list(self, session):
+        return encode_scan(self.scan_cache.get()[:self.max_scan_results], session.format)
 
     def WriteValue(self, value, options):
-        self.last_activity = time.time()
+        session = self.get_session(options)
+        if len(value) == 1 or (len(value) == 2 and value[0] in FORMATS):
+            # [format] or [format, tag]
+            self.set_format(session, int(value[0]), int(value[1]) if len(value) == 2 else None)
+            return
         try:
             config = json.loads(bytearray(value).decode('utf-8'))
-            self.wifi_manager.set_credentials(config['ssid'], config['psk'])
-            result = self.wifi_manager.connect()
-            self.ip = self.get_local_ip()
-            status = "connected" if result["success"] else "failed"
-
-            self.value = [dbus.Byte(x) for x in json.dumps({
-                "status": status,
-                "reason": result["message"],
-                "ip": self.ip
-            }).encode('utf-8')]
-
-            if self.notifying:
-                self.PropertiesChanged(GATT_CHARACTERISTIC_IFACE, {'Value': dbus.Array(self.value, signature='y')}, [])
-
-            if result["success"]:
-                GLib.timeout_add_seconds(10, self.disconnect_client)
-            else:
-                GLib.timeout_add_seconds(10, self.service.application.restart_advertising)
+        except ValueError as e:
+            # UnicodeDecodeError is a ValueError too
+            self.reject_request(session, f"Malformed request: {e}")
+        if not isinstance(config, dict):
+            self.reject_request(session, "Expected a JSON object")
+        if 'tag' in config:
+            session.set_tag(config['tag'])
+        if config.get('command') == 'rescan':
+            self.rescan(session, config)
+            return
+        if self.is_pending(session):
+            logger.warning(f"Connection already pending for {session.device}, ignoring write")
+            return
+        ssid, psk = config.get('ssid'), config.get('psk')
+        if not isinstance(ssid, str) or not isinstance(psk, (str, type(None))):
+            self.reject_request(session, "Expected {\"ssid\": ..., \"psk\": ...}")
+        try:
+            self.wifi_manager.validate_credentials(ssid, psk)
+        except ValueError as e:
+            self.reject_request(session, str(e))
+        session.provisioning = ProvisioningStateMachine(session)
+        # Without a PSK the stored credentials of a known network are used
+        self.connect_queue.append((session, ssid, psk, bool(config.get('hidden'))))
+        if psk:
+            # Derive the PSK while the request waits in the queue
+            pmk_cache.derive(ssid, psk)
+        if self.active_connect is None:
+            self.start_next_connect()
+        else:
+            session.set_status("queued", f"Position {len(self.connect_queue)}")
+
+    def is_pending(self, session):
+        """
+        Whether the session's connect request is running or queued.
+        """
+        return self.active_connect is session or any(entry[0] is session for entry in self.connect_queue)
+
+    def reject_request(self, session, reason):
+        """
+        Fail a write that cannot become a connect request: the client gets a
+        failed state with the invalid_credentials error and BlueZ an error
+        reply. While the session's connect is pending only the error reply
+        is sent, its provisioning state keeps tracking that connect.
+        """
+        logger.error(f"Rejected write from {session.device}: {reason}")
+        if self.is_pending(session):
+            raise InvalidArgsException(reason)
+        session.provisioning = ProvisioningStateMachine(session)
+        session.provisioning.transition("validating")
+        session.provisioning.transition("failed", reason, "invalid_credentials")
+        raise InvalidArgsException(reason)
+
+    def rescan(self, session, config):
+        """
+        Start a full rescan, or a targeted one when the command lists SSIDs.
+        """
+        ssids, channels = config.get('ssids'), config.get('channels')
+        if ssids is not None and not (isinstance(ssids, list) and all(isinstance(ssid, str) for ssid in ssids)):
+            raise InvalidArgsException("Expected \"ssids\" to be a list of strings")
+        if channels is not None and not (isinstance(channels, list) and all(isinstance(channel, int) for channel in channels)):
+            raise InvalidArgsException("Expected \"channels\" to be a list of numbers")
+        session.set_status("scanning")
+        if ssids:
+            self.wifi_manager.scan_for(ssids, lambda networks: self.on_targeted_scan_complete(session, networks),
+                                       channels=channels)
+            return
+        self.scan_cache.refresh(rescan=True, callback=lambda networks: self.on_rescan_complete(session, networks))
+
+    def start_next_connect(self):
+        """
+        Run queued connect requests one at a time so concurrent clients do
+        not fight over the radio.
+        """
+        while self.connect_queue:
+            session, ssid, psk, hidden = self.connect_queue.popleft()
+            provisioning = session.provisioning
+            provisioning.transition("validating")
+            if psk is None and self.wifi_manager.store.get(ssid) is None:
+                provisioning.transition("failed", f"Unknown network {ssid}", "unknown_network")
+                continue
+            try:
+                if psk is None:
+                    self.wifi_manager.set_known_network(ssid)
+                else:
+                    self.wifi_manager.set_credentials(ssid, psk, hidden)
+            except ValueError as e:
+                provisioning.transition("failed", str(e), "invalid_credentials")
+                continue
+            self.active_connect = session
+            for position, entry in enumerate(self.connect_queue, start=1):
+                entry[0].set_status("queued", f"Position {position}")
+            self.wifi_manager.connect(lambda result: self.on_connect_result(session, result),
+                                      progress=provisioning.transition)
+            return
+        self.active_connect = None
+
+    def on_rescan_complete(self, session, networks):
+        session.set_status("scanned", f"{len(networks)} networks")
+
+    def on_targeted_scan_complete(self, session, networks):
+        self.scan_cache.merge(networks)
+        session.set_status("scanned", f"{len(networks)} networks")
+
+    def on_connect_result(self, session, result):
+        self.ip = result.get("ip") or self.get_local_ip()
+        state = "connected" if result["success"] else "failed"
+        session.provisioning.transition(state, result["message"], result.get("error"))
+        self.start_next_connect()
 
-        except Exception as e:
-            logger.error(f"Error in WriteValue: {e}")
+        if result["success"]:
+            scheduler.schedule(10, self.disconnect_device, session.device)
+        else:
+            scheduler.schedule(10, self.service.application.restart_advertising)
+
+    def set_format(self, session, fmt, tag=None):
+        """
+        Switch a session's status and scan payloads between the plain and
+        detailed JSON forms and the compact binary encoding, optionally
+        setting its tag too. The current status is re-sent in the new format.
+        """
+        if fmt not in FORMATS:
+            raise InvalidArgsException(f"Unknown payload format {fmt}")
+        session.format = fmt
+        session.read_buffer = None
+        if tag is not None:
+            session.set_tag(tag)
+        logger.info(f"Payload format for {session.device} set to {fmt}, tag {session.tag}")
+        session.update_value()
+        session.notifier.value_changed()
+
+    def on_device_connection_changed(self, path, connected):
+        if not connected:
+            self.close_session(path)
 
     def StartNotify(self):
+        """
+        BlueZ calls this for the first subscriber only and StopNotify when
+        the last one leaves, so notifications run for all sessions at once.
+        """
         self.notifying = True
-        self.notify()
+        for session in self.sessions.values():
+            session.notifier.start()
 
     def StopNotify(self):
         self.notifying = False
+        for session in self.sessions.values():
+            session.notifier.stop()
 
-    def notify(self):
-        if self.notifying:
-            self.PropertiesChanged(GATT_CHARACTERISTIC_IFACE, {'Value': dbus.Array(self.value, signature='y')}, [])
-            GLib.timeout_add_seconds(2, self.notify)
-
-    def idle_timeout_check(self):
-        if time.time() - self.last_activity > 300:
-            logger.info("Idle timeout reached. Disconnecting BLE client.")
+    def disconnect_device(self, device_path):
+        """
+        Disconnect one BLE client, or every connected client when BlueZ did
+        not tell us which device the session belongs to.
+        """
+        if device_path is None:
             return self.disconnect_client()
-        return True
+        adapter_path = device_path.rsplit('/', 1)[0]
+        adapter = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, adapter_path), GATT_ADAPTER_IFACE)
+        future = call_async(adapter.RemoveDevice, dbus.ObjectPath(device_path))
+        future.add_done_callback(lambda f: logger.info(f"Disconnected BLE client: {device_path}") if f.exception() is None
+                                 else logger.error(f"Failed to disconnect client: {f.exception()}"))
+        return False
 
     def disconnect_client(self):
-        try:
-            adapter = dbus.Interface(self.bus.get_object("org.bluez", "/org/bluez/hci0"), "org.bluez.Adapter1")
-            for device_path in self.get_connected_devices():
-                adapter.RemoveDevice(device_path)
-                logger.info(f"Disconnected BLE client: {device_path}")
-        except Exception as e:
-            logger.error(f"Failed to disconnect client: {e}")
+        for device_path in self.get_connected_devices():
+            self.disconnect_device(device_path)
         return False
 
     def get_connected_devices(self):
-        obj_manager = dbus.Interface(self.bus.get_object("org.bluez", "/"), "org.freedesktop.DBus.ObjectManager")
-        managed = obj_manager.GetManagedObjects()
-        return [path for path, interfaces in managed.items() if 'org.bluez.Device1' in interfaces and interfaces['org.bluez.Device1'].get('Connected')]
+        return self.devices.get_connected_devices()
+
+
+class ScanStreamCharacteristic(Characteristic):
+    """
+    Streams scan results that do not fit in one 512 byte attribute value.
+    The client writes [OP_PAGE_REQUEST, page] and receives the page as a
+    run of notifications, each one [tag, page, seq, flags] followed by as
+    many bytes as the negotiated MTU allows. `tag` is the session tag set
+    on the WPA characteristic; notifications reach every subscribed client,
+    so a client ignores frames with another tag.
+
+    Writing [OP_WATCH, 1] instead streams changes to the list as they are
+    reported, framed the same way under page DELTA_PAGE. Each message is
+    an encode_scan_delta payload, [OP_WATCH, 0] stops the stream.
+
+    Transfer state lives in each session's ScanStreamState; frames of
+    concurrent transfers are sent in turn.
+    """
+    SCAN_STREAM_CHAR_UUID = '00001802-0000-1000-6000-00805f9b34fb'
+    SCAN_STREAM_CHAR_FLAGS = ['write', 'notify', 'secure-write']
+    DESCRIPTORS = [CUDDiscriptor]
+
+    OP_PAGE_REQUEST = 0x01
+    OP_WATCH = 0x02
+    DELTA_PAGE = 0xFF
+    PAGE_SIZE = 512
+    ATT_NOTIFY_OVERHEAD = 3
+    FRAME_HEADER_SIZE = 4
+    FLAG_LAST_FRAME = 0x01
+    FLAG_LAST_PAGE = 0x02
+
+    def __init__(self, bus, index, service):
+        super().__init__(bus, index, self.SCAN_STREAM_CHAR_UUID, self.SCAN_STREAM_CHAR_FLAGS, service)
+        self.wpa_characteristic = service.get_characteristic(WPACharacteristic.WPA_CHAR_UUID)
+        self.notifying = False
+        # Sessions with frames queued, served round robin
+        self.ready = deque()
+        self.sender_id = None
+
+    def WriteValue(self, value, options):
+        session = self.wpa_characteristic.get_session(options)
+        stream = session.scan_stream
+        if 'mtu' in options:
+            stream.mtu = int(options['mtu'])
+        if len(value) == 2 and value[0] == self.OP_WATCH:
+            if value[1]:
+                self.start_watch(session)
+            else:
+                self.stop_watch(session)
+            return
+        if len(value) != 2 or value[0] != self.OP_PAGE_REQUEST:
+            raise InvalidArgsException("Expected page request")
+        page = int(value[1])
+        if page == 0:
+            # Snapshot once per transfer so every page comes from the same scan
+            stream.snapshot = memoryview(self.wpa_characteristic.encode_scan_list(session))
+        page_count = max(1, -(-len(stream.snapshot) // self.PAGE_SIZE))
+        if page >= page_count:
+            raise InvalidArgsException(f"Page {page} out of range ({page_count} pages)")
+        # A new page request replaces the rest of an earlier page, not pending deltas
+        stream.frames = [frame for frame in stream.frames if frame[1] == self.DELTA_PAGE]
+        stream.frames += self.build_frames(session, page, page_count)
+        self.send_frames(session)
+
+    def send_frames(self, session):
+        if session not in self.ready:
+            self.ready.append(session)
+        if self.sender_id is None:
+            self.sender_id = GLib.idle_add(self.send_next_frame)
+
+    def build_frames(self, session, page, page_count, data=None):
+        stream = session.scan_stream
+        if data is None:
+            data = stream.snapshot[page * self.PAGE_SIZE:(page + 1) * self.PAGE_SIZE]
+        chunk_size = max(1, stream.mtu - self.ATT_NOTIFY_OVERHEAD - self.FRAME_HEADER_SIZE)
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)] or [data]
+        frames = []
+        for seq, chunk in enumerate(chunks):
+            flags = 0
+            if seq == len(chunks) - 1:
+                flags |= self.FLAG_LAST_FRAME
+                if page == page_count - 1:
+                    flags |= self.FLAG_LAST_PAGE
+            frames.append(bytes((session.tag, page, seq & 0xFF, flags)) + chunk)
+        return frames
+
+    def send_next_frame(self):
+        if not self.notifying:
+            for session in self.ready:
+                session.scan_stream.frames = []
+            self.ready.clear()
+        while self.ready:
+            session = self.ready.popleft()
+            stream = session.scan_stream
+            if not stream.frames:
+                # Replaced by a later request or closed with its session
+                continue
+            frame = stream.frames.pop(0)
+            self.PropertiesChanged(GATT_CHARACTERISTIC_IFACE, {'Value': dbus.Array(frame, signature='y')}, [])
+            if stream.frames:
+                self.ready.append(session)
+            return True
+        self.sender_id = None
+        return False
+
+    def start_watch(self, session):
+        """
+        Stream the scan list to a session as deltas, starting with
+        everything already known as additions.
+        """
+        stream = session.scan_stream
+        if stream.watch is not None:
+            return
+        stream.delta_tracker = ScanDeltaTracker()
+        stream.watch = self.wpa_characteristic.wifi_manager.watch_scan(lambda networks: self.on_networks(session, networks))
+        logger.info(f"Streaming scan changes to {session.device}")
+
+    def stop_watch(self, session):
+        if session.scan_stream.stop_watch():
+            logger.info(f"Stopped streaming scan changes to {session.device}")
+
+    def on_networks(self, session, networks):
+        stream = session.scan_stream
+        stream.pending_deltas += stream.delta_tracker.update(networks)
+        # Changes reported in one burst go out as one message
+        if stream.pending_deltas and stream.flush_id is None:
+            stream.flush_id = GLib.idle_add(self.flush_deltas, session)
+
+    def flush_deltas(self, session):
+        stream = session.scan_stream
+        stream.flush_id = None
+        if not self.notifying:
+            # Kept until the client enables notifications
+            return False
+        deltas, stream.pending_deltas = stream.pending_deltas, []
+        if deltas:
+            data = memoryview(encode_scan_delta(deltas, session.format))
+            stream.frames += self.build_frames(session, self.DELTA_PAGE, self.DELTA_PAGE + 1, data)
+            self.send_frames(session)
+        return False
+
+    def StartNotify(self):
+        self.notifying = True
+        for session in self.wpa_characteristic.sessions.values():
+            stream = session.scan_stream
+            if stream.pending_deltas and stream.flush_id is None:
+                stream.flush_id = GLib.idle_add(self.flush_deltas, session)
+
+    def StopNotify(self):
+        self.notifying = False
+        for session in self.wpa_characteristic.sessions.values():
+            self.stop_watch(session)
+
+
+class KnownNetworksCharacteristic(Characteristic):
+    """
+    Networks this device has joined. Reading returns the list, in the
+    format selected on the WPA characteristic and without the PSKs.
+    Writing {"command": "forget", "ssid": ...} removes a network.
+    """
+    KNOWN_NETWORKS_CHAR_UUID = '00001803-0000-1000-6000-00805f9b34fb'
+    KNOWN_NETWORKS_CHAR_FLAGS = ['read', 'write', 'secure-read', 'secure-write']
+    DESCRIPTORS = [CUDDiscriptor]
+
+    def __init__(self, bus, index, service):
+        super().__init__(bus, index, self.KNOWN_NETWORKS_CHAR_UUID, self.KNOWN_NETWORKS_CHAR_FLAGS, service)
+        self.wpa_characteristic = service.get_characteristic(WPACharacteristic.WPA_CHAR_UUID)
+        self.wifi_manager = self.wpa_characteristic.wifi_manager
+
+    def ReadValue(self, options):
+        session = self.wpa_characteristic.get_session(options)
+        offset = int(options.get('offset', 0))
+        value = encode_known(self.wifi_manager.store.list(), session.format)
+        if offset > len(value):
+            raise InvalidOffsetException("Offset past end of value")
+        return value[offset:]
+
+    def WriteValue(self, value, options):
+        self.wpa_characteristic.get_session(options)
+        try:
+            config = json.loads(bytearray(value).decode('utf-8'))
+        except ValueError:
+            raise InvalidArgsException("Expected a JSON command")
+        if not isinstance(config, dict) or config.get('command') != 'forget' or 'ssid' not in config:
+            raise InvalidArgsException("Expected {\"command\": \"forget\", \"ssid\": ...}")
+        try:
+            self.wifi_manager.forget(config['ssid'])
+        except ValueError as e:
+            raise InvalidArgsException(str(e))
 
 
 class WPAService(Service):
     WPA_SERVICE_UUID = '00001801-0000-1000-9000-00805f9b34fb'
+    CHARACTERISTICS = [WPACharacteristic, ScanStreamCharacteristic, KnownNetworksCharacteristic]
+
     def __init__(self, bus, index):
         super().__init__(bus, index, self.WPA_SERVICE_UUID, True)
-        self.wpa_characteristic = WPACharacteristic(bus, 1, self)
-        self.add_characteristic(self.wpa_characteristic)
+        self.wpa_characteristic = self.get_characteristic(WPACharacteristic.WPA_CHAR_UUID)
+        self.scan_stream_characteristic = self.get_characteristic(ScanStreamCharacteristic.SCAN_STREAM_CHAR_UUID)
+        self.known_networks_characteristic = self.get_characteristic(
+            KnownNetworksCharacteristic.KNOWN_NETWORKS_CHAR_UUID)
 
 
 class WPAAdvertisement(Advertisement):
-    def __init__(self, bus, index, mainloop):
+    # Fast burst so phones find the device right after a trigger, then a slow
+    # interval (Apple's recommended 1022.5 ms step) to keep the duty cycle low
+    FAST_INTERVAL = (20, 30)
+    FAST_DURATION = 30
+    SLOW_INTERVAL = (1000, 1285)
+
+    def __init__(self, bus, index, mainloop, interval=None):
         super().__init__(bus, index, 'peripheral', mainloop)
+        if interval is not None:
+            self.set_interval(*interval)
         self.add_service_uuid(WPAService.WPA_SERVICE_UUID)
         self.add_local_name(socket.gethostname())
         self.include_tx_power = True
-        self.set_adapter_property('Discoverable', dbus.Boolean(1))
-        self.set_adapter_property('DiscoverableTimeout', dbus.UInt32(0))
-        self.set_adapter_property('Pairable', dbus.Boolean(1))
-        self.set_adapter_property('PairableTimeout', dbus.UInt32(0))
+        self.adapter_ready = None
+
+    def configure_adapter(self, enabled=True):
+        """
+        Make the adapter discoverable and pairable, or with enabled=False
+        stop it being either. LE advertising does not depend on these
+        settings, so they are applied after it starts.
+        """
+        if not enabled:
+            self.adapter_ready = gather(
+                self.set_adapter_property('Discoverable', dbus.Boolean(0)),
+                self.set_adapter_property('Pairable', dbus.Boolean(0)),
+            )
+            return
+        # Issued together, the calls run concurrently in bluetoothd
+        self.adapter_ready = gather(
+            self.set_adapter_property('Discoverable', dbus.Boolean(1)),
+            self.set_adapter_property('DiscoverableTimeout', dbus.UInt32(0)),
+            self.set_adapter_property('Pairable', dbus.Boolean(1)),
+            self.set_adapter_property('PairableTimeout', dbus.UInt32(0)),
+        )
+
+
+def create_advertising_controller(bus):
+    """
+    Build the fast-then-slow advertising phases. The advertisements get no
+    main loop, failures are retried by the controller instead of exiting.
+    """
+    fast = WPAAdvertisement(bus, 0, None, WPAAdvertisement.FAST_INTERVAL)
+    slow = WPAAdvertisement(bus, 1, None, WPAAdvertisement.SLOW_INTERVAL)
+    return AdvertisingController([(fast, WPAAdvertisement.FAST_DURATION), (slow, None)])
+
+
+def register_agent(bus):
+    """
+    Register the pairing agent without blocking startup, pairing is only
+    needed once a client connects.
+    """
+    agent_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/org/bluez"), "org.bluez.AgentManager1")
+
+    def on_default_agent(future):
+        if future.exception() is not None:
+            logger.error(f"Failed to make agent the default: {future.exception()}")
+            return
+        logger.info("Agent registered for secure pairing")
+
+    def on_registered(future):
+        if future.exception() is not None:
+            logger.error(f"Agent registration failed: {future.exception()}")
+            return
+        call_async(agent_manager.RequestDefaultAgent, AGENT_PATH).add_done_callback(on_default_agent)
+
+    call_async(agent_manager.RegisterAgent, AGENT_PATH, "KeyboardDisplay").add_done_callback(on_registered)
 
 
 def main():
@@ -188,20 +1102,19 @@ def main():
     bus = dbus.SystemBus()
     agent = Agent(bus)
     agent.set_exit_on_release(False)
-    agent_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/org/bluez"), "org.bluez.AgentManager1")
-    agent_manager.RegisterAgent(AGENT_PATH, "KeyboardDisplay")
-    agent_manager.RequestDefaultAgent(AGENT_PATH)
-    logger.info("Agent registered for secure pairing")
+    register_agent(bus)
 
-    advertisement = WPAAdvertisement(bus, 0, mainloop)
+    advertising = create_advertising_controller(bus)
     application = Application(bus, mainloop)
+    application.set_advertising(advertising)
     wpa_service = WPAService(bus, 0)
-    wpa_service.wpa_characteristic.service = wpa_service  # Inject for callbacks
-    wpa_service.application = application                 # For restart access
     application.add_service(wpa_service)
 
+    # Both calls return immediately, everything else waits for the advertisement
+    advertising.add_registered_callback(advertising.phases[0].advertisement.configure_adapter)
+    advertising.add_registered_callback(wpa_service.wpa_characteristic.start_deferred)
+    advertising.start()
     application.register_application()
-    advertisement.start_advertisement()
 
     mainloop.run()
 
@@ -0,0 +1,246 @@
+import ipaddress
+import json
+import struct
+
+
+# Payload formats, selected by the client with a single format byte write.
+# FORMAT_JSON keeps the original scan list of one SSID per line,
+# FORMAT_JSON_DETAILED is JSON throughout, with RSSI, security and channel
+# in every scan entry.
+FORMAT_JSON = 0x00
+FORMAT_BINARY = 0x01
+FORMAT_JSON_DETAILED = 0x02
+FORMATS = (FORMAT_JSON, FORMAT_BINARY, FORMAT_JSON_DETAILED)
+
+# Binary message types (first byte of every binary payload)
+MSG_STATUS = 0x01
+MSG_SCAN = 0x02
+MSG_KNOWN = 0x03
+MSG_SCAN_DELTA = 0x04
+MSG_STATE = 0x05
+
+# Scan delta operations
+DELTA_ADDED = 0x01
+DELTA_CHANGED = 0x02
+DELTA_REMOVED = 0x03
+DELTA_NAMES = {DELTA_ADDED: "added", DELTA_CHANGED: "changed", DELTA_REMOVED: "removed"}
+
+STATUS_CODES = {
+    "idle": 0x00,
+    "connecting": 0x01,
+    "connected": 0x02,
+    "failed": 0x03,
+    "scanning": 0x04,
+    "scanned": 0x05,
+    "validating": 0x06,
+    "associating": 0x07,
+    "authenticating": 0x08,
+    "dhcp": 0x09,
+    "online_check": 0x0A,
+    "queued": 0x0B,
+}
+STATUS_UNKNOWN = 0xFF
+
+# Why provisioning failed, sent with the "failed" state
+ERROR_CODES = {
+    None: 0x00,
+    "invalid_credentials": 0x01,
+    "unknown_network": 0x02,
+    "network_not_found": 0x03,
+    "association_failed": 0x04,
+    "auth_failed": 0x05,
+    "dhcp_failed": 0x06,
+    "no_internet": 0x07,
+    "captive_portal": 0x08,
+    "timeout": 0x09,
+}
+ERROR_UNKNOWN = 0xFF
+
+# Security flags for scan entries
+SECURITY_OPEN = 0x00
+SECURITY_WEP = 0x01
+SECURITY_WPA = 0x02
+SECURITY_WPA2 = 0x04
+SECURITY_WPA3 = 0x08
+SECURITY_ENTERPRISE = 0x10
+
+# type, session tag, status code, IPv4 address
+STATUS_HEADER = struct.Struct('!BBB4s')
+# type, session tag, state code, error code, milliseconds since the request,
+# IPv4 address
+STATE_HEADER = struct.Struct('!BBBBI4s')
+# RSSI (dBm), security flags, channel, SSID length
+SCAN_ENTRY_HEADER = struct.Struct('!bBBB')
+# delta operation, then a scan entry
+DELTA_ENTRY_HEADER = struct.Struct('!B')
+# BSSID, channel, SSID length
+KNOWN_ENTRY_HEADER = struct.Struct('!6sBB')
+
+# Leaves a status notification within the 20 bytes of a default 23 byte MTU
+MAX_REASON_LENGTH = 20 - STATUS_HEADER.size
+MAX_STATE_REASON_LENGTH = 20 - STATE_HEADER.size
+MAX_SSID_LENGTH = 32
+
+
+def encode_utf8(text, max_bytes):
+    """
+    Encode text as UTF-8 in at most max_bytes without splitting a character.
+    """
+    return (text or "").encode('utf-8')[:max_bytes].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def encode_ipv4(ip):
+    """
+    Pack a dotted IPv4 address into 4 bytes, 0.0.0.0 if it is not valid.
+    """
+    try:
+        return ipaddress.IPv4Address(ip or "0.0.0.0").packed
+    except ValueError:
+        return bytes(4)
+
+
+def encode_bssid(bssid):
+    """
+    Pack a colon separated MAC address into 6 bytes, zeros if it is not valid.
+    """
+    try:
+        packed = bytes.fromhex((bssid or "").replace(':', ''))
+    except ValueError:
+        return bytes(6)
+    return packed if len(packed) == 6 else bytes(6)
+
+
+def security_flags(security):
+    """
+    Map an nmcli SECURITY string such as "WPA2 WPA3" to security flags.
+    """
+    flags = SECURITY_OPEN
+    for token in (security or "").split():
+        if token == 'WEP':
+            flags |= SECURITY_WEP
+        elif token == 'WPA1':
+            flags |= SECURITY_WPA
+        elif token == 'WPA2':
+            flags |= SECURITY_WPA2
+        elif token == 'WPA3':
+            flags |= SECURITY_WPA3
+        elif token == '802.1X':
+            flags |= SECURITY_ENTERPRISE
+    return flags
+
+
+def signal_to_rssi(signal):
+    """
+    Convert NetworkManager's 0-100 signal quality to an approximate dBm.
+    """
+    return max(-128, min(0, signal // 2 - 100))
+
+
+def encode_status(status, reason=None, ip=None, fmt=FORMAT_JSON, tag=0):
+    """
+    Encode a status update. `tag` identifies the client session the update
+    belongs to. The binary form is a fixed 7 byte header followed by the
+    reason, truncated so the update fits one notification.
+    """
+    if fmt == FORMAT_BINARY:
+        header = STATUS_HEADER.pack(MSG_STATUS, tag, STATUS_CODES.get(status, STATUS_UNKNOWN), encode_ipv4(ip))
+        tail = encode_utf8(reason, MAX_REASON_LENGTH)
+        return header + tail
+    payload = {"tag": tag, "status": status}
+    if reason is not None:
+        payload["reason"] = reason
+    payload["ip"] = ip
+    return json.dumps(payload).encode('utf-8')
+
+
+def encode_state(state, reason=None, ip=None, error=None, elapsed_ms=0, fmt=FORMAT_JSON, tag=0):
+    """
+    Encode a provisioning state transition with its error code and the
+    milliseconds since the connect request was received. The binary form is
+    a 12 byte header followed by the reason, truncated like in
+    encode_status.
+    """
+    if fmt == FORMAT_BINARY:
+        header = STATE_HEADER.pack(MSG_STATE, tag, STATUS_CODES.get(state, STATUS_UNKNOWN),
+                                   ERROR_CODES.get(error, ERROR_UNKNOWN), min(elapsed_ms, 0xFFFFFFFF), encode_ipv4(ip))
+        tail = encode_utf8(reason, MAX_STATE_REASON_LENGTH)
+        return header + tail
+    payload = {"tag": tag, "status": state}
+    if reason is not None:
+        payload["reason"] = reason
+    if error is not None:
+        payload["error"] = error
+    payload["ip"] = ip
+    payload["t"] = elapsed_ms
+    return json.dumps(payload).encode('utf-8')
+
+
+def encode_scan(networks, fmt=FORMAT_JSON):
+    """
+    Encode a list of AccessPoints. The default text form is one SSID per
+    line, FORMAT_JSON_DETAILED gives a JSON list of {"ssid", "rssi",
+    "security", "channel"} and the binary form is a message type byte
+    followed by one [rssi, security, channel, length, ssid] record per
+    network.
+    """
+    if fmt == FORMAT_BINARY:
+        out = bytearray((MSG_SCAN,))
+        for ap in networks:
+            ssid = encode_utf8(ap.ssid, MAX_SSID_LENGTH)
+            out += SCAN_ENTRY_HEADER.pack(signal_to_rssi(ap.signal), security_flags(ap.security), ap.channel, len(ssid))
+            out += ssid
+        return bytes(out)
+    if fmt == FORMAT_JSON_DETAILED:
+        return json.dumps([
+            {"ssid": ap.ssid, "rssi": signal_to_rssi(ap.signal), "security": ap.security, "channel": ap.channel}
+            for ap in networks
+        ]).encode('utf-8')
+    return '\n'.join(ap.ssid for ap in networks).encode('utf-8')
+
+
+def encode_known(networks, fmt=FORMAT_JSON):
+    """
+    Encode the stored networks. The text form is a JSON list without the
+    PSKs, the binary form is a message type byte followed by one
+    [bssid, channel, length, ssid] record per network.
+    """
+    if fmt == FORMAT_BINARY:
+        out = bytearray((MSG_KNOWN,))
+        for network in networks:
+            ssid = encode_utf8(network.ssid, MAX_SSID_LENGTH)
+            out += KNOWN_ENTRY_HEADER.pack(encode_bssid(network.bssid), network.channel or 0, len(ssid))
+            out += ssid
+        return bytes(out)
+    return json.dumps([
+        {"ssid": network.ssid, "bssid": network.bssid, "channel": network.channel,
+         "last_connected": network.last_connected}
+        for network in networks
+    ]).encode('utf-8')
+
+
+def encode_scan_delta(deltas, fmt=FORMAT_JSON):
+    """
+    Encode scan list changes, a list of (operation, AccessPoint). The binary
+    form is a message type byte followed by one [operation, rssi, security,
+    channel, length, ssid] record per change; removed networks carry zeros.
+    The text form is a JSON list of {"op", "ssid", "rssi", "channel"}.
+    """
+    if fmt == FORMAT_BINARY:
+        out = bytearray((MSG_SCAN_DELTA,))
+        for op, ap in deltas:
+            ssid = encode_utf8(ap.ssid, MAX_SSID_LENGTH)
+            out += DELTA_ENTRY_HEADER.pack(op)
+            if op == DELTA_REMOVED:
+                out += SCAN_ENTRY_HEADER.pack(0, 0, 0, len(ssid))
+            else:
+                out += SCAN_ENTRY_HEADER.pack(signal_to_rssi(ap.signal), security_flags(ap.security), ap.channel, len(ssid))
+            out += ssid
+        return bytes(out)
+    changes = []
+    for op, ap in deltas:
+        change = {"op": DELTA_NAMES[op], "ssid": ap.ssid}
+        if op != DELTA_REMOVED:
+            change["rssi"] = signal_to_rssi(ap.signal)
+            change["channel"] = ap.channel
+        changes.append(change)
+    return json.dumps(changes).encode('utf-8')